@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+""" Benchmark bulk body serialization in cdr-es-upload:
+elasticsearch.helpers chunking (serialize to str, join, encode to utf-8)
+vs. serializing each action to bytes once (scrapy_cdr.es_upload).
+
+Run from the repository root (or with scrapy-cdr installed)::
+
+    PYTHONPATH=. python benchmarks/bulk_serialization.py --items 2000 --content-size 100000
+"""
+import argparse
+import time
+
+import elasticsearch.helpers as es_helpers
+from elasticsearch.serializer import JSONSerializer
+
+from scrapy_cdr import es_upload, utils
+
+
+def make_actions(n_items, content_size):
+    content = (u'lorem ipsum élève <a href="/x">' * (
+        content_size // 30 + 1))[:content_size]
+    for i in range(n_items):
+        yield {
+            '_op_type': 'index',
+            '_index': 'cdr',
+            '_type': 'document',
+            '_id': 'ID{}'.format(i),
+            '_source': {
+                'url': 'http://example.com/{}'.format(i),
+                'timestamp_crawl': '2017-02-15T20:30:59.000000Z',
+                'raw_content': content,
+                'response_headers': {'content-type': 'text/html'},
+                'objects': [],
+            },
+        }
+
+
+def es_helpers_bodies(actions, chunk_size, max_chunk_bytes):
+    serializer = JSONSerializer()
+    for chunk in es_helpers._chunk_actions(
+            map(es_helpers.expand_action, actions),
+            chunk_size, max_chunk_bytes, serializer):
+        bulk_actions = chunk[1] if isinstance(chunk, tuple) else chunk
+        # client.bulk joins lines, transport encodes the body
+        yield ('\n'.join(bulk_actions) + '\n').encode('utf-8')
+
+
+def scrapy_cdr_bodies(actions, chunk_size, max_chunk_bytes):
+    for chunk in es_upload._chunk_actions(
+            map(es_upload.serialize_action, actions),
+            chunk_size, max_chunk_bytes):
+        yield b''.join(chunk)
+
+
+def measure(name, fn, args):
+    t0 = time.perf_counter()
+    total = 0
+    for body in fn(make_actions(args.items, args.content_size),
+                   args.chunk_size, args.max_chunk_bytes):
+        total += len(body)
+    dt = time.perf_counter() - t0
+    print('{:<24} {:>8.1f} MB/s ({:.1f} MB in {:.2f}s)'.format(
+        name, total / dt / 2**20, total / 2**20, dt))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    arg = parser.add_argument
+    arg('--items', type=int, default=2000)
+    arg('--content-size', type=int, default=100000)
+    arg('--chunk-size', type=int, default=50)
+    arg('--max-chunk-bytes', type=int, default=10 * 2**20)
+    args = parser.parse_args()
+    print('JSON encoder: {}'.format(
+        'orjson' if utils.orjson else 'ujson' if utils.ujson else 'json'))
+    measure('elasticsearch.helpers', es_helpers_bodies, args)
+    measure('serialize_action', scrapy_cdr_bodies, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+""" Benchmark CDR item construction in a spider callback:
+text_cdr_item as it used to be (datetime formatting, Headers.to_unicode_dict,
+CDRItem) vs. the current text_cdr_item with CDRItem and with plain dicts.
+
+Run from the repository root (or with scrapy-cdr installed)::
+
+    PYTHONPATH=. python benchmarks/cdr_item.py --items 100000
+"""
+import argparse
+from datetime import datetime
+import time
+
+from scrapy.http.response.html import HtmlResponse
+
+from scrapy_cdr import CDRItem
+from scrapy_cdr.utils import text_cdr_item, format_timestamp, format_id
+
+
+def old_text_cdr_item(response, crawler_name, team_name, item_cls=CDRItem):
+    content_type = response.headers.get('content-type', b'')
+    timestamp_crawl = format_timestamp(datetime.utcnow())
+    return item_cls(
+        _id=format_id(response.url, timestamp_crawl),
+        crawler=crawler_name,
+        team=team_name,
+        timestamp_crawl=timestamp_crawl,
+        url=response.url,
+        version=3.1,
+        content_type=content_type.decode('ascii', 'ignore'),
+        raw_content=response.text,
+        response_headers=response.headers.to_unicode_dict(),
+        objects=[])
+
+
+def make_responses(n_items, content_size):
+    body = (u'<p>lorem ipsum élève <a href="/x">' * (
+        content_size // 30 + 1))[:content_size].encode('utf8')
+    headers = {
+        'Content-Type': 'text/html; charset=utf-8',
+        'Server': 'nginx',
+        'Date': 'Wed, 15 Feb 2017 20:30:59 GMT',
+        'Cache-Control': 'max-age=0, private',
+        'Set-Cookie': ['a=1', 'b=2'],
+    }
+    return [HtmlResponse('http://example.com/{}'.format(i),
+                         body=body, headers=headers)
+            for i in range(n_items)]
+
+
+def run(name, factory, responses, **kwargs):
+    t0 = time.perf_counter()
+    for response in responses:
+        factory(response, crawler_name='crawler', team_name='team', **kwargs)
+    dt = time.perf_counter() - t0
+    print('{:<28} {:>10,.0f} items/s'.format(name, len(responses) / dt))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    arg = parser.add_argument
+    arg('--items', type=int, default=100000)
+    arg('--content-size', type=int, default=2000)
+    args = parser.parse_args()
+    # decoded text is cached by the response, decode it as the spider would
+    responses = make_responses(args.items, args.content_size)
+    for response in responses:
+        response.text
+    run('old text_cdr_item', old_text_cdr_item, responses)
+    run('text_cdr_item', text_cdr_item, responses)
+    run('text_cdr_item, item_cls=dict', text_cdr_item, responses,
+        item_cls=dict)
+
+
+if __name__ == '__main__':
+    main()
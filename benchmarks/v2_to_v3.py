@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+""" Benchmark cdr-v2-to-v3 throughput on a synthetic CDRv2 file,
+comparing the converter with different numbers of workers and
+per-item conversion through CDRItem (how cdr-v2-to-v3 used to work).
+
+Run from the repository root (or with scrapy-cdr installed)::
+
+    PYTHONPATH=. python benchmarks/v2_to_v3.py --size-mb 1024 --workers 1,4
+"""
+import argparse
+from datetime import datetime
+import gzip
+import json
+import os
+import sys
+import tempfile
+import time
+
+from scrapy_cdr import jl_io, v2_to_v3
+from scrapy_cdr.items import CDRItem
+from scrapy_cdr.utils import format_timestamp, format_id
+
+
+def make_v2_file(path, size_mb, content_size):
+    content = (u'lorem ipsum élève <a href="/x">' * (
+        content_size // 30 + 1))[:content_size]
+    size = 0
+    i = 0
+    with jl_io.JLWriter(path, level=1) as writer:
+        while size < size_mb * 2**20:
+            line = json.dumps({
+                'url': 'http://example.com/{}'.format(i),
+                'timestamp': 1487190659000 + i,
+                'crawler': 'crawler',
+                'team': 'team',
+                'version': 2.0,
+                'raw_content': content,
+                'content_type': 'text/html',
+            }).encode('utf8') + b'\n'
+            writer.write(line)
+            size += len(line)
+            i += 1
+    return size
+
+
+def convert_items(input_path, output_path):
+    with gzip.open(output_path, 'wt') as outf:
+        for v2_item in jl_io.iter_items(input_path):
+            dt = datetime.fromtimestamp(v2_item['timestamp'] / 1e3)
+            timestamp_crawl = format_timestamp(dt)
+            v3_item = CDRItem(
+                _id=format_id(v2_item['url'], timestamp_crawl),
+                crawler=v2_item['crawler'],
+                team=v2_item['team'],
+                timestamp_crawl=timestamp_crawl,
+                version=3.0,
+                url=v2_item['url'],
+                raw_content=v2_item['raw_content'],
+                content_type=v2_item['content_type'],
+                response_headers={'content-type': v2_item['content_type']},
+            )
+            outf.write(json.dumps(dict(v3_item)))
+            outf.write('\n')
+
+
+def convert_main(input_path, output_path, workers):
+    sys.argv = ['cdr-v2-to-v3', input_path, output_path,
+                '--workers', str(workers)]
+    v2_to_v3.main()
+
+
+def measure(name, fn, size):
+    t0 = time.perf_counter()
+    fn()
+    dt = time.perf_counter() - t0
+    print('{:<24} {:>8.1f} MB/s ({:.1f} MB in {:.2f}s)'.format(
+        name, size / dt / 2**20, size / 2**20, dt))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    arg = parser.add_argument
+    arg('--size-mb', type=int, default=1024,
+        help='uncompressed size of the input file')
+    arg('--content-size', type=int, default=20000)
+    arg('--workers', default='1,{}'.format(os.cpu_count()),
+        help='comma-separated numbers of workers to try')
+    arg('--skip-items', action='store_true',
+        help='skip the per-item CDRItem conversion')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        input_path = os.path.join(tmp, 'items.v2.jl.gz')
+        output_path = os.path.join(tmp, 'items.v3.jl.gz')
+        size = make_v2_file(input_path, args.size_mb, args.content_size)
+        if not args.skip_items:
+            measure('CDRItem per item',
+                    lambda: convert_items(input_path, output_path), size)
+        for workers in map(int, args.workers.split(',')):
+            measure('cdr-v2-to-v3 workers={}'.format(workers),
+                    lambda: convert_main(input_path, output_path, workers),
+                    size)
+
+
+if __name__ == '__main__':
+    main()
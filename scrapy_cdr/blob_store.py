@@ -0,0 +1,88 @@
+""" Content-addressed storage of large payloads, in a local directory
+or in S3 (or S3-compatible storage). Keys are UPPERCASE hex SHA-256
+of the content, same as paths of media items stored by CDRMediaPipeline.
+"""
+import hashlib
+import os
+import tempfile
+
+from six.moves.urllib.parse import urlsplit
+
+
+def content_key(data):
+    return hashlib.sha256(data).hexdigest().upper()
+
+
+def open_store(uri, endpoint_url=None):
+    """ Return a store for an "s3://bucket/prefix" URI or a local path.
+    ``endpoint_url`` can be set for S3-compatible storage.
+    """
+    if uri.startswith('s3://'):
+        return S3BlobStore(uri, endpoint_url=endpoint_url)
+    return LocalBlobStore(uri)
+
+
+class LocalBlobStore:
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def put(self, data):
+        """ Store data (bytes) and return its key.
+        """
+        key = content_key(data)
+        path = os.path.join(self.path, key)
+        if not os.path.exists(path):
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return key
+
+    def get(self, key):
+        with open(os.path.join(self.path, key), 'rb') as f:
+            return f.read()
+
+    def stored_url(self, key):
+        """ URL of a stored object relative to the store,
+        same as ``obj_stored_url`` of media items.
+        """
+        return key
+
+    def stored_key(self, stored_url):
+        """ Key for a URL returned by ``stored_url``.
+        """
+        return stored_url
+
+
+class S3BlobStore:
+    def __init__(self, uri, endpoint_url=None):
+        import botocore.session
+        parsed = urlsplit(uri)
+        self.bucket = parsed.netloc
+        self.prefix = parsed.path.lstrip('/')
+        if self.prefix and not self.prefix.endswith('/'):
+            self.prefix += '/'
+        self._client = botocore.session.get_session().create_client(
+            's3', endpoint_url=endpoint_url)
+
+    def put(self, data):
+        key = content_key(data)
+        self._client.put_object(
+            Bucket=self.bucket, Key=self.prefix + key, Body=data)
+        return key
+
+    def get(self, key):
+        return self._client.get_object(
+            Bucket=self.bucket, Key=self.prefix + key)['Body'].read()
+
+    def stored_url(self, key):
+        # relative like in CDRMediaPipeline.s3_path with CDR_S3_RELATIVE_URLS
+        return self.prefix + key
+
+    def stored_key(self, stored_url):
+        if not stored_url.startswith(self.prefix):
+            raise ValueError('{} is not under {} prefix'.format(
+                stored_url, self.prefix))
+        return stored_url[len(self.prefix):]
@@ -0,0 +1,135 @@
+""" asyncio engine for cdr-es-upload (``--engine async``),
+which needs aiohttp to be installed.
+"""
+import asyncio
+from concurrent.futures import Executor
+from itertools import cycle
+import json
+import threading
+import time
+
+import aiohttp
+import elasticsearch
+
+from .es_upload import (
+    _parallel_bulk, _record_chunk, _bulk_results, _bulk_error_results,
+    _raise_on_error)
+
+
+class AsyncBulkClient:
+    """ Sends bulk requests with aiohttp, using a pool of keep-alive
+    connections to all ``hosts`` (in round-robin order).
+    The event loop runs in a separate thread, so that requests are
+    in progress while the calling thread prepares the next chunks.
+    """
+    def __init__(self, hosts, concurrency, timeout=600, http_auth=None):
+        self.concurrency = concurrency
+        self._urls = cycle([_host_url(host) for host in hosts])
+        self._timeout = timeout
+        self._auth = aiohttp.BasicAuth(*http_auth) if http_auth else None
+        self._session = None
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    async def bulk(self, body, params=None):
+        """ Send a serialized bulk body (bytes) and return the decoded
+        response. Raise elasticsearch.TransportError subclasses on errors,
+        same as elasticsearch.RequestsHttpConnection.
+        """
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                auth=self._auth,
+                timeout=aiohttp.ClientTimeout(total=self._timeout))
+        url = '{}/_bulk'.format(next(self._urls))
+        try:
+            async with self._session.post(
+                    url, data=body, params=params or {},
+                    headers={'Content-Type': 'application/x-ndjson'},
+                    ) as response:
+                data = await response.read()
+        except asyncio.TimeoutError as e:
+            raise elasticsearch.ConnectionTimeout('TIMEOUT', str(e), e)
+        except aiohttp.ClientError as e:
+            raise elasticsearch.ConnectionError('N/A', str(e), e)
+        data = data.decode('utf8')
+        if not 200 <= response.status < 300:
+            try:
+                info = json.loads(data)
+            except ValueError:
+                info = data
+            raise elasticsearch.exceptions.HTTP_EXCEPTIONS.get(
+                response.status, elasticsearch.TransportError)(
+                response.status, data, info)
+        return json.loads(data)
+
+    def close(self):
+        if self._session is not None:
+            asyncio.run_coroutine_threadsafe(
+                self._session.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+class AsyncioExecutor(Executor):
+    """ Runs coroutine functions in an event loop running in another thread.
+    """
+    def __init__(self, loop, max_workers=None):
+        self.loop = loop
+
+    def submit(self, fn, *args, **kwargs):
+        return asyncio.run_coroutine_threadsafe(fn(*args, **kwargs), self.loop)
+
+
+def async_parallel_bulk(client, actions, concurrency=100, chunk_size=500,
+                        max_chunk_bytes=100 * 1024 * 1024,
+                        serialize_action_callback=None,
+                        yield_actions=False,
+                        controller=None,
+                        raise_on_exception=True,
+                        raise_on_error=True,
+                        **kwargs):
+    """ Same as es_upload.parallel_bulk, but bulk requests are sent with
+    an ``AsyncBulkClient``, with up to ``concurrency`` requests in flight.
+    """
+    async def process_chunk(chunk):
+        bodies = [body for _, body in chunk]
+        t0 = time.time()
+        try:
+            resp = await client.bulk(b''.join(bodies), params=kwargs)
+        except elasticsearch.TransportError as e:
+            if raise_on_exception:
+                raise
+            results = _bulk_error_results(bodies, e)
+        else:
+            results = _bulk_results(resp)
+        if raise_on_error:
+            _raise_on_error(results)
+        _record_chunk(controller, bodies, results, t0)
+        return chunk, results
+
+    def executor_cls(max_workers):
+        return AsyncioExecutor(client.loop, max_workers=max_workers)
+
+    return _parallel_bulk(
+        process_chunk, actions,
+        executor_cls=executor_cls,
+        concurrency=concurrency,
+        chunk_size=chunk_size,
+        max_chunk_bytes=max_chunk_bytes,
+        serialize_action_callback=serialize_action_callback,
+        yield_actions=yield_actions,
+        controller=controller)
+
+
+def _host_url(host):
+    if '://' not in host:
+        host = 'http://{}'.format(host)
+    scheme, rest = host.split('://', 1)
+    if ':' not in rest.split('/', 1)[0]:
+        host_name, _, path = rest.partition('/')
+        rest = '{}:9200{}'.format(host_name, '/' + path if path else '')
+    return '{}://{}'.format(scheme, rest).rstrip('/')
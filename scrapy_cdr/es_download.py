@@ -1,49 +1,165 @@
 import argparse
-import gzip
-import json
+from multiprocessing import Pool, Value
+import os
+import shutil
 
 import elasticsearch
+import elasticsearch.helpers as es_helpers
 from elasticsearch_dsl import Search
 import tqdm
 
+from . import jl_io
+from .utils import json_dumps_bytes
+
 
 def main():
     parser = argparse.ArgumentParser(description='Download items from ES index')
     arg = parser.add_argument
-    arg('output', help='output in .jl.gz format')
+    arg('output', help='output in .jl, .jl.gz, .jl.zst or .jl.lz4 format')
     arg('index', help='ES index name')
     arg('--domain', help='url.domain to filter')
     arg('--id', help='record id')
     arg('--host', default='localhost', help='ES host in host[:port] format')
     arg('--user', help='HTTP Basic Auth user')
     arg('--password', help='HTTP Basic Auth password')
-    arg('--chunk-size', type=int, default=100, help='download chunk size')
+    arg('--chunk-size', type=int,
+        help='download chunk size (by default it is chosen based on '
+             'the size of documents)')
+    arg('--fields', help='download only these fields (comma-separated)')
+    arg('--exclude-fields', help='do not download these fields '
+                                 '(comma-separated)')
+    arg('--slices', type=int, default=1,
+        help='download in parallel with N sliced scrolls in separate '
+             'processes (N should not be larger than the number of shards)')
+    arg('--keep-parts', action='store_true',
+        help='with --slices, keep a separate output file for each slice, '
+             'instead of merging them into output')
+    arg('--compression-level', type=int,
+        help='compression level (default depends on output format)')
+    arg('--compression-threads', type=int, default=2,
+        help='number of threads used for compression by each process')
 
     args = parser.parse_args()
+    client = _client(args)
+    print(client.info())
+
+    search = _search(args, client)
+    if args.chunk_size is None:
+        args.chunk_size = adaptive_chunk_size(
+            client, args.index, search.to_dict())
+        print('Using chunk size {:,}'.format(args.chunk_size))
+
+    if args.slices > 1:
+        paths = [_part_path(args.output, i) for i in range(args.slices)]
+    else:
+        paths = [args.output]
+    total = Value('l', 0)
+    with tqdm.tqdm(total=search.count()) as pbar:
+        with Pool(processes=len(paths), initializer=_init_worker,
+                  initargs=(total,)) as pool:
+            result = pool.starmap_async(
+                _download_slice,
+                [(args, i, path) for i, path in enumerate(paths)])
+            while not result.ready():
+                result.wait(0.5)
+                pbar.update(total.value - pbar.n)
+            result.get()
+        pbar.update(total.value - pbar.n)
+
+    if args.slices > 1 and not args.keep_parts:
+        _merge(paths, args.output)
+        paths = [args.output]
+    print('{:,} items downloaded to {}'.format(total.value, ', '.join(paths)))
+
+
+def _client(args):
     kwargs = {}
     if args.user or args.password:
         kwargs['http_auth'] = (args.user, args.password)
-
-    client = elasticsearch.Elasticsearch(
+    return elasticsearch.Elasticsearch(
         [args.host],
         connection_class=elasticsearch.RequestsHttpConnection,
         timeout=600,
         **kwargs)
-    print(client.info())
 
+
+def _search(args, client):
     search = Search(using=client, index=args.index)
     if args.domain:
         search = search.filter('term', **{'url.domain': args.domain})
     if args.id:
         search = search.filter('term', **{'_id': args.id})
+    source = {}
+    if args.fields:
+        source['includes'] = args.fields.split(',')
+    if args.exclude_fields:
+        source['excludes'] = args.exclude_fields.split(',')
+    if source:
+        search = search.source(**source)
+    return search
 
-    total = 0
-    with tqdm.tqdm(total=search.count()) as pbar:
-        with gzip.open(args.output, 'wt') as f:
-            for x in search.params(size=args.chunk_size).scan():
-                total += 1
-                pbar.update(1)
-                f.write(json.dumps(x.to_dict()))
-                f.write('\n')
-
-    print('{:,} items downloaded to {}'.format(total, args.output))
+
+def adaptive_chunk_size(client, index, query, target_bytes=20 * 2**20,
+                        min_size=100, max_size=5000, sample_size=20):
+    """ Return a scroll page size for pages of about ``target_bytes``,
+    based on the size of a sample of documents matching the query.
+    """
+    resp = client.search(index=index, body=dict(query, size=sample_size))
+    hits = resp['hits']['hits']
+    if not hits:
+        return min_size
+    doc_size = sum(len(json_dumps_bytes(hit['_source'])) for hit in hits)
+    doc_size /= len(hits)
+    return int(max(min_size, min(max_size, target_bytes / doc_size)))
+
+
+_total = None  # shared counter of downloaded items
+
+
+def _init_worker(total):
+    global _total
+    _total = total
+
+
+def _download_slice(args, slice_id, path):
+    """ Download documents from a slice of the scroll into path,
+    or all documents if there is only one slice.
+    """
+    client = _client(args)
+    search = _search(args, client)
+    if args.slices > 1:
+        search = search.extra(slice={'id': slice_id, 'max': args.slices})
+    n_items = 0
+    with jl_io.JLWriter(path, level=args.compression_level,
+                        threads=args.compression_threads) as writer:
+        for hit in es_helpers.scan(
+                client, query=search.to_dict(), index=args.index,
+                size=args.chunk_size):
+            writer.write_item(hit.get('_source', {}))
+            n_items += 1
+            if n_items % 1000 == 0:
+                _add_to_total(1000)
+    _add_to_total(n_items % 1000)
+    return n_items
+
+
+def _add_to_total(n):
+    with _total.get_lock():
+        _total.value += n
+
+
+def _part_path(path, slice_id):
+    """ output.jl.gz -> output.part0.jl.gz
+    """
+    return jl_io.part_path(path, 'part{}'.format(slice_id))
+
+
+def _merge(paths, output):
+    """ Concatenate parts into output: a concatenation of gzip
+    (or zstd, or lz4) files is a valid file of the same format.
+    """
+    with open(output, 'wb') as outf:
+        for path in paths:
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, outf, 2**20)
+            os.remove(path)
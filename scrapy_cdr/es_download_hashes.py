@@ -2,11 +2,13 @@ import argparse
 import csv
 import hashlib
 
-import elasticsearch
+import elasticsearch.helpers as es_helpers
 from elasticsearch_dsl import Search
 import tqdm
 from w3lib.url import canonicalize_url
 
+from .es_download import _client
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -19,42 +21,59 @@ def main():
     arg('--user', help='HTTP Basic Auth user')
     arg('--password', help='HTTP Basic Auth password')
     arg('--chunk-size', type=int, default=100, help='download chunk size')
+    arg('--hash-field',
+        help='field with a precomputed SHA-1 hex digest of raw_content '
+             '(e.g. raw_content_hash set by text_cdr_item): '
+             'if set, raw_content is not downloaded (it is still fetched '
+             'for items without this field)')
 
     args = parser.parse_args()
-    kwargs = {}
-    if args.user or args.password:
-        kwargs['http_auth'] = (args.user, args.password)
-
-    client = elasticsearch.Elasticsearch(
-        [args.host],
-        connection_class=elasticsearch.RequestsHttpConnection,
-        timeout=600,
-        **kwargs)
+    client = _client(args)
     print(client.info())
 
     search = Search(using=client, index=args.index)
     if args.domain:
         search = search.filter('term', **{'url.domain': args.domain})
+    search = search.source(includes=_source_fields(args.hash_field))
 
     total = 0
     with tqdm.tqdm(total=search.count()) as pbar:
         with open(args.output, 'wt') as f:
             writer = csv.writer(f)
-            for x in search.params(size=args.chunk_size).scan():
+            for hit in es_helpers.scan(
+                    client, query=search.to_dict(), index=args.index,
+                    size=args.chunk_size):
                 total += 1
                 pbar.update(1)
-                x = x.to_dict()
-                writer.writerow([
-                    x['timestamp_crawl'],
-                    (hashlib.sha1((x['raw_content'] or '')
-                     .encode('utf8')).hexdigest()),
-                    x['team'],
-                    x['url'],
-                    canonicalize_url(x['url'], keep_fragments=True),
-                ])
+                writer.writerow(_hash_row(hit, client, args.hash_field))
 
     print('{:,} items downloaded to {}'.format(total, args.output))
 
 
+def _source_fields(hash_field=None):
+    fields = ['timestamp_crawl', 'team', 'url']
+    fields.append(hash_field or 'raw_content')
+    return fields
+
+
+def _hash_row(hit, client, hash_field=None):
+    x = hit['_source']
+    content_hash = x.get(hash_field) if hash_field else None
+    if content_hash is None:
+        if hash_field:
+            x = client.get(index=hit['_index'], doc_type=hit['_type'],
+                           id=hit['_id'], _source_include='raw_content')
+            x = dict(hit['_source'], **x['_source'])
+        content_hash = (hashlib.sha1((x.get('raw_content') or '')
+                        .encode('utf8')).hexdigest())
+    return [
+        x['timestamp_crawl'],
+        content_hash,
+        x['team'],
+        x['url'],
+        canonicalize_url(x['url'], keep_fragments=True),
+    ]
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,216 @@
+""" Indexing of CDR items into Elasticsearch during the crawl,
+without writing them to a file and running ``cdr-es-upload`` later.
+"""
+import logging
+
+import elasticsearch
+from itemadapter import ItemAdapter
+from scrapy.exceptions import NotConfigured
+from twisted.internet import reactor, task
+from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.internet.threads import deferToThread
+
+from .es_upload import (
+    BulkJSONSerializer, _process_bulk_chunk, _op_result, _Entry, _RetryQueue)
+from .utils import decode_raw_content, json_dumps_bytes, timestamp_now
+
+
+logger = logging.getLogger(__name__)
+
+
+class CDRElasticsearchPipeline:
+    """ An item pipeline which indexes items into Elasticsearch, collecting
+    them into bulk requests of up to ``CDR_ES_CHUNK_SIZE`` items (500)
+    or ``CDR_ES_MAX_CHUNK_BYTES`` bytes (10 MB). Bulk requests are sent
+    from a thread, at most ``CDR_ES_MAX_IN_FLIGHT`` (2) at once:
+    when a chunk is full and can't be sent yet, items wait before
+    leaving the pipeline.
+    Requests are also sent every ``CDR_ES_FLUSH_INTERVAL`` seconds (5).
+
+    Usage::
+
+        ITEM_PIPELINES = {
+            'scrapy_cdr.es_pipeline.CDRElasticsearchPipeline': 900,
+        }
+        CDR_ES_HOST = 'localhost:9200'  # several comma-separated hosts
+        CDR_ES_INDEX = 'index'
+
+    Other options are ``CDR_ES_TYPE`` ("document"), ``CDR_ES_USER``,
+    ``CDR_ES_PASSWORD``, and ``CDR_ES_MAX_RETRIES`` (5) with
+    ``CDR_ES_RETRY_BACKOFF`` (2 seconds) for documents rejected because
+    of cluster load. ``timestamp_index`` is set when a request is sent,
+    and results are counted in ``es_pipeline/*`` crawler stats.
+    """
+    def __init__(self, client, index, doc_type='document', chunk_size=500,
+                 max_chunk_bytes=10 * 2**20, max_in_flight=2,
+                 max_retries=5, retry_backoff=2, max_retry_backoff=300,
+                 flush_interval=5, stats=None):
+        self.client = client
+        self.index = index
+        self.doc_type = doc_type
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_in_flight = max_in_flight
+        self.flush_interval = flush_interval
+        self.stats = stats
+        self.n_in_flight = 0
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._waiting = []
+        self._retry_queue = _RetryQueue(
+            max_retries=max_retries, backoff=retry_backoff,
+            max_backoff=max_retry_backoff)
+        self._flush_loop = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        host = settings.get('CDR_ES_HOST')
+        index = settings.get('CDR_ES_INDEX')
+        if not host or not index:
+            raise NotConfigured('CDR_ES_HOST and CDR_ES_INDEX must be set')
+        kwargs = {}
+        user = settings.get('CDR_ES_USER')
+        password = settings.get('CDR_ES_PASSWORD')
+        if user or password:
+            kwargs['http_auth'] = (user, password)
+        client = elasticsearch.Elasticsearch(
+            host.split(','),
+            connection_class=elasticsearch.RequestsHttpConnection,
+            serializer=BulkJSONSerializer(),
+            timeout=600,
+            **kwargs)
+        return cls(
+            client, index,
+            doc_type=settings.get('CDR_ES_TYPE', 'document'),
+            chunk_size=settings.getint('CDR_ES_CHUNK_SIZE', 500),
+            max_chunk_bytes=settings.getint(
+                'CDR_ES_MAX_CHUNK_BYTES', 10 * 2**20),
+            max_in_flight=settings.getint('CDR_ES_MAX_IN_FLIGHT', 2),
+            max_retries=settings.getint('CDR_ES_MAX_RETRIES', 5),
+            retry_backoff=settings.getfloat('CDR_ES_RETRY_BACKOFF', 2),
+            flush_interval=settings.getfloat('CDR_ES_FLUSH_INTERVAL', 5),
+            stats=crawler.stats,
+        )
+
+    def open_spider(self, spider):
+        self._flush_loop = task.LoopingCall(self._flush_due)
+        self._flush_loop.start(self.flush_interval, now=False)
+
+    def process_item(self, item, spider):
+        self._add(_Entry(self._serialize(item), None, 0))
+        self._flush_full()
+        if not self._chunk_full():
+            return item
+        d = Deferred()
+        self._waiting.append(d)
+        return d.addCallback(lambda _: item)
+
+    @inlineCallbacks
+    def close_spider(self, spider):
+        if self._flush_loop is not None and self._flush_loop.running:
+            self._flush_loop.stop()
+        while self._buffer or self.n_in_flight or self._retry_queue:
+            self._flush_due()
+            yield task.deferLater(reactor, 0.1, lambda: None)
+
+    def _serialize(self, item):
+        """ Bulk action line and document source, without timestamp_index.
+        """
+        item = decode_raw_content(ItemAdapter(item).asdict())
+        item.pop('metadata', None)  # not in CDRv3 schema
+        item.pop('timestamp_index', None)
+        action = {'index': {
+            '_index': self.index,
+            '_type': self.doc_type,
+            '_id': item.pop('_id'),
+        }}
+        return b'\n'.join([json_dumps_bytes(action), json_dumps_bytes(item),
+                           b''])
+
+    def _add(self, entry):
+        self._buffer.append(entry)
+        self._buffer_bytes += len(entry.body)
+
+    def _chunk_full(self):
+        return (len(self._buffer) >= self.chunk_size or
+                self._buffer_bytes >= self.max_chunk_bytes)
+
+    def _flush_full(self):
+        while self._chunk_full() and self.n_in_flight < self.max_in_flight:
+            self._flush()
+
+    def _flush_due(self):
+        for entry in self._retry_queue.due():
+            self._add(entry)
+        self._flush_full()
+        if self.n_in_flight < self.max_in_flight:
+            self._flush()
+
+    def _flush(self):
+        """ Send a chunk from the start of the buffer.
+        """
+        if not self._buffer:
+            return
+        n_bytes = 0
+        for n, entry in enumerate(self._buffer):
+            if n and (n >= self.chunk_size or
+                      n_bytes + len(entry.body) > self.max_chunk_bytes):
+                break
+            n_bytes += len(entry.body)
+        else:
+            n = len(self._buffer)
+        chunk = self._buffer[:n]
+        del self._buffer[:n]
+        self._buffer_bytes -= n_bytes
+        self.n_in_flight += 1
+        d = deferToThread(self._send, chunk)
+        d.addCallback(self._sent, chunk)
+        d.addErrback(self._send_failed, chunk)
+        d.addBoth(self._done)
+
+    def _send(self, chunk):
+        timestamp_index = json_dumps_bytes({'timestamp_index': timestamp_now()})
+        bodies = [_with_fields(entry.body, timestamp_index)
+                  for entry in chunk]
+        return _process_bulk_chunk(
+            self.client, bodies,
+            raise_on_exception=False, raise_on_error=False)
+
+    def _sent(self, results, chunk):
+        for entry, (success, result) in zip(chunk, results):
+            op_result, ok = _op_result(success, result, 'index')
+            if not ok and self._retry_queue.retry(entry, result['index']):
+                self._inc_stats('retried')
+                continue
+            self._inc_stats(op_result)
+            if not ok:
+                self._inc_stats('failed')
+                logger.error('ES error: {}'.format(str(result)[:2000]))
+
+    def _send_failed(self, failure, chunk):
+        logger.error('Error indexing items: {}'.format(
+            failure.getErrorMessage()))
+        self._inc_stats('errors')
+        self._inc_stats('failed', len(chunk))
+
+    def _done(self, _):
+        self.n_in_flight -= 1
+        self._flush_full()
+        while self._waiting and not self._chunk_full():
+            self._waiting.pop(0).callback(None)
+
+    def _inc_stats(self, name, count=1):
+        if self.stats is not None:
+            self.stats.inc_value('es_pipeline/{}'.format(name), count)
+
+
+def _with_fields(body, fields):
+    """ Add fields (a serialized JSON object) to the document
+    in a serialized bulk action.
+    """
+    action, source = body.split(b'\n', 1)
+    rest = source[1:]  # after "{"
+    if rest.lstrip().startswith(b'}'):  # empty document
+        return b''.join([action, b'\n', fields, rest.lstrip()[1:]])
+    return b''.join([action, b'\n', fields[:-1], b',', rest])
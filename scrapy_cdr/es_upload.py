@@ -1,27 +1,36 @@
 import argparse
-from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime
-from itertools import islice
+from functools import partial
+import gzip
+import heapq
+from itertools import count, islice
+import json
 import logging
 import os
-import shutil
 import sys
-from six.moves.urllib.parse import urlsplit
+import six
+import threading
 import time
 import traceback
 
-import json_lines
 import elasticsearch
 import elasticsearch.helpers as es_helpers
+from elasticsearch.serializer import JSONSerializer
 
-from .utils import format_timestamp
+from . import jl_io
+from .media_relayout import Relayout, MODES
+from .utils import (
+    format_timestamp, timestamp_now, json_dumps_bytes,
+    imap_fixed_output_buffer)
 
 
 def main():
     parser = argparse.ArgumentParser(description='Upload items to ES index')
     arg = parser.add_argument
-    arg('inputs', nargs='+', help='inputs in .jl or .jl.gz format')
+    arg('inputs', nargs='+',
+        help='inputs in .jl, .jl.gz, .jl.zst or .jl.lz4 format')
     arg('index', help='ES index name')
     arg('--type', default='document',
         help='ES type to use ("document" by default)')
@@ -30,11 +39,18 @@ def main():
         help='ES operation type to use ("index" by default)')
     arg('--broken', action='store_true',
         help='specify if input might be broken (incomplete)')
-    arg('--host', default='localhost', help='ES host in host[:port] format')
+    arg('--host', default='localhost',
+        help='ES host in host[:port] format, or several comma-separated hosts')
     arg('--user', help='HTTP Basic Auth user')
     arg('--password', help='HTTP Basic Auth password')
     arg('--chunk-size', type=int, default=50, help='upload chunk size')
-    arg('--threads', type=int, default=4, help='number of threads')
+    arg('--threads', type=int, default=4,
+        help='number of threads (number of concurrent requests '
+             'with --engine async)')
+    arg('--engine', choices=['threads', 'async'], default='threads',
+        help='send bulk requests from a thread pool (default), or with '
+             'asyncio (needs aiohttp), which allows hundreds '
+             'of concurrent requests')
     arg('--limit', type=int, help='Index first N items')
     arg('--format', choices=['CDRv2', 'CDRv3'], default='CDRv3')
     arg('--max-chunk-bytes', type=int, default=10 * 2**20,
@@ -45,10 +61,45 @@ def main():
         help='Store objects in reverse domain folder structure. Objects '
              'will be copied in the filesystem. --media-root must be set.')
     arg('--media-root', help='path to the root of stored media objects')
+    arg('--reverse-domain-mode', choices=MODES, default='copy',
+        help='how objects are put into reverse domain folder structure: '
+             'hardlink, reflink or rename avoid copying data')
+    arg('--relayout-threads', type=int, default=8,
+        help='number of threads putting objects into reverse domain '
+             'folder structure')
+    arg('--parse-workers', type=int, default=0,
+        help='decode and prepare items in N worker processes '
+             '(by default this is done in the main thread)')
+    arg('--parse-chunk-size', type=int, default=1000,
+        help='number of input lines sent to a parse worker at once')
+    arg('--checkpoint',
+        help='file to record upload progress in: if it exists, upload '
+             'continues after the last acknowledged line of each input')
+    arg('--max-retries', type=int, default=5,
+        help='how many times to retry a document rejected because of '
+             'cluster load (429 or 5xx status) or a timeout')
+    arg('--retry-backoff', type=float, default=2,
+        help='delay in seconds before the first retry, doubled each retry')
+    arg('--max-retry-backoff', type=float, default=300,
+        help='maximum delay in seconds before a retry')
+    arg('--adaptive', action='store_true',
+        help='adjust chunk size in bytes and number of concurrent requests '
+             'to cluster load: --max-chunk-bytes and --threads become '
+             'upper limits, --chunk-size should be set high enough')
+    arg('--target-latency', type=float, default=10,
+        help='with --adaptive, chunk size is decreased if a bulk request '
+             'takes longer than this number of seconds')
+    arg('--dead-letter',
+        help='.jl or .jl.gz file to append documents which failed to upload '
+             'to (they can be uploaded from it later)')
 
     args = parser.parse_args()
     if args.reverse_domain_storage and not args.media_root:
         parser.error('--media-root must be set with --reverse-domain-objects')
+    if (args.reverse_domain_storage and args.parse_workers and
+            args.reverse_domain_mode == 'rename'):
+        parser.error('--reverse-domain-mode rename is not supported '
+                     'with --parse-workers')
 
     logging.basicConfig(
         level=getattr(logging, args.log_level),
@@ -60,122 +111,408 @@ def main():
     if args.user or args.password:
         kwargs['http_auth'] = (args.user, args.password)
 
+    hosts = args.host.split(',')
     client = elasticsearch.Elasticsearch(
-        [args.host],
+        hosts,
         connection_class=elasticsearch.RequestsHttpConnection,
+        serializer=BulkJSONSerializer(),
         timeout=600,
         **kwargs)
     logging.info(client.info())
+    if args.engine == 'async':
+        from . import es_async
+        bulk_client = es_async.AsyncBulkClient(
+            hosts, concurrency=args.threads, timeout=600, **kwargs)
+        bulk = partial(es_async.async_parallel_bulk, bulk_client,
+                       concurrency=args.threads)
+    else:
+        bulk_client = None
+        bulk = partial(parallel_bulk, client, thread_count=args.threads)
 
     def _items():
         for filename in args.inputs:
             logging.info('Starting {}'.format(filename))
-            with json_lines.open(filename, broken=args.broken) as f:
-                for item in f:
-                    yield item
-
-    is_cdrv3 = args.format == 'CDRv3'
+            for item in jl_io.iter_items(filename, broken=args.broken):
+                yield item
 
     def _actions():
         items = _items()
         if args.limit:
             items = islice(items, args.limit)
         for item in items:
+            yield _prepare_action(item, args)
 
-            if is_cdrv3:
-                assert 'timestamp_crawl' in item, \
-                       'this is not CDRv3, check --format'
-            else:
-                assert 'timestamp' in item, 'this is not CDRv2, check --format'
-
-            if is_cdrv3:
-                item['timestamp_index'] = format_timestamp(datetime.utcnow())
-            elif isinstance(item['timestamp'], int):
-                item['timestamp'] = format_timestamp(
-                    datetime.fromtimestamp(item['timestamp'] / 1000.))
-
-            if args.reverse_domain_storage:
-                _reverse_domain_storage(item, args.media_root)
-
-            action = {
-                '_op_type': args.op_type,
-                '_index': args.index,
-                '_type': args.type,
-                '_id': item.pop('_id'),
-            }
-            if is_cdrv3:
-                item.pop('metadata', None)  # not in CDRv3 schema
-            else:
-                item.pop('extracted_metadata', None)
-            if args.op_type != 'delete':
-                action['_source'] = item
-            yield action
+    checkpoint = _Checkpoint(args.checkpoint) if args.checkpoint else None
+    read_lines = bool(args.parse_workers or checkpoint)
+    relayout_counts = [0, 0, 0]  # from _parse_lines
+
+    def _parsed_entries():
+        lines = _iter_lines(args.inputs, broken=args.broken,
+                            checkpoint=checkpoint)
+        if args.limit:
+            lines = islice(lines, args.limit)
+        parse = partial(_parse_lines, args=args)
+        chunks = _chunks(lines, args.parse_chunk_size)
+        if args.parse_workers:
+            results = imap_fixed_output_buffer(
+                parse, chunks,
+                threads=args.parse_workers,
+                executor_cls=ProcessPoolExecutor)
+        else:
+            results = map(parse, chunks)
+        for actions, counts in results:
+            if counts is not None:
+                relayout_counts[:] = map(sum, zip(relayout_counts, counts))
+            for body, position in actions:
+                if checkpoint:
+                    checkpoint.sent(position)
+                yield _Entry(body, position, 0)
+
+    def _entries():
+        for action in _actions():
+            yield _Entry(serialize_action(action), None, 0)
+
+    retry_queue = _RetryQueue(
+        max_retries=args.max_retries,
+        backoff=args.retry_backoff,
+        max_backoff=args.max_retry_backoff)
 
     # This wrapper is needed due to use of raise_on_error=False
     # below (which we need because ES can raise exceptions on timeouts, etc.),
     # but we don't want to ignore errors when reading data.
     failed = [False]  # to set correct exit code
 
-    def actions():
+    def entries():
         try:
-            for x in _actions():
+            for x in (_parsed_entries() if read_lines else _entries()):
+                # documents to retry go to the next chunks
+                for retry_entry in retry_queue.due():
+                    yield retry_entry
                 yield x
         except Exception:
             traceback.print_exc()
             failed[0] = True
             raise  # will be caught anyway
 
+    dead_letter = _DeadLetter(args.dead_letter) if args.dead_letter else None
+    controller = None
+    if args.adaptive:
+        controller = AdaptiveController(
+            max_chunk_bytes=args.max_chunk_bytes,
+            max_in_flight=args.threads,
+            target_latency=args.target_latency)
+
+    def save_progress():
+        if dead_letter:
+            dead_letter.flush()
+        if checkpoint:
+            checkpoint.save()
+
     t0 = t00 = time.time()
     i = last_i = 0
     result_counts = defaultdict(int)
     try:
-        for i, (success, result) in enumerate(
-                parallel_bulk(
-                    client,
-                    actions=actions(),
-                    thread_count=args.threads,
+        pending = entries()
+        while pending is not None:
+            for entry, success, result in bulk(
+                    actions=pending,
                     chunk_size=args.chunk_size,
                     raise_on_error=False,
                     raise_on_exception=False,
                     max_chunk_bytes=args.max_chunk_bytes,
-                ), start=1):
-            op_result = result[args.op_type].get('result')
-            if op_result is None:
-                # ES 2.x
-                op_result = ('status_{}'
-                             .format(result[args.op_type].get('status')))
-            result_counts[op_result] += 1
-            if not (success or (args.op_type == 'delete' and
-                                op_result in {'not_found', 'status_404'})):
-                logging.info('ES error: {}'.format(str(result)[:2000]))
-                failed[0] = True
-            t1 = time.time()
-            if t1 - t0 > 10:
-                _report_stats(i, last_i, t1 - t0, result_counts)
-                t0 = t1
-                last_i = i
+                    serialize_action_callback=_entry_body,
+                    yield_actions=True,
+                    controller=controller,
+                    ):
+                op_result, ok = _op_result(success, result, args.op_type)
+                if not ok and retry_queue.retry(entry, result[args.op_type]):
+                    result_counts['retried'] += 1
+                    continue
+                i += 1
+                result_counts[op_result] += 1
+                if not ok:
+                    logging.info('ES error: {}'.format(str(result)[:2000]))
+                    failed[0] = True
+                    if dead_letter:
+                        dead_letter.write(entry.body)
+                        result_counts['dead_letter'] += 1
+                if checkpoint:
+                    checkpoint.acknowledged(
+                        entry.position, ok or dead_letter is not None)
+                t1 = time.time()
+                if t1 - t0 > 10:
+                    _report_stats(i, last_i, t1 - t0, result_counts)
+                    if controller:
+                        logging.info(controller)
+                    save_progress()
+                    t0 = t1
+                    last_i = i
+            # all input is read, send remaining retries
+            pending = retry_queue.drain() if retry_queue else None
     finally:
         _report_stats(i, 0, time.time() - t00, result_counts)
+        save_progress()
+        if dead_letter:
+            dead_letter.close()
+        if bulk_client:
+            bulk_client.close()
+        if args.reverse_domain_storage:
+            relayout = _get_relayout(args)
+            relayout.close()
+            relayout.add_counts(relayout_counts)
+            logging.info(relayout)
+            if relayout.n_failed:
+                failed[0] = True
 
     if failed[0]:
         sys.exit(1)
 
 
-def _reverse_domain_storage(item, media_root):
-    for obj in item.get('objects', []):
-        stored_url = obj['obj_stored_url']
-        assert '/' not in stored_url
-        domain = urlsplit(obj['obj_original_url']).netloc
-        if ':' in domain:
-            domain, _ = domain.split(':', 1)
-        parents = [p for p in reversed(domain.split('.')) if p]
-        os.makedirs(os.path.join(media_root, *parents), exist_ok=True)
-        stored_url_noext, _ = os.path.splitext(stored_url)
-        new_stored_url = os.path.sep.join(parents + [stored_url_noext])
-        dest = os.path.join(media_root, new_stored_url)
-        if not os.path.exists(dest):
-            shutil.copy(os.path.join(media_root, stored_url), dest)
-        obj['obj_stored_url'] = new_stored_url
+def _op_result(success, result, op_type):
+    """ Return operation result name and whether it was successful,
+    for a bulk result item.
+    """
+    op_result = result[op_type].get('result')
+    if op_result is None:
+        # ES 2.x
+        op_result = 'status_{}'.format(result[op_type].get('status'))
+    ok = success or (op_type == 'delete' and
+                     op_result in {'not_found', 'status_404'})
+    return op_result, ok
+
+
+def _prepare_action(item, args):
+    is_cdrv3 = args.format == 'CDRv3'
+    if is_cdrv3:
+        assert 'timestamp_crawl' in item, 'this is not CDRv3, check --format'
+    else:
+        assert 'timestamp' in item, 'this is not CDRv2, check --format'
+
+    if is_cdrv3:
+        item['timestamp_index'] = timestamp_now()
+    elif isinstance(item['timestamp'], int):
+        item['timestamp'] = format_timestamp(
+            datetime.fromtimestamp(item['timestamp'] / 1000.))
+
+    if args.reverse_domain_storage:
+        _get_relayout(args).relayout_item(item)
+
+    action = {
+        '_op_type': args.op_type,
+        '_index': args.index,
+        '_type': args.type,
+        '_id': item.pop('_id'),
+    }
+    if is_cdrv3:
+        item.pop('metadata', None)  # not in CDRv3 schema
+    else:
+        item.pop('extracted_metadata', None)
+    if args.op_type != 'delete':
+        action['_source'] = item
+    return action
+
+
+def _iter_lines(filenames, broken=False, checkpoint=None):
+    """ Read raw lines from .jl files, without decoding them,
+    yielding ``(line, position)`` tuples.
+    Reading starts from the checkpoint position if it is given.
+    If input is broken, stop reading the file at the first read error.
+    """
+    for filename in filenames:
+        start = checkpoint.start(filename) if checkpoint else None
+        if start is not None:
+            if start.eof:
+                logging.info('Skipping {}: already uploaded'.format(filename))
+                continue
+            logging.info('Starting {} after line {:,}'
+                         .format(filename, start.line))
+        else:
+            logging.info('Starting {}'.format(filename))
+        for line, position in jl_io.iter_lines(
+                filename, start=start, broken=broken):
+            yield line, position
+
+
+class _Checkpoint:
+    """ Upload progress: for each input file, the position after
+    the last line which was acknowledged by ES, with all lines before it
+    also acknowledged. If a document fails, progress in its file
+    is not recorded any more.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.positions = {}
+        if os.path.exists(path):
+            with open(path, 'rt') as f:
+                self.positions = {
+                    filename: jl_io.Position(**position)
+                    for filename, position in json.load(f).items()}
+        # positions in the order they were sent, mapped to None if they
+        # are not acknowledged yet, or to acknowledgement success
+        self._pending = OrderedDict()
+        self._failed = set()
+
+    def start(self, filename):
+        return self.positions.get(os.path.abspath(filename))
+
+    def sent(self, position):
+        self._pending[position] = None
+
+    def acknowledged(self, position, ok):
+        self._pending[position] = ok
+        while self._pending:
+            position, ok = next(iter(self._pending.items()))
+            if ok is None:
+                break
+            del self._pending[position]
+            filename = os.path.abspath(position.path)
+            if not ok:
+                self._failed.add(filename)
+            elif filename not in self._failed:
+                self.positions[filename] = position
+
+    def save(self):
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'wt') as f:
+            json.dump({filename: dict(position._asdict())
+                       for filename, position in self.positions.items()},
+                      f, indent=True, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+# A serialized action with position of the input line it was read from
+# (if known) and the number of upload attempts made before.
+_Entry = namedtuple('_Entry', ['body', 'position', 'attempt'])
+
+
+def _entry_body(entry):
+    return entry.body
+
+
+class _RetryQueue:
+    """ Documents to upload again after an exponential backoff,
+    in order of their retry time.
+    """
+    # 429 is es_rejected_execution_exception,
+    # N/A is for connection errors and TIMEOUT for timeouts
+    retry_statuses = {429, 502, 503, 504, 'N/A', 'TIMEOUT'}
+
+    def __init__(self, max_retries, backoff, max_backoff):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._queue = []
+        self._counter = count()  # keeps order for the same retry time
+
+    def __len__(self):
+        return len(self._queue)
+
+    def retry(self, entry, info):
+        """ Schedule a retry if the document failed with a temporary error
+        and retry budget is not exhausted, return True if it's scheduled.
+        """
+        if (entry.attempt >= self.max_retries or
+                info.get('status') not in self.retry_statuses):
+            return False
+        delay = min(self.max_backoff, self.backoff * 2 ** entry.attempt)
+        heapq.heappush(self._queue, (
+            time.time() + delay, next(self._counter),
+            entry._replace(attempt=entry.attempt + 1)))
+        return True
+
+    def due(self):
+        """ Documents which can be retried now.
+        """
+        while self._queue and self._queue[0][0] <= time.time():
+            yield heapq.heappop(self._queue)[-1]
+
+    def drain(self):
+        """ All documents to retry, waiting until their retry time.
+        """
+        while self._queue:
+            retry_at, _, entry = heapq.heappop(self._queue)
+            time.sleep(max(0, retry_at - time.time()))
+            yield entry
+
+
+class _DeadLetter:
+    """ A .jl or .jl.gz file with documents which failed to upload,
+    in the same format as the input.
+    """
+    def __init__(self, path):
+        opener = gzip.open if path.endswith('.gz') else open
+        self._file = opener(path, 'ab')
+
+    def write(self, body):
+        lines = body.split(b'\n')
+        (_, meta), = json.loads(lines[0].decode('utf8')).items()
+        doc = json.loads(lines[1].decode('utf8')) if lines[1] else {}
+        doc['_id'] = meta.get('_id')
+        self._file.write(json_dumps_bytes(doc) + b'\n')
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def _chunks(it, size):
+    it = iter(it)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _parse_lines(lines, args):
+    """ Decode a chunk of ``(line, position)`` tuples and turn them into
+    ``(action, position)`` tuples with serialized bulk actions,
+    ready to be sent to ES. Return them with relayout counts for the chunk
+    (see ``Relayout.pop_counts``), or None without --reverse-domain-storage.
+    This runs in a worker process if --parse-workers is set.
+    """
+    actions = []
+    for line, position in lines:
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line.decode('utf8'))
+        except ValueError:
+            if not args.broken:
+                raise
+            logging.warning('Skipping broken line: {!r}'.format(line[:200]))
+            continue
+        actions.append(
+            (serialize_action(_prepare_action(item, args)), position))
+    counts = None
+    if args.reverse_domain_storage:
+        # worker process can exit before objects are processed otherwise
+        relayout = _get_relayout(args)
+        relayout.wait()
+        counts = relayout.pop_counts()
+    return actions, counts
+
+
+def _identity(x):
+    return x
+
+
+_relayout = None  # Relayout in this process
+
+
+def _get_relayout(args):
+    """ Relayout for --reverse-domain-storage, created on first use,
+    so that each parse worker process has its own.
+    """
+    global _relayout
+    if (_relayout is None or _relayout.closed or
+            _relayout.media_root != args.media_root or
+            _relayout.mode != args.reverse_domain_mode):
+        _relayout = Relayout(args.media_root, mode=args.reverse_domain_mode,
+                             threads=args.relayout_threads)
+    return _relayout
 
 
 def _report_stats(items, prev_items, dt, result_counts):
@@ -192,32 +529,235 @@ def _report_stats(items, prev_items, dt, result_counts):
 
 def parallel_bulk(client, actions, thread_count=4, chunk_size=500,
                   max_chunk_bytes=100 * 1024 * 1024,
-                  expand_action_callback=es_helpers.expand_action,
+                  serialize_action_callback=None,
+                  yield_actions=False,
+                  controller=None,
                   **kwargs):
     """ es_helpers.parallel_bulk rewritten with imap_fixed_output_buffer
     instead of Pool.imap, which consumed unbounded memory if the generator
     outruns the upload (which usually happens).
+
+    Each action is serialized to bytes only once (see ``serialize_action``),
+    chunks are limited by their size in bytes and sent as a raw bulk body.
+    Pass ``serialize_action_callback=_identity`` if actions
+    are already serialized.
+
+    Results are ``(ok, result)`` tuples in the same order as actions,
+    or ``(action, ok, result)`` if ``yield_actions`` is True.
+
+    If an ``AdaptiveController`` is passed, it sets the chunk size in bytes
+    and the number of requests in flight instead of ``max_chunk_bytes``
+    and ``thread_count``.
     """
-    actions = map(expand_action_callback, actions)
-    for result in imap_fixed_output_buffer(
-            lambda chunk: list(
-                es_helpers._process_bulk_chunk(client, chunk, **kwargs)),
-            es_helpers._chunk_actions(actions, chunk_size, max_chunk_bytes,
-                                      client.transport.serializer),
-            threads=thread_count,
+    def process_chunk(chunk):
+        bodies = [body for _, body in chunk]
+        t0 = time.time()
+        results = _process_bulk_chunk(client, bodies, **kwargs)
+        _record_chunk(controller, bodies, results, t0)
+        return chunk, results
+
+    return _parallel_bulk(
+        process_chunk, actions,
+        executor_cls=ThreadPoolExecutor,
+        concurrency=thread_count,
+        chunk_size=chunk_size,
+        max_chunk_bytes=max_chunk_bytes,
+        serialize_action_callback=serialize_action_callback,
+        yield_actions=yield_actions,
+        controller=controller)
+
+
+def _parallel_bulk(process_chunk, actions, executor_cls, concurrency,
+                   chunk_size, max_chunk_bytes, serialize_action_callback,
+                   yield_actions, controller):
+    """ Common part of parallel_bulk and es_async.async_parallel_bulk:
+    ``process_chunk`` gets a chunk of (action, serialized action) pairs,
+    it is run with ``executor_cls`` and returns the chunk with results.
+    """
+    serialize_action_callback = serialize_action_callback or serialize_action
+    pairs = ((action, serialize_action_callback(action)) for action in actions)
+    max_in_flight = None
+    if controller is not None:
+        max_chunk_bytes = lambda: controller.max_chunk_bytes
+        # one more chunk is prepared while others are sent
+        max_in_flight = lambda: controller.max_in_flight + 1
+
+    for chunk, results in imap_fixed_output_buffer(
+            process_chunk,
+            _chunk_actions(pairs, chunk_size, max_chunk_bytes),
+            threads=concurrency,
+            executor_cls=executor_cls,
+            max_in_flight=max_in_flight,
         ):
-        for item in result:
-            yield item
-
-
-def imap_fixed_output_buffer(fn, it, threads: int):
-    with ThreadPoolExecutor(max_workers=threads) as executor:
-        futures = []
-        max_futures = threads + 1
-        for i, x in enumerate(it):
-            while len(futures) >= max_futures:
-                future, futures = futures[0], futures[1:]
-                yield future.result()
-            futures.append(executor.submit(fn, x))
-        for future in futures:
-            yield future.result()
+        for (action, _), (ok, result) in zip(chunk, results):
+            if yield_actions:
+                yield action, ok, result
+            else:
+                yield ok, result
+
+
+def _record_chunk(controller, bodies, results, t0):
+    if controller is not None:
+        controller.record(
+            latency=time.time() - t0,
+            n_bytes=sum(map(len, bodies)),
+            n_rejected=sum(
+                _is_rejected(result) for ok, result in results if not ok))
+
+
+def serialize_action(action, expand_action_callback=es_helpers.expand_action):
+    """ Expand action and serialize it into bulk request lines (bytes).
+    """
+    action, data = expand_action_callback(action)
+    lines = [_to_json_bytes(action)]
+    if data is not None:
+        lines.append(_to_json_bytes(data))
+    lines.append(b'')
+    return b'\n'.join(lines)
+
+
+def _to_json_bytes(data):
+    if isinstance(data, six.text_type):  # already serialized
+        return data.encode('utf8')
+    return json_dumps_bytes(data)
+
+
+def _chunk_actions(pairs, chunk_size, max_chunk_bytes):
+    """ Split (action, serialized action) pairs into chunks by number
+    or size in bytes. ``max_chunk_bytes`` can be a function returning
+    current maximum size.
+    """
+    if not callable(max_chunk_bytes):
+        fixed_max_chunk_bytes = max_chunk_bytes
+        max_chunk_bytes = lambda: fixed_max_chunk_bytes
+    chunk = []
+    size = 0
+    for action, body in pairs:
+        if chunk and (size + len(body) > max_chunk_bytes() or
+                      len(chunk) == chunk_size):
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append((action, body))
+        size += len(body)
+    if chunk:
+        yield chunk
+
+
+def _process_bulk_chunk(client, bodies, raise_on_exception=True,
+                        raise_on_error=True, **kwargs):
+    """ Send serialized actions to ES, return a list of (ok, result) tuples
+    in the same format as es_helpers._process_bulk_chunk.
+    """
+    body = b''.join(bodies)
+    if not isinstance(client.transport.serializer, BulkJSONSerializer):
+        body = body.decode('utf8')
+    try:
+        resp = client.transport.perform_request(
+            'POST', '/_bulk', params=kwargs, body=body)
+    except elasticsearch.TransportError as e:
+        if raise_on_exception:
+            raise
+        results = _bulk_error_results(bodies, e)
+    else:
+        results = _bulk_results(resp)
+    if raise_on_error:
+        _raise_on_error(results)
+    return results
+
+
+def _bulk_results(resp):
+    results = []
+    for item in resp['items']:
+        (op_type, info), = item.items()
+        ok = 200 <= info.get('status', 500) < 300
+        results.append((ok, {op_type: info}))
+    return results
+
+
+def _bulk_error_results(bodies, error):
+    """ Mark all actions as failed with a TransportError.
+    """
+    results = []
+    for action_body in bodies:
+        action = json.loads(action_body.split(b'\n', 1)[0].decode('utf8'))
+        (op_type, info), = action.items()
+        info = dict(info, error=str(error), status=error.status_code,
+                    exception=error)
+        results.append((False, {op_type: info}))
+    return results
+
+
+def _raise_on_error(results):
+    errors = [result for ok, result in results if not ok]
+    if errors:
+        raise es_helpers.BulkIndexError(
+            '{} document(s) failed to index.'.format(len(errors)), errors)
+
+
+def _is_rejected(result):
+    """ Is the failure caused by cluster load?
+    """
+    (_, info), = result.items()
+    return info.get('status') in _RetryQueue.retry_statuses
+
+
+class AdaptiveController:
+    """ Adjusts chunk size in bytes and number of concurrent bulk requests
+    with AIMD (additive increase, multiplicative decrease): both are
+    increased slowly while requests succeed fast enough, chunk size is halved
+    if a request takes longer than ``target_latency``, and both are halved
+    if documents are rejected because of cluster load. After a decrease,
+    further decreases are ignored for requests sent before it.
+    """
+    def __init__(self, max_chunk_bytes, max_in_flight, target_latency,
+                 min_chunk_bytes=2**16, increase_bytes=2**18):
+        self.max_chunk_bytes_limit = max_chunk_bytes
+        self.min_chunk_bytes = min(min_chunk_bytes, max_chunk_bytes)
+        self.max_in_flight_limit = max_in_flight
+        self.target_latency = target_latency
+        self.increase_bytes = increase_bytes
+        self.max_chunk_bytes = min(2**20, max_chunk_bytes)
+        self.max_in_flight = 1
+        self._n_ok = 0
+        self._decreased_at = 0
+        self._lock = threading.Lock()
+
+    def record(self, latency, n_bytes, n_rejected):
+        """ Record results of a bulk request which took ``latency`` seconds.
+        """
+        sent_at = time.time() - latency
+        with self._lock:
+            if n_rejected or latency > self.target_latency:
+                if sent_at < self._decreased_at:
+                    return  # already reacted to this overload
+                self._decreased_at = time.time()
+                self._n_ok = 0
+                self.max_chunk_bytes = max(
+                    self.min_chunk_bytes, self.max_chunk_bytes // 2)
+                if n_rejected:
+                    self.max_in_flight = max(1, self.max_in_flight // 2)
+            elif n_bytes >= self.max_chunk_bytes // 2:
+                # only full enough chunks tell if we can send more
+                self._n_ok += 1
+                self.max_chunk_bytes = min(
+                    self.max_chunk_bytes_limit,
+                    self.max_chunk_bytes + self.increase_bytes)
+                if self._n_ok >= self.max_in_flight:
+                    self._n_ok = 0
+                    self.max_in_flight = min(
+                        self.max_in_flight_limit, self.max_in_flight + 1)
+
+    def __str__(self):
+        return 'adaptive: {} requests in flight, {:.1f} MB chunks'.format(
+            self.max_in_flight, self.max_chunk_bytes / 2**20)
+
+
+class BulkJSONSerializer(JSONSerializer):
+    """ JSONSerializer which passes already serialized bytes as-is,
+    so that bulk bodies are not decoded and encoded again.
+    """
+    def dumps(self, data):
+        if isinstance(data, bytes):
+            return data
+        return super(BulkJSONSerializer, self).dumps(data)
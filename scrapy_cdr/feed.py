@@ -0,0 +1,229 @@
+""" Fast export of CDR items from a crawl into .jl, .jl.gz, .jl.zst
+or .jl.lz4 files, optionally split into parts which can be uploaded
+in parallel by ``cdr-es-upload`` and ``cdr-kafka-upload``.
+"""
+from collections import deque
+import logging
+import queue
+import threading
+
+from itemadapter import ItemAdapter
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.exporters import BaseItemExporter
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.threads import deferToThread
+
+from . import jl_io
+from .utils import decode_raw_content, json_dumps_bytes
+
+
+logger = logging.getLogger(__name__)
+
+
+def serialize_item(item):
+    """ Serialize a CDR item (including items with ``raw_content`` as bytes)
+    into a JSON line (bytes).
+    """
+    item = decode_raw_content(ItemAdapter(item).asdict())
+    return json_dumps_bytes(item) + b'\n'
+
+
+class JsonLinesItemExporter(BaseItemExporter):
+    """ A drop-in replacement for scrapy JsonLinesItemExporter which uses
+    the fastest available JSON encoder, for use in ``FEED_EXPORTERS``::
+
+        FEED_EXPORTERS = {'cdr': 'scrapy_cdr.feed.JsonLinesItemExporter'}
+
+    Fields are not serialized individually, and export options
+    except ``fields_to_export`` are ignored.
+    """
+    def __init__(self, file, **kwargs):
+        super(JsonLinesItemExporter, self).__init__(dont_fail=True, **kwargs)
+        self.file = file
+
+    def export_item(self, item):
+        if self.fields_to_export:
+            item = {k: v for k, v in ItemAdapter(item).items()
+                    if k in self.fields_to_export}
+        self.file.write(serialize_item(item))
+
+
+class CDRFeedExporter:
+    """ An extension which writes scraped items into ``CDR_FEED_PATH``
+    (compressed according to extension) from a background thread,
+    so that the crawl is not blocked by compression or disk writes.
+    Add it to ``EXTENSIONS``::
+
+        EXTENSIONS = {'scrapy_cdr.feed.CDRFeedExporter': 500}
+
+    Options:
+
+    - ``CDR_FEED_MAX_ITEMS`` and ``CDR_FEED_MAX_BYTES``: start a new part
+      after this many items or uncompressed bytes, parts are named
+      like "items.part0.jl.gz", "items.part1.jl.gz" for "items.jl.gz".
+    - ``CDR_FEED_COMPRESSION_LEVEL``, ``CDR_FEED_COMPRESSION_THREADS``
+      (1 by default).
+    - ``CDR_FEED_QUEUE_SIZE``: maximum number of serialized items waiting
+      to be written (1000 by default), the crawl waits when it's reached.
+
+    Written items and items dropped after a write error are counted
+    in ``cdr_feed/*`` crawler stats.
+    """
+    def __init__(self, path, max_items=0, max_bytes=0, level=None,
+                 threads=1, queue_size=1000, stats=None):
+        self.writer = _RotatingWriter(
+            path, max_items=max_items, max_bytes=max_bytes,
+            level=level, threads=threads)
+        self.stats = stats
+        self.n_dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._pending = deque()
+        self._thread = None
+        self._error = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        path = settings.get('CDR_FEED_PATH')
+        if not path:
+            raise NotConfigured
+        level = settings.get('CDR_FEED_COMPRESSION_LEVEL')
+        ext = cls(
+            path,
+            max_items=settings.getint('CDR_FEED_MAX_ITEMS', 0),
+            max_bytes=settings.getint('CDR_FEED_MAX_BYTES', 0),
+            level=None if level is None else int(level),
+            threads=settings.getint('CDR_FEED_COMPRESSION_THREADS', 1),
+            queue_size=settings.getint('CDR_FEED_QUEUE_SIZE', 1000),
+            stats=crawler.stats,
+        )
+        crawler.signals.connect(ext.spider_opened, signals.spider_opened)
+        crawler.signals.connect(ext.item_scraped, signals.item_scraped)
+        crawler.signals.connect(ext.spider_closed, signals.spider_closed)
+        return ext
+
+    def spider_opened(self, spider):
+        self._thread = threading.Thread(
+            target=self._write_lines, name='cdr-feed-writer', daemon=True)
+        self._thread.start()
+
+    def item_scraped(self, item, spider):
+        return self._put(serialize_item(item))
+
+    def spider_closed(self, spider):
+        d = self._put(None) or succeed(None)
+        d.addCallback(lambda _: deferToThread(self._close))
+        return d.addBoth(self._closed)
+
+    def _put(self, line):
+        """ Queue a line without blocking the reactor: if the queue is full,
+        return a Deferred which fires when the line is queued.
+        """
+        if not self._pending:
+            try:
+                self._queue.put_nowait(line)
+            except queue.Full:
+                pass
+            else:
+                return None
+        d = Deferred()
+        self._pending.append((line, d))
+        # the writer might have taken lines before this one was added,
+        # and didn't schedule _put_pending then
+        self._put_pending()
+        return d
+
+    def _put_pending(self):
+        while self._pending:
+            line, d = self._pending[0]
+            try:
+                self._queue.put_nowait(line)
+            except queue.Full:
+                break
+            self._pending.popleft()
+            d.callback(None)
+
+    def _write_lines(self):
+        while True:
+            line = self._queue.get()
+            if self._pending:
+                reactor.callFromThread(self._put_pending)
+            if line is None:
+                break
+            if self._error is not None:
+                # keep consuming so that the crawl is not blocked
+                self.n_dropped += 1
+                continue
+            try:
+                self.writer.write(line)
+            except Exception as e:
+                logger.exception('Error writing items to {}'.format(
+                    self.writer.current_path))
+                self._error = e
+                self.n_dropped += 1
+
+    def _close(self):
+        self._thread.join()
+        self.writer.close()
+        logger.info('{:,} items written to {}'.format(
+            self.writer.n_items, ', '.join(self.writer.paths)))
+        if self._error is not None:
+            logger.error('{:,} items were not written to {} because of '
+                         'an error: {!r}'.format(
+                             self.n_dropped, self.writer.current_path,
+                             self._error))
+
+    def _closed(self, result):
+        if self.stats is not None:
+            self.stats.set_value('cdr_feed/written', self.writer.n_items)
+            self.stats.set_value('cdr_feed/dropped', self.n_dropped)
+        return result
+
+
+class _RotatingWriter:
+    """ Writes lines with JLWriter, starting a new part file
+    after max_items lines or max_bytes uncompressed bytes if they are set.
+    """
+    def __init__(self, path, max_items=0, max_bytes=0, level=None, threads=1):
+        self.path = path
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.level = level
+        self.threads = threads
+        self.paths = []
+        self.n_items = 0
+        self._writer = None
+        self._part_items = self._part_bytes = 0
+
+    @property
+    def current_path(self):
+        return self.paths[-1] if self.paths else self.path
+
+    def write(self, line):
+        if self._writer is None or (
+                (self.max_items and self._part_items >= self.max_items) or
+                (self.max_bytes and self._part_bytes >= self.max_bytes)):
+            self._start_part()
+        self._writer.write(line)
+        self._part_items += 1
+        self._part_bytes += len(line)
+        self.n_items += 1
+
+    def _start_part(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self.max_items or self.max_bytes:
+            path = jl_io.part_path(self.path, 'part{}'.format(len(self.paths)))
+        else:
+            path = self.path
+        self.paths.append(path)
+        self._writer = jl_io.JLWriter(
+            path, level=self.level, threads=self.threads)
+        self._part_items = self._part_bytes = 0
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
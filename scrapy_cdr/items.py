@@ -43,6 +43,14 @@ class CDRItem(scrapy.Item):
     # This field is not in CDR v3 schema, and will be stripped in cdr-es-upload
     metadata = scrapy.Field()
 
+    # Not in CDR v3 schema: SHA-1 hex digest of raw_content encoded as UTF-8,
+    # set by text_cdr_item(content_hash=True) (see es_download_hashes)
+    raw_content_hash = scrapy.Field()
+
+    # Not in CDR v3 schema: encoding of raw_content when it is bytes,
+    # set by text_cdr_item(raw_bytes=True) and removed by decode_raw_content
+    raw_content_encoding = scrapy.Field()
+
     def __repr__(self):
         fields = ['_id', 'url', 'timestamp_crawl']
         return '<CDRItem: {attrs}{objects}>'.format(
@@ -0,0 +1,323 @@
+""" Reading and writing of .jl files, uncompressed or compressed with gzip
+(.jl.gz), zstd (.jl.zst) or lz4 (.jl.lz4). zstd and lz4 need zstandard and
+lz4 packages to be installed.
+"""
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+from .utils import json_dumps_bytes
+
+
+# Position in a .jl or .jl.gz file right after a line:
+# - path: file path,
+# - line: number of lines read so far,
+# - member: offset in the file of the gzip member the line ends in
+#   (always 0 for uncompressed files),
+# - offset: offset in the uncompressed member data after the line,
+# - eof: if this was the last line of the file.
+Position = namedtuple('Position', ['path', 'line', 'member', 'offset', 'eof'])
+
+
+READ_SIZE = 2**20
+BLOCK_SIZE = 4 * 2**20
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+EXTENSIONS = ('.gz', '.zst', '.lz4')
+
+_read_errors = (EOFError, IOError, zlib.error)
+if zstandard is not None:
+    _read_errors += (zstandard.ZstdError,)
+if lz4_frame is not None:
+    _read_errors += (RuntimeError,)  # lz4 errors are RuntimeError
+
+
+def iter_lines(path, start=None, broken=False):
+    """ Iterate over raw lines (bytes) of a .jl file in any supported format,
+    yielding ``(line, position)`` tuples, where position is a ``Position``
+    right after the line.
+
+    Pass a ``Position`` (or a dict with the same fields) as ``start``
+    to continue reading after it: uncompressed files are read starting
+    from the position directly, and for gzip files only the gzip member
+    containing the position is decompressed before it, which is fast for
+    multi-member gzip files (e.g. created by ``JLWriter``, bgzip or
+    by concatenation). zstd and lz4 files are decompressed from the start.
+
+    If the file is ``broken``, reading stops at the first error.
+    """
+    if start is not None and not isinstance(start, Position):
+        start = Position(**start)
+    if start is not None and start.eof:
+        return
+    if path.endswith('.gz'):
+        lines = _iter_gzip_lines
+    elif path.endswith('.zst') or path.endswith('.lz4'):
+        lines = _iter_stream_lines
+    else:
+        lines = _iter_plain_lines
+    prev = None  # one line lookahead to set eof flag of the last position
+    with open(path, 'rb') as f:
+        try:
+            for item in lines(f, path, start):
+                if prev is not None:
+                    yield prev
+                prev = item
+        except _read_errors:
+            if not broken:
+                raise
+            logging.warning('Error reading {}, skipping the rest'
+                            .format(path), exc_info=True)
+    if prev is not None:
+        line, position = prev
+        yield line, position._replace(eof=True)
+
+
+def iter_items(path, broken=False):
+    """ Iterate over decoded items of a .jl file in any supported format.
+    If the file is ``broken``, reading stops at the first error,
+    and lines which can not be decoded are skipped.
+    """
+    for line, _ in iter_lines(path, broken=broken):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line.decode('utf8'))
+        except ValueError:
+            if not broken:
+                raise
+            logging.warning('Skipping a broken line in {}'.format(path))
+
+
+def part_path(path, part):
+    """ Path of a part of a .jl file: part_path('out.jl.gz', 'part0')
+    is 'out.part0.jl.gz'.
+    """
+    name, ext = os.path.splitext(path)
+    if ext in EXTENSIONS:
+        name, jl_ext = os.path.splitext(name)
+        ext = jl_ext + ext
+    return '{}.{}{}'.format(name, part, ext)
+
+
+def _iter_plain_lines(f, path, start):
+    line_no, offset = 0, 0
+    if start is not None:
+        line_no, offset = start.line, start.offset
+        f.seek(offset)
+    for line in f:
+        line_no += 1
+        offset += len(line)
+        yield line, Position(path, line_no, 0, offset, False)
+
+
+def _iter_gzip_lines(f, path, start):
+    line_no, member, skip = 0, 0, 0
+    if start is not None:
+        line_no, member, skip = start.line, start.member, start.offset
+        f.seek(member)
+    raw_offset = member  # file offset of data
+    member_offset = 0  # uncompressed offset in current member
+    decompressor = zlib.decompressobj(_GZIP_WBITS)
+    in_member = False
+    pending = b''  # start of the current line
+    data = b''  # compressed input not consumed yet
+    while True:
+        if not data:
+            data = f.read(READ_SIZE)
+        if data and not in_member:
+            stripped = data.lstrip(b'\x00')  # trailing padding is allowed
+            raw_offset += len(data) - len(stripped)
+            data = stripped
+            if not data:
+                continue
+            member, member_offset = raw_offset, 0
+            in_member = True
+        if data:
+            out = decompressor.decompress(data, READ_SIZE)
+            # at the end of the member unconsumed_tail is not reset,
+            # and input after the member is in unused_data
+            if decompressor.eof:
+                rest = decompressor.unused_data
+            else:
+                rest = decompressor.unconsumed_tail
+            raw_offset += len(data) - len(rest)
+            data = rest
+        else:
+            out = decompressor.flush()
+            if not out and not decompressor.eof:
+                break
+        if skip:
+            n_skip = min(skip, len(out))
+            member_offset += n_skip
+            skip -= n_skip
+            out = out[n_skip:]
+        lines = out.split(b'\n')
+        for line in lines[:-1]:
+            member_offset += len(line) + 1
+            line_no += 1
+            yield (pending + line + b'\n',
+                   Position(path, line_no, member, member_offset, False))
+            pending = b''
+        pending += lines[-1]
+        member_offset += len(lines[-1])
+        if decompressor.eof:
+            # next gzip member starts after the end of this one
+            decompressor = zlib.decompressobj(_GZIP_WBITS)
+            in_member = False
+    if in_member:
+        raise EOFError('Compressed file ended before the end-of-stream '
+                       'marker was reached')
+    if pending:
+        line_no += 1
+        yield pending, Position(path, line_no, member, member_offset, False)
+
+
+def _iter_stream_lines(f, path, start):
+    line_no, skip = 0, 0
+    if start is not None:
+        line_no, skip = start.line, start.offset
+    stream = _decompressed(f, path)
+    offset = 0
+    while skip:
+        data = stream.read(min(skip, READ_SIZE))
+        if not data:
+            raise EOFError('File ended before the start position')
+        skip -= len(data)
+        offset += len(data)
+    pending = b''
+    while True:
+        data = stream.read(READ_SIZE)
+        if not data:
+            break
+        lines = data.split(b'\n')
+        for line in lines[:-1]:
+            offset += len(line) + 1
+            line_no += 1
+            yield pending + line + b'\n', Position(
+                path, line_no, 0, offset, False)
+            pending = b''
+        pending += lines[-1]
+        offset += len(lines[-1])
+    if pending:
+        line_no += 1
+        yield pending, Position(path, line_no, 0, offset, False)
+
+
+def _decompressed(f, path):
+    if path.endswith('.zst'):
+        _require(zstandard, 'zstandard', path)
+        return zstandard.ZstdDecompressor().stream_reader(
+            f, read_across_frames=True)
+    else:
+        _require(lz4_frame, 'lz4', path)
+        return lz4_frame.open(f, 'rb')
+
+
+def _require(module, name, path):
+    if module is None:
+        raise ImportError(
+            '{} package is required for {}'.format(name, path))
+
+
+class JLWriter:
+    """ Writes lines to a .jl file, compressed according to file extension:
+    .gz (gzip), .zst (zstd) or .lz4 (lz4), uncompressed otherwise.
+
+    Lines are collected into blocks of about ``block_size`` bytes,
+    and each block is compressed independently (as a separate gzip member
+    or zstd/lz4 frame), so the result can be read by standard tools,
+    while blocks are compressed in parallel with ``threads`` threads.
+    ``level`` is the compression level (codec default if not set).
+    """
+    def __init__(self, path, level=None, threads=1, block_size=BLOCK_SIZE):
+        self.path = path
+        self._compress = _compressor(path, level)
+        self._block_size = block_size
+        self._block = []
+        self._block_bytes = 0
+        self._executor = None
+        self._in_flight = deque()
+        self._max_in_flight = 2 * threads
+        if self._compress is not None and threads > 1:
+            self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._f = open(path, 'wb')
+
+    def write(self, line):
+        """ Write a line (bytes, including the trailing newline),
+        or several lines.
+        """
+        self._block.append(line)
+        self._block_bytes += len(line)
+        if self._block_bytes >= self._block_size:
+            self._flush_block()
+
+    def write_item(self, item):
+        self.write(json_dumps_bytes(item) + b'\n')
+
+    def _flush_block(self):
+        if not self._block:
+            return
+        data = b''.join(self._block)
+        self._block = []
+        self._block_bytes = 0
+        if self._compress is None:
+            self._f.write(data)
+        elif self._executor is None:
+            self._f.write(self._compress(data))
+        else:
+            while len(self._in_flight) >= self._max_in_flight:
+                self._f.write(self._in_flight.popleft().result())
+            self._in_flight.append(
+                self._executor.submit(self._compress, data))
+
+    def close(self):
+        try:
+            self._flush_block()
+            while self._in_flight:
+                self._f.write(self._in_flight.popleft().result())
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+            self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _compressor(path, level):
+    """ Return a function compressing a block into a separate
+    gzip member or zstd/lz4 frame, or None for uncompressed files.
+    """
+    if path.endswith('.gz'):
+        level = 6 if level is None else level
+
+        def compress(data):
+            compressor = zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+            return compressor.compress(data) + compressor.flush()
+        return compress
+    elif path.endswith('.zst'):
+        _require(zstandard, 'zstandard', path)
+        level = 3 if level is None else level
+        # ZstdCompressor is not thread-safe
+        return lambda data: zstandard.ZstdCompressor(level=level).compress(
+            data)
+    elif path.endswith('.lz4'):
+        _require(lz4_frame, 'lz4', path)
+        level = 0 if level is None else level
+        return lambda data: lz4_frame.compress(
+            data, compression_level=level)
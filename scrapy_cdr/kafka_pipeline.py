@@ -0,0 +1,142 @@
+""" Sending of CDR items to Kafka during the crawl,
+without writing them to a file and running ``cdr-kafka-upload`` later.
+"""
+from collections import deque
+import logging
+
+from itemadapter import ItemAdapter
+from kafka import KafkaProducer
+from scrapy.exceptions import NotConfigured
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.threads import deferToThread
+
+from .kafka_upload import (
+    producer_kwargs, message_key, topic_partitions, CRC32Partitioner,
+    DeliveryWindow)
+from .utils import decode_raw_content, json_dumps_bytes, timestamp_now
+
+
+logger = logging.getLogger(__name__)
+
+
+class CDRKafkaPipeline:
+    """ An item pipeline which sends items to ``CDR_KAFKA_TOPIC``
+    without waiting for each of them to be acknowledged. If
+    ``CDR_KAFKA_MAX_IN_FLIGHT`` (1000) messages are not acknowledged yet,
+    items wait before leaving the pipeline, so that a slow broker
+    slows down the crawl instead of using up memory.
+
+    Usage::
+
+        ITEM_PIPELINES = {
+            'scrapy_cdr.kafka_pipeline.CDRKafkaPipeline': 900,
+        }
+        CDR_KAFKA_TOPIC = 'topic'
+        CDR_KAFKA_BROKERS = 'localhost:9092'  # several comma-separated
+
+    Other options are the same as for ``cdr-kafka-upload``:
+    ``CDR_KAFKA_SSL_KEYS_PATH``, ``CDR_KAFKA_MAX_RETRIES`` (3),
+    ``CDR_KAFKA_BATCH_SIZE`` (1 MB), ``CDR_KAFKA_LINGER_MS`` (50),
+    ``CDR_KAFKA_KEY`` ("none", "_id", "domain" or "team") and
+    ``CDR_KAFKA_PARTITIONER`` ("default" or "crc32"). ``timestamp_index``
+    is set when an item is sent, and results are counted
+    in ``kafka_pipeline/*`` crawler stats.
+    """
+    def __init__(self, producer, topic, max_in_flight=1000, max_retries=3,
+                 key='none', partitioner='default', stats=None):
+        self.producer = producer
+        self.topic = topic
+        self.key = key
+        self.stats = stats
+        self.window = DeliveryWindow(
+            producer, topic, max_in_flight=max_in_flight,
+            max_retries=max_retries, on_release=self._on_release)
+        self.partitioner = None
+        if partitioner == 'crc32':
+            self.partitioner = CRC32Partitioner(
+                topic_partitions(producer, topic))
+        self._pending = deque()
+        self._closing = False
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        topic = settings.get('CDR_KAFKA_TOPIC')
+        if not topic:
+            raise NotConfigured('CDR_KAFKA_TOPIC must be set')
+        producer = KafkaProducer(**producer_kwargs(
+            brokers=settings.get('CDR_KAFKA_BROKERS'),
+            ssl_keys_path=settings.get('CDR_KAFKA_SSL_KEYS_PATH'),
+            batch_size=settings.getint('CDR_KAFKA_BATCH_SIZE', 2**20),
+            linger_ms=settings.getint('CDR_KAFKA_LINGER_MS', 50)))
+        return cls(
+            producer, topic,
+            max_in_flight=settings.getint('CDR_KAFKA_MAX_IN_FLIGHT', 1000),
+            max_retries=settings.getint('CDR_KAFKA_MAX_RETRIES', 3),
+            key=settings.get('CDR_KAFKA_KEY', 'none'),
+            partitioner=settings.get('CDR_KAFKA_PARTITIONER', 'default'),
+            stats=crawler.stats,
+        )
+
+    def process_item(self, item, spider):
+        message, kwargs = self._message(item)
+        if not self._pending and self.window.try_send(message, **kwargs):
+            return item
+        d = Deferred()
+        self._pending.append((message, kwargs, d))
+        # messages might have been acknowledged before the item was added,
+        # and _on_release didn't schedule sending it then
+        self._send_pending()
+        return d.addCallback(lambda _: item)
+
+    def close_spider(self, spider):
+        d = Deferred()
+        self._close_when_sent(d)
+        return d
+
+    def _close_when_sent(self, d):
+        if self._pending:
+            reactor.callLater(0.1, self._close_when_sent, d)
+            return
+        self._closing = True
+        closed = deferToThread(self.window.close)
+        closed.addBoth(self._closed)
+        closed.chainDeferred(d)
+
+    def _closed(self, result):
+        self.producer.close()
+        if self.stats is not None:
+            for name in ['delivered', 'retried', 'failed']:
+                self.stats.set_value(
+                    'kafka_pipeline/{}'.format(name),
+                    getattr(self.window, 'n_{}'.format(name)))
+        logger.info('Kafka: {}'.format(self.window))
+        return result
+
+    def _message(self, item):
+        item = decode_raw_content(ItemAdapter(item).asdict())
+        item['timestamp_index'] = timestamp_now()
+        kwargs = {}
+        if self.key != 'none':
+            kwargs['key'] = message_key(item, self.key)
+            if self.partitioner is not None:
+                kwargs['partition'] = self.partitioner(kwargs['key'])
+        return json_dumps_bytes(item), kwargs
+
+    def _on_release(self):
+        # called from the producer thread
+        if self._pending or self.window.n_retries_waiting:
+            reactor.callFromThread(self._send_pending)
+
+    def _send_pending(self):
+        if self._closing:
+            return  # retries are sent by DeliveryWindow.close
+        if not self.window.send_retries(blocking=False):
+            return
+        while self._pending:
+            message, kwargs, d = self._pending[0]
+            if not self.window.try_send(message, **kwargs):
+                break
+            self._pending.popleft()
+            d.callback(None)
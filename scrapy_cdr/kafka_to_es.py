@@ -0,0 +1,252 @@
+import argparse
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import json
+import logging
+import sys
+import time
+
+import elasticsearch
+from kafka import KafkaConsumer
+from kafka.structs import OffsetAndMetadata, TopicPartition
+
+from .blob_store import open_store
+from .es_upload import (
+    BulkJSONSerializer, parallel_bulk, serialize_action,
+    _prepare_action, _op_result, _Entry, _entry_body, _RetryQueue,
+    _DeadLetter, _report_stats)
+from .kafka_upload import ssl_kwargs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Index items from a Kafka topic into ES index')
+    arg = parser.add_argument
+    arg('topic', help='Kafka topic with items, '
+                      'as uploaded by cdr-kafka-upload')
+    arg('index', help='ES index name')
+    arg('--brokers', help='brokers (comma-separated), including port')
+    arg('--group-id', default='cdr-kafka-to-es',
+        help='Kafka consumer group: run several processes (or use '
+             '--workers) with the same group to share topic partitions')
+    arg('--ssl-keys-path',
+        help='path to ca-cert.pem, client-cert.pem and client-key.pem location')
+    arg('--type', default='document',
+        help='ES type to use ("document" by default)')
+    arg('--op-type', default='index',
+        choices={'index', 'create', 'delete', 'update'},
+        help='ES operation type to use ("index" by default)')
+    arg('--format', choices=['CDRv2', 'CDRv3'], default='CDRv3')
+    arg('--host', default='localhost',
+        help='ES host in host[:port] format, or several comma-separated hosts')
+    arg('--user', help='HTTP Basic Auth user')
+    arg('--password', help='HTTP Basic Auth password')
+    arg('--chunk-size', type=int, default=50, help='upload chunk size')
+    arg('--max-chunk-bytes', type=int, default=10 * 2**20,
+        help='Depends on how ES is configured. 10 MB on AWS (default).')
+    arg('--threads', type=int, default=4, help='number of threads')
+    arg('--batch-size', type=int, default=5000,
+        help='maximum number of messages indexed before offsets '
+             'are committed')
+    arg('--batch-timeout', type=float, default=5,
+        help='maximum time in seconds to wait for a full batch')
+    arg('--idle-timeout', type=float,
+        help='exit if there were no new messages for this number of seconds '
+             '(by default, run forever)')
+    arg('--workers', type=int, default=1,
+        help='number of consumer processes')
+    arg('--max-retries', type=int, default=5,
+        help='how many times to retry a document rejected because of '
+             'cluster load (429 or 5xx status) or a timeout')
+    arg('--retry-backoff', type=float, default=2,
+        help='delay in seconds before the first retry, doubled each retry')
+    arg('--max-retry-backoff', type=float, default=300,
+        help='maximum delay in seconds before a retry')
+    arg('--dead-letter',
+        help='.jl or .jl.gz file to append documents which failed to upload '
+             'to: without it, consumption stops at the first such document')
+    arg('--offload-store',
+        help='local directory or s3://bucket/prefix with raw_content '
+             'offloaded by cdr-kafka-upload')
+    arg('--offload-endpoint-url', help='endpoint URL for S3-compatible '
+                                       'offload storage')
+    arg('--log-level', default='INFO')
+    arg('--log-file')
+    parser.set_defaults(reverse_domain_storage=False)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=getattr(logging, args.log_level),
+        format='%(asctime)s [%(levelname)s] %(module)s: %(message)s',
+        filename=args.log_file)
+    logging.getLogger('elasticsearch').setLevel(logging.WARNING)
+
+    if args.workers > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            failed = any(executor.map(_consume, [args] * args.workers))
+    else:
+        failed = _consume(args)
+    if failed:
+        sys.exit(1)
+
+
+def _consume(args):
+    """ Index messages until idle timeout or a failed document,
+    return True if there was a failure.
+    """
+    kwargs = {}
+    if args.user or args.password:
+        kwargs['http_auth'] = (args.user, args.password)
+    client = elasticsearch.Elasticsearch(
+        args.host.split(','),
+        connection_class=elasticsearch.RequestsHttpConnection,
+        serializer=BulkJSONSerializer(),
+        timeout=600,
+        **kwargs)
+
+    kafka_kwargs = dict(
+        group_id=args.group_id,
+        enable_auto_commit=False,
+        auto_offset_reset='earliest',
+        max_partition_fetch_bytes=10 * 2**20,
+    )
+    if args.brokers:
+        kafka_kwargs['bootstrap_servers'] = args.brokers.split(',')
+    if args.ssl_keys_path:
+        kafka_kwargs.update(ssl_kwargs(args.ssl_keys_path))
+    consumer = KafkaConsumer(args.topic, **kafka_kwargs)
+
+    store = None
+    if args.offload_store:
+        store = open_store(args.offload_store,
+                           endpoint_url=args.offload_endpoint_url)
+    retry_queue = _RetryQueue(
+        max_retries=args.max_retries,
+        backoff=args.retry_backoff,
+        max_backoff=args.max_retry_backoff)
+    dead_letter = _DeadLetter(args.dead_letter) if args.dead_letter else None
+
+    t0 = t00 = last_message_t = time.time()
+    i = last_i = 0
+    result_counts = defaultdict(int)
+    failed = False
+    try:
+        while not failed:
+            batch = _poll_batch(consumer, args.batch_size, args.batch_timeout)
+            if not batch:
+                if (args.idle_timeout is not None and
+                        time.time() - last_message_t > args.idle_timeout):
+                    break
+                continue
+            last_message_t = time.time()
+            outcomes = OrderedDict()
+            entries = []
+            for message in batch:
+                position = (TopicPartition(message.topic, message.partition),
+                            message.offset)
+                outcomes[position] = None
+                body = _message_body(message.value, args, store)
+                if body is None:
+                    result_counts['invalid'] += 1
+                    outcomes[position] = True  # retrying would not help
+                else:
+                    entries.append(_Entry(body, position, 0))
+            pending = iter(entries)
+            while pending is not None:
+                for entry, success, result in parallel_bulk(
+                        client,
+                        actions=pending,
+                        thread_count=args.threads,
+                        chunk_size=args.chunk_size,
+                        max_chunk_bytes=args.max_chunk_bytes,
+                        raise_on_error=False,
+                        raise_on_exception=False,
+                        serialize_action_callback=_entry_body,
+                        yield_actions=True,
+                        ):
+                    op_result, ok = _op_result(success, result, args.op_type)
+                    if not ok and retry_queue.retry(
+                            entry, result[args.op_type]):
+                        result_counts['retried'] += 1
+                        continue
+                    i += 1
+                    result_counts[op_result] += 1
+                    if not ok:
+                        logging.info('ES error: {}'.format(str(result)[:2000]))
+                        if dead_letter:
+                            dead_letter.write(entry.body)
+                            result_counts['dead_letter'] += 1
+                    outcomes[entry.position] = ok or dead_letter is not None
+                pending = retry_queue.drain() if retry_queue else None
+            if dead_letter:
+                dead_letter.flush()
+            offsets, failed = committable_offsets(outcomes)
+            if offsets:
+                consumer.commit(offsets)
+            t1 = time.time()
+            if t1 - t0 > 10:
+                _report_stats(i, last_i, t1 - t0, result_counts)
+                t0 = t1
+                last_i = i
+    finally:
+        _report_stats(i, 0, time.time() - t00, result_counts)
+        if dead_letter:
+            dead_letter.close()
+        consumer.close(autocommit=False)
+    return failed
+
+
+def _poll_batch(consumer, batch_size, timeout):
+    """ Poll up to batch_size messages, waiting at most timeout seconds.
+    """
+    batch = []
+    deadline = time.time() + timeout
+    while len(batch) < batch_size:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        records = consumer.poll(timeout_ms=int(remaining * 1000),
+                                max_records=batch_size - len(batch))
+        for messages in records.values():
+            batch.extend(messages)
+    return batch
+
+
+def _message_body(value, args, store=None):
+    """ Serialized bulk action for a message, or None if it's not valid.
+    """
+    try:
+        item = json.loads(value.decode('utf8'))
+        stored_url = item.pop('raw_content_stored_url', None)
+        if stored_url is not None:
+            if store is None:
+                raise ValueError('raw_content is offloaded, '
+                                 'but --offload-store is not set')
+            item['raw_content'] = store.get(
+                store.stored_key(stored_url)).decode('utf8')
+        return serialize_action(_prepare_action(item, args))
+    except (ValueError, KeyError, AssertionError) as e:
+        logging.error('Invalid message {!r}: {}'.format(value[:200], e))
+
+
+def committable_offsets(outcomes):
+    """ Given an ordered mapping of ``(partition, offset)`` to
+    acknowledgement success, return offsets to commit for each partition
+    (up to the first failed message), and whether there was a failure.
+    """
+    offsets = {}
+    failed_partitions = set()
+    for (tp, offset), ok in outcomes.items():
+        if tp in failed_partitions:
+            continue
+        if ok:
+            offsets[tp] = _offset_and_metadata(offset + 1)
+        else:
+            failed_partitions.add(tp)
+    return offsets, bool(failed_partitions)
+
+
+def _offset_and_metadata(offset):
+    # leader_epoch field was added in newer kafka-python versions
+    n_extra = len(OffsetAndMetadata._fields) - 2
+    return OffsetAndMetadata(offset, '', *([-1] * n_extra))
@@ -1,21 +1,29 @@
 import argparse
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import json
-from itertools import islice
+from itertools import islice, cycle
 import logging
 from pathlib import Path
+import sys
+import threading
 import time
+from six.moves.urllib.parse import urlsplit
+import zlib
 
-import json_lines
 from kafka import KafkaProducer
+from kafka.errors import KafkaError, KafkaTimeoutError
 
-from .utils import format_timestamp
+from . import jl_io
+from .blob_store import open_store
+from .utils import timestamp_now, imap_fixed_output_buffer
 
 
 def main():
     parser = argparse.ArgumentParser(description='Upload items to ES index')
     arg = parser.add_argument
-    arg('inputs', nargs='+', help='inputs in .jl or .jl.gz format')
+    arg('inputs', nargs='+',
+        help='inputs in .jl, .jl.gz, .jl.zst or .jl.lz4 format')
     arg('topic', help='inputs in .jl or .jl.gz format')
     arg('--brokers', help='brokers (comma-separated), including port')
     arg('--limit', type=int, help='Index first N items')
@@ -25,66 +33,302 @@ def main():
         help='path to ca-cert.pem, client-cert.pem and client-key.pem location')
     arg('--log-level', default='INFO')
     arg('--log-file')
-    arg('--batch-size', type=int, default=32)
+    arg('--batch-size', type=int, default=2**20,
+        help='producer batch size in bytes')
+    arg('--linger-ms', type=int, default=50,
+        help='time to wait for more messages before sending a batch')
+    arg('--max-in-flight', type=int, default=1000,
+        help='maximum number of messages sent but not yet acknowledged')
+    arg('--max-retries', type=int, default=3,
+        help='number of times a failed message is sent again')
+    arg('--offload-store',
+        help='local directory or s3://bucket/prefix to store raw_content '
+             'larger than --offload-threshold, instead of sending it '
+             'in the message (raw_content_stored_url field is set instead)')
+    arg('--offload-threshold', type=int, default=2**20,
+        help='raw_content size in bytes above which it is offloaded')
+    arg('--offload-endpoint-url', help='endpoint URL for S3-compatible '
+                                       'offload storage')
+    arg('--offload-threads', type=int, default=8,
+        help='number of threads storing offloaded raw_content')
+    arg('--key', choices=['none', '_id', 'domain', 'team'], default='none',
+        help='message key: item _id, url host, or team')
+    arg('--partitioner', choices=['default', 'crc32'], default='default',
+        help='"default" is the kafka client partitioner (murmur2 hash of '
+             'the key, same as Java client), "crc32" is faster')
+    arg('--workers', type=int, default=1,
+        help='number of producer processes, each uploading a part '
+             'of input files')
     args = parser.parse_args()
 
     logging.basicConfig(
         level=getattr(logging, args.log_level),
         format='%(asctime)s [%(levelname)s] %(module)s: %(message)s',
         filename=args.log_file)
+    if args.limit and args.workers > 1:
+        parser.error('--limit is not supported with --workers')
 
+    if args.workers > 1:
+        n_workers = min(args.workers, len(args.inputs))
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            n_failed = sum(executor.map(
+                _upload, [args] * n_workers,
+                [args.inputs[i::n_workers] for i in range(n_workers)]))
+    else:
+        n_failed = _upload(args, args.inputs)
+    if n_failed:
+        sys.exit(1)
+
+
+def _upload(args, inputs):
+    """ Upload items from inputs, returning the number of failed messages.
+    """
     def _items():
-        for filename in args.inputs:
+        for filename in inputs:
             logging.info('Starting {}'.format(filename))
-            with json_lines.open(filename, broken=args.broken) as f:
-                for item in f:
-                    yield item
+            for item in jl_io.iter_items(filename, broken=args.broken):
+                yield item
 
-    kafka_kwargs = dict(
-        max_request_size=10 * 2**20,
-        request_timeout_ms=120000,
-        retries=5,
-        retry_backoff_ms=30000,
-        compression_type='gzip',
-        batch_size=args.batch_size,  # but data is also flushed (see below)
-    )
-    if args.brokers:
-        kafka_kwargs['bootstrap_servers'] = args.brokers.split(',')
-    if args.ssl_keys_path:
-        keys_path = Path(args.ssl_keys_path)
-        kafka_kwargs.update(dict(
-            security_protocol='SSL',
-            ssl_check_hostname=False,
-            ssl_cafile=str(keys_path / 'ca-cert.pem'),
-            ssl_certfile=str(keys_path / 'client-cert.pem'),
-            ssl_keyfile=str(keys_path / 'client-key.pem'),
-        ))
-    producer = KafkaProducer(**kafka_kwargs)
+    producer = KafkaProducer(**producer_kwargs(
+        brokers=args.brokers, ssl_keys_path=args.ssl_keys_path,
+        batch_size=args.batch_size, linger_ms=args.linger_ms))
+    window = DeliveryWindow(producer, args.topic,
+                            max_in_flight=args.max_in_flight,
+                            max_retries=args.max_retries)
+    partitioner = None
+    if args.partitioner == 'crc32':
+        partitioner = CRC32Partitioner(
+            topic_partitions(producer, args.topic))
 
     items = _items()
     if args.limit:
         items = islice(items, args.limit)
+    if args.offload_store:
+        store = open_store(args.offload_store,
+                           endpoint_url=args.offload_endpoint_url)
+        items = imap_fixed_output_buffer(
+            lambda item: offload_raw_content(
+                item, store, args.offload_threshold),
+            items, threads=args.offload_threads)
 
     t0 = t00 = time.time()
     n_items = prev_n_items = 0
     try:
         for item in items:
-            item['timestamp_index'] = format_timestamp(datetime.utcnow())
+            item['timestamp_index'] = timestamp_now()
             message = json.dumps(item).encode('utf8')
-            producer.send(args.topic, message)
+            kwargs = {}
+            if args.key != 'none':
+                kwargs['key'] = message_key(item, args.key)
+                if partitioner is not None:
+                    kwargs['partition'] = partitioner(kwargs['key'])
+            window.send(message, **kwargs)
             n_items += 1
-            if n_items % args.batch_size == 0:
-                producer.flush()
             t1 = time.time()
             if t1 - t0 > 10:
-                _report_stats(n_items, prev_n_items, t1 - t0)
+                _report_stats(n_items, prev_n_items, t1 - t0, window)
                 t0 = t1
                 prev_n_items = n_items
     finally:
-        _report_stats(n_items, 0, time.time() - t00)
-        producer.flush()
+        window.close()
+        _report_stats(n_items, 0, time.time() - t00, window)
+    return window.n_failed
+
+
+def producer_kwargs(brokers=None, ssl_keys_path=None, batch_size=2**20,
+                    linger_ms=50):
+    """ KafkaProducer options, brokers are comma-separated.
+    """
+    kafka_kwargs = dict(
+        max_request_size=10 * 2**20,
+        request_timeout_ms=120000,
+        retries=5,
+        retry_backoff_ms=30000,
+        compression_type='gzip',
+        batch_size=batch_size,
+        linger_ms=linger_ms,
+    )
+    if brokers:
+        kafka_kwargs['bootstrap_servers'] = brokers.split(',')
+    if ssl_keys_path:
+        kafka_kwargs.update(ssl_kwargs(ssl_keys_path))
+    return kafka_kwargs
+
+
+def ssl_kwargs(ssl_keys_path):
+    """ Kafka client SSL options for keys in ssl_keys_path
+    (ca-cert.pem, client-cert.pem and client-key.pem).
+    """
+    keys_path = Path(ssl_keys_path)
+    return dict(
+        security_protocol='SSL',
+        ssl_check_hostname=False,
+        ssl_cafile=str(keys_path / 'ca-cert.pem'),
+        ssl_certfile=str(keys_path / 'client-cert.pem'),
+        ssl_keyfile=str(keys_path / 'client-key.pem'),
+    )
+
+
+def message_key(item, key):
+    """ Message key (bytes) by item "_id", "domain" (host of item url),
+    or "team".
+    """
+    if key == 'domain':
+        value = urlsplit(item['url']).hostname
+    else:
+        value = item.get(key)
+    return value.encode('utf8') if value else None
+
+
+def topic_partitions(producer, topic, timeout=60):
+    """ Partitions of the topic, waiting up to timeout seconds
+    until they are known (``partitions_for`` returns None or an empty set
+    before metadata is loaded, or while the topic is being created).
+    """
+    deadline = time.time() + timeout
+    while True:
+        partitions = producer.partitions_for(topic)
+        if partitions:
+            return partitions
+        if time.time() > deadline:
+            raise KafkaTimeoutError(
+                'No partitions found for topic {} after {} s'
+                .format(topic, timeout))
+        time.sleep(0.1)
+
+
+class CRC32Partitioner:
+    """ Assigns messages to partitions by CRC32 hash of the key, which
+    is much faster to compute in Python than murmur2 used by default
+    in kafka-python (but assignment differs from the Java client).
+    Messages without a key go to partitions in round-robin order.
+    """
+    def __init__(self, partitions):
+        if not partitions:
+            raise ValueError('No partitions to assign messages to')
+        self.partitions = sorted(partitions)
+        self._next = cycle(self.partitions)
+
+    def __call__(self, key):
+        if key is None:
+            return next(self._next)
+        return self.partitions[zlib.crc32(key) % len(self.partitions)]
+
+
+def offload_raw_content(item, store, threshold):
+    """ Put raw_content larger than threshold (in bytes) into the store,
+    replacing it with raw_content_stored_url, relative to the store.
+    """
+    raw_content = item.get('raw_content')
+    if raw_content and len(raw_content) * 4 > threshold:  # fast check
+        data = raw_content.encode('utf8')
+        if len(data) > threshold:
+            del item['raw_content']
+            item['raw_content_stored_url'] = store.stored_url(store.put(data))
+    return item
+
+
+class DeliveryWindow:
+    """ Sends messages without waiting for each of them to be delivered,
+    keeping at most ``max_in_flight`` messages which are not acknowledged
+    yet. Delivery is tracked with callbacks, and failed messages are sent
+    again up to ``max_retries`` times if the error is retriable.
+
+    ``on_release`` is called (from the producer thread) each time
+    a message is acknowledged or failed.
+    """
+    def __init__(self, producer, topic, max_in_flight=1000, max_retries=3,
+                 on_release=None):
+        self.producer = producer
+        self.topic = topic
+        self.max_retries = max_retries
+        self.on_release = on_release
+        self.n_delivered = self.n_retried = self.n_failed = 0
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._retry_queue = deque()
+
+    def send(self, message, **kwargs):
+        self.send_retries()
+        self._send(message, 0, kwargs)
+
+    def try_send(self, message, **kwargs):
+        """ Send a message unless the window is full (or messages waiting
+        for a retry don't fit in it), return True if it was sent.
+        Never blocks.
+        """
+        return (self.send_retries(blocking=False) and
+                self._send(message, 0, kwargs, blocking=False))
+
+    def _send(self, message, attempt, kwargs, blocking=True):
+        if not self._slots.acquire(blocking):
+            return False
+        try:
+            future = self.producer.send(self.topic, message, **kwargs)
+        except KafkaError as e:
+            self._on_error(message, attempt, kwargs, e)
+        except Exception:
+            # e.g. serialization or partitioner errors are not retried
+            self._release()
+            raise
+        else:
+            future.add_callback(self._on_success)
+            future.add_errback(self._on_error, message, attempt, kwargs)
+        return True
+
+    def _on_success(self, _):
+        with self._lock:
+            self.n_delivered += 1
+        self._release()
+
+    def _on_error(self, message, attempt, kwargs, exception):
+        # called from the producer thread, where it's not safe to send
+        with self._lock:
+            if (attempt < self.max_retries and
+                    getattr(exception, 'retriable', False)):
+                self.n_retried += 1
+                self._retry_queue.append((message, attempt + 1, kwargs))
+            else:
+                self.n_failed += 1
+                logging.error('Failed to send a message: {!r}'
+                              .format(exception))
+        self._release()
+
+    def _release(self):
+        self._slots.release()
+        if self.on_release is not None:
+            self.on_release()
+
+    @property
+    def n_retries_waiting(self):
+        return len(self._retry_queue)
+
+    def send_retries(self, blocking=True):
+        """ Send messages waiting for a retry, return False if some of
+        them were not sent because the window is full (only if not blocking).
+        """
+        while self._retry_queue:
+            message, attempt, kwargs = self._retry_queue[0]
+            if not self._send(message, attempt, kwargs, blocking=blocking):
+                return False
+            self._retry_queue.popleft()
+        return True
+
+    def close(self):
+        """ Wait until all messages are delivered or failed.
+        """
+        while True:
+            self.producer.flush()
+            if not self._retry_queue:
+                break
+            self.send_retries()
+
+    def __str__(self):
+        return '{:,} delivered, {:,} retried, {:,} failed'.format(
+            self.n_delivered, self.n_retried, self.n_failed)
 
 
-def _report_stats(n_items, prev_n_items, dt):
-    logging.info('{n_items:,} items processed at {speed:.0f} items/s'
-                 .format(n_items=n_items, speed=(n_items - prev_n_items) / dt))
+def _report_stats(n_items, prev_n_items, dt, window):
+    logging.info('{n_items:,} items processed at {speed:.0f} items/s, {window}'
+                 .format(n_items=n_items, speed=(n_items - prev_n_items) / dt,
+                         window=window))
@@ -0,0 +1,77 @@
+""" Persistent index of downloaded media objects, shared across crawls
+(and processes) by ``CDRMediaPipeline`` with ``CDR_MEDIA_INDEX`` setting.
+"""
+import json
+import sqlite3
+import time
+
+
+class MediaIndex:
+    """ SQLite index mapping original object URL to its stored path
+    (content hash), response headers and crawl timestamp.
+
+    Writes are committed every ``commit_every`` puts and on ``close()``,
+    so other processes see new entries with a small delay.
+    """
+    def __init__(self, path, commit_every=100, timeout=60):
+        self.path = path
+        self.commit_every = commit_every
+        self._conn = sqlite3.connect(path, timeout=timeout)
+        # WAL allows reading while another process is writing
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS media ('
+            'url TEXT PRIMARY KEY, '
+            'path TEXT NOT NULL, '
+            'headers TEXT NOT NULL, '
+            'timestamp_crawl TEXT NOT NULL, '
+            'checked_at REAL NOT NULL)')
+        self._conn.commit()
+        self._n_pending = 0
+
+    def get(self, url):
+        """ Return a dict with "path", "headers" (a dict),
+        "timestamp_crawl" and "checked_at" (unix time of the last download
+        or revalidation), or None if url is not in the index.
+        """
+        row = self._conn.execute(
+            'SELECT path, headers, timestamp_crawl, checked_at '
+            'FROM media WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        path, headers, timestamp_crawl, checked_at = row
+        return {
+            'path': path,
+            'headers': json.loads(headers),
+            'timestamp_crawl': timestamp_crawl,
+            'checked_at': checked_at,
+        }
+
+    def put(self, url, path, headers, timestamp_crawl):
+        """ Add or replace an entry, headers is a dict of strings.
+        """
+        self._conn.execute(
+            'INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?)',
+            (url, path, json.dumps(headers), timestamp_crawl, time.time()))
+        self._written()
+
+    def touch(self, url):
+        """ Mark an entry as revalidated now.
+        """
+        self._conn.execute('UPDATE media SET checked_at = ? WHERE url = ?',
+                           (time.time(), url))
+        self._written()
+
+    def _written(self):
+        self._n_pending += 1
+        if self._n_pending >= self.commit_every:
+            self._conn.commit()
+            self._n_pending = 0
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM media').fetchone()[0]
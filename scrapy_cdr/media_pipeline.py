@@ -1,13 +1,27 @@
-from datetime import datetime
+import bisect
+from collections import defaultdict, OrderedDict
+import errno
 import hashlib
+from io import BytesIO
 import logging
+import os
+import shutil
+import tempfile
+import time
 
 import cachetools
-from scrapy import Request
-from scrapy.pipelines.files import FilesPipeline, S3FilesStore
-from .utils import format_timestamp, media_cdr_item
+from scrapy import Request, signals
+from scrapy.pipelines.files import FilesPipeline, FSFilesStore, S3FilesStore
+from scrapy.utils.httpobj import urlparse_cached
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+from twisted.python.failure import Failure
+from .blob_store import content_key
+from .media_index import MediaIndex
+from .items import CDRMediaItem
+from .utils import headers_to_dict, timestamp_now
 
 
+logger = logging.getLogger(__name__)
 logging.getLogger('botocore').setLevel(logging.WARNING)
 
 
@@ -38,6 +52,9 @@ class CDRMediaPipeline(FilesPipeline):
 
        - ``FILES_MAX_CACHE`` set maximum size of the downloader cache, and is
          10000 by default (unlike unbounded cache used in scrapy).
+         Set ``CDR_MEDIA_CACHE_BYTES`` to limit the cache by the approximate
+         size of cached results in bytes instead. Cache hits, misses and
+         evictions are counted in ``media_cache/*`` crawler stats.
 
        - Set ``CDR_S3_RELATIVE_URLS=False`` option to use
          absolute URLs in ``objects`` array (``obj_stored_url``) when data is
@@ -45,6 +62,48 @@ class CDRMediaPipeline(FilesPipeline):
          contain path and bucket. Local paths are always relative, regardless
          of this option.
 
+       - ``CDR_MEDIA_MAX_SIZE`` sets maximum size of a media object in bytes
+         (larger objects are not downloaded), default is ``DOWNLOAD_MAXSIZE``.
+
+       - ``CDR_MEDIA_MEMORY_BUDGET`` limits the total size in bytes of media
+         objects being downloaded at once: new downloads wait while
+         it's exceeded. Default is 0 (no limit).
+
+       - Media bodies are hashed as they arrive and written to a temporary
+         file, which is then renamed (or uploaded to S3), instead of
+         copying the body in memory and hashing it again (only for local
+         and S3 storage).
+         Set ``CDR_MEDIA_SPOOL=False`` to disable this. Temporary files
+         are put into ``CDR_MEDIA_SPOOL_DIR``, which is ".spool" in
+         ``FILES_STORE`` for local storage by default.
+
+       - ``CDR_MEDIA_INDEX`` is a path to an SQLite database with stored
+         objects, keyed by original URL, which can be shared by several
+         crawls: objects found in the index are not downloaded again,
+         as long as they were checked less than ``CDR_MEDIA_INDEX_MAX_AGE``
+         seconds ago (by default they never expire). Expired objects are
+         downloaded with a conditional request if the server sent
+         ``ETag`` or ``Last-Modified`` headers. Objects are assumed to be
+         still present in ``FILES_STORE``.
+
+       - Objects are named by content hash, so objects which are already
+         present in ``FILES_STORE`` are not written again: recently stored
+         keys are kept in memory (up to ``CDR_MEDIA_STORED_CACHE``, 100000
+         by default), and other keys are checked in the store (with
+         a HEAD request for S3). Set ``CDR_MEDIA_SKIP_EXISTING=False``
+         to always write objects. Crawler stats ``media_store/hit_cache``,
+         ``media_store/hit_store`` and ``media_store/miss`` count these cases.
+
+       - ``CDR_MEDIA_CONCURRENT_REQUESTS`` and
+         ``CDR_MEDIA_CONCURRENT_REQUESTS_PER_DOMAIN`` limit the number of
+         media downloads in flight, in total and for each host (by default
+         there is no limit besides scrapy downloader limits).
+         Waiting downloads are started in order of request priority,
+         which can be set with ``CDR_MEDIA_PRIORITY``.
+
+       - ``CDR_MEDIA_MAX_OBJECTS_PER_ITEM`` limits the number of distinct
+         objects downloaded for one item (by default there is no limit).
+
     5. Optionally, subclass the ``CDRMediaPipeline`` and redefine some methods:
 
        - ``media_request`` method if you want to
@@ -60,22 +119,268 @@ class CDRMediaPipeline(FilesPipeline):
     def open_spider(self, spider):
         super(CDRMediaPipeline, self).open_spider(spider)
         max_cached = spider.settings.getint('FILES_MAX_CACHE', 10000)
-        if max_cached:  # 0 not supported here
-            self.spiderinfo.downloaded = cachetools.LRUCache(
-                maxsize=max_cached)
+        max_cached_bytes = spider.settings.getint('CDR_MEDIA_CACHE_BYTES', 0)
+        if max_cached_bytes:
+            self.spiderinfo.downloaded = _MediaCache(
+                spider, maxsize=max_cached_bytes, getsizeof=_result_size)
+        elif max_cached:  # 0 not supported here
+            self.spiderinfo.downloaded = _MediaCache(
+                spider, maxsize=max_cached)
         self.s3_relative_urls = spider.settings.getbool(
             'CDR_S3_RELATIVE_URLS', True)
+        self.max_size = spider.settings.getint('CDR_MEDIA_MAX_SIZE', 0)
+        self.memory_budget = spider.settings.getint(
+            'CDR_MEDIA_MEMORY_BUDGET', 0)
+        self.bytes_in_flight = 0
+        self.max_concurrent = spider.settings.getint(
+            'CDR_MEDIA_CONCURRENT_REQUESTS', 0)
+        self.max_concurrent_per_host = spider.settings.getint(
+            'CDR_MEDIA_CONCURRENT_REQUESTS_PER_DOMAIN', 0)
+        self.media_priority = spider.settings.get('CDR_MEDIA_PRIORITY')
+        self.max_objects_per_item = spider.settings.getint(
+            'CDR_MEDIA_MAX_OBJECTS_PER_ITEM', 0)
+        self.n_in_flight = 0
+        self._in_flight_per_host = defaultdict(int)
+        self._waiting = []  # sorted by (-priority, sequence number)
+        self._n_waited = 0
+        self.spool_dir = None
+        # other stores (e.g. GCS) need the body in memory (buf.getvalue())
+        if (spider.settings.getbool('CDR_MEDIA_SPOOL', True) and
+                isinstance(self.store, (FSFilesStore, S3FilesStore))):
+            self.spool_dir = spider.settings.get('CDR_MEDIA_SPOOL_DIR')
+            if self.spool_dir is None:
+                if isinstance(self.store, FSFilesStore):
+                    # same filesystem, so that spooled files can be renamed
+                    self.spool_dir = os.path.join(self.store.basedir, '.spool')
+                else:
+                    self.spool_dir = tempfile.gettempdir()
+            if not os.path.isdir(self.spool_dir):
+                os.makedirs(self.spool_dir)
+        self.skip_existing = spider.settings.getbool(
+            'CDR_MEDIA_SKIP_EXISTING', True)
+        self._stored_keys = cachetools.LRUCache(
+            maxsize=spider.settings.getint('CDR_MEDIA_STORED_CACHE', 100000))
+        self.media_index = None
+        index_path = spider.settings.get('CDR_MEDIA_INDEX')
+        if index_path:
+            self.media_index = MediaIndex(index_path)
+        self.index_max_age = spider.settings.getfloat(
+            'CDR_MEDIA_INDEX_MAX_AGE', 0) or None
+        crawler = getattr(self, 'crawler', None)
+        if crawler is not None:
+            crawler.signals.connect(
+                self._bytes_received, signal=signals.bytes_received)
+            crawler.signals.connect(
+                self._response_downloaded, signal=signals.response_downloaded)
 
     def media_request(self, url):
         # Override to provide your own downloading logic
         return Request(url)
 
     def get_media_requests(self, item, info):
-        return [self.media_request(url) for url in item.get('objects', [])]
+        urls = item.get('objects', [])
+        if self.max_objects_per_item:
+            distinct_urls = list(OrderedDict.fromkeys(urls))
+            if len(distinct_urls) > self.max_objects_per_item:
+                info.spider.crawler.stats.inc_value(
+                    'media/objects_over_limit',
+                    len(distinct_urls) - self.max_objects_per_item,
+                    spider=info.spider)
+            urls = distinct_urls[:self.max_objects_per_item]
+        requests = [self.media_request(url) for url in urls]
+        for request in requests:
+            if self.media_priority is not None:
+                request.priority = int(self.media_priority)
+            if self.max_size:
+                request.meta['download_maxsize'] = self.max_size
+            # meta is shallow-copied on redirects, so the spool is shared
+            request.meta['cdr_media_spool'] = _Spool(self.spool_dir)
+        return requests
+
+    def close_spider(self, spider):
+        if self.media_index is not None:
+            self.media_index.close()
 
     def media_to_download(self, request, info):
-        # downloaded items have already been filtered as duplicate
-        return None
+        # downloaded items have already been filtered as duplicate,
+        # but they may be in the index, or need to wait for a free slot
+        # or memory budget
+        if self.media_index is not None:
+            entry = self.media_index.get(request.url)
+            if entry is not None:
+                age = time.time() - entry['checked_at']
+                if self.index_max_age is None or age < self.index_max_age:
+                    self.inc_stats(info.spider, 'uptodate')
+                    return self._indexed_result(
+                        request, entry, entry['timestamp_crawl'])
+                _set_conditional_headers(request, entry['headers'])
+                request.meta['cdr_media_index_entry'] = entry
+        if self._can_start(request):
+            self._acquire_slot(request)
+            return None
+        d = Deferred()
+        self._n_waited += 1
+        bisect.insort(
+            self._waiting, (-request.priority, self._n_waited, request, d))
+        return d
+
+    def _can_start(self, request):
+        if self.memory_budget and self.bytes_in_flight >= self.memory_budget:
+            return False
+        if self.max_concurrent and self.n_in_flight >= self.max_concurrent:
+            return False
+        if self.max_concurrent_per_host and (
+                self._in_flight_per_host[_host(request)] >=
+                self.max_concurrent_per_host):
+            return False
+        return True
+
+    def _acquire_slot(self, request):
+        host = _host(request)
+        request.meta['cdr_media_slot'] = host
+        self._in_flight_per_host[host] += 1
+        self.n_in_flight += 1
+
+    def _release_slot(self, request):
+        host = request.meta.pop('cdr_media_slot', None)
+        if host is None:
+            return
+        self.n_in_flight -= 1
+        self._in_flight_per_host[host] -= 1
+        if not self._in_flight_per_host[host]:
+            del self._in_flight_per_host[host]
+        self._start_waiting()
+
+    def _start_waiting(self):
+        """ Start waiting downloads which can start now,
+        in order of priority.
+        """
+        started = []
+        for entry in self._waiting:
+            request = entry[2]
+            if self._can_start(request):
+                self._acquire_slot(request)
+                started.append(entry)
+        if started:
+            started_ids = {id(entry) for entry in started}
+            self._waiting = [entry for entry in self._waiting
+                             if id(entry) not in started_ids]
+            for entry in started:
+                entry[3].callback(None)
+
+    def _bytes_received(self, data, request, spider):
+        spool = request.meta.get('cdr_media_spool')
+        if spool is not None:
+            spool.write(data)
+            self.bytes_in_flight += len(data)
+
+    def _response_downloaded(self, response, request, spider):
+        spool = request.meta.get('cdr_media_spool')
+        if spool is None:
+            return
+        if response.status != 200:
+            # e.g. a redirect: final response body will follow
+            self._release(spool)
+        else:
+            # sent before downloader middlewares can decompress the body
+            # and remove the header
+            spool.content_encoding = response.headers.get('Content-Encoding')
+
+    def _release(self, spool):
+        """ Discard spooled data and let waiting downloads start.
+        """
+        self.bytes_in_flight -= spool.size
+        spool.discard()
+        if self._waiting:
+            self._start_waiting()
+
+    def _valid_spool(self, request, response):
+        """ Spool with response body, or None if it's not available
+        (e.g. response is cached, or body was decompressed).
+        """
+        spool = request.meta.get('cdr_media_spool')
+        if (spool is not None and spool.path is not None and
+                spool.size == len(response.body) and
+                spool.content_encoding in {None, b'identity'} and
+                b'Content-Encoding' not in response.headers):
+            return spool
+
+    def media_failed(self, failure, request, info):
+        self._release_slot(request)
+        self._release_request(request)
+        return super(CDRMediaPipeline, self).media_failed(
+            failure, request, info)
+
+    def file_downloaded(self, response, request, info, **kwargs):
+        path = self.file_path(request, response=response, info=info)
+        spool = self._valid_spool(request, response)
+        if spool is not None:
+            spool.close()
+        if self.skip_existing and path in self._stored_keys:
+            self._inc_store_stats(info, 'hit_cache')
+            self._release_request(request)
+        elif isinstance(self.store, FSFilesStore):
+            # media_failed is not called if storing fails
+            try:
+                self._persist_fs(path, spool, response, info)
+            finally:
+                self._release_request(request)
+        else:
+            if self.skip_existing:
+                d = maybeDeferred(self.store.stat_file, path, info)
+                d.addErrback(lambda _: {})
+            else:
+                d = succeed({})
+            d.addCallback(self._persist_if_missing, path, spool, response, info)
+            d.addBoth(self._persisted, request)
+        return None  # md5 checksum is not used
+
+    def _persist_fs(self, path, spool, response, info):
+        abs_path = self.store._get_filesystem_path(path)
+        if self.skip_existing and os.path.exists(abs_path):
+            self._inc_store_stats(info, 'hit_store')
+        else:
+            self._inc_store_stats(info, 'miss')
+            self.store._mkdir(os.path.dirname(abs_path), info)
+            if spool is not None:
+                _move_file(spool.path, abs_path)
+            else:
+                self.store.persist_file(path, BytesIO(response.body), info)
+        self._stored_keys[path] = True
+
+    def _persist_if_missing(self, stat, path, spool, response, info):
+        if stat:
+            self._inc_store_stats(info, 'hit_store')
+            self._stored_keys[path] = True
+            return
+        self._inc_store_stats(info, 'miss')
+        if spool is not None:
+            f = open(spool.path, 'rb')
+        else:
+            f = BytesIO(response.body)
+        d = maybeDeferred(self.store.persist_file, path, f, info)
+
+        def _stored(result):
+            self._stored_keys[path] = True
+            return result
+        d.addCallback(_stored)
+        d.addBoth(lambda result: (f.close(), result)[1])
+        return d
+
+    def _persisted(self, result, request):
+        self._release_request(request)
+        if isinstance(result, Failure):
+            logger.error('Error storing {}: {}'.format(
+                request.url, result.getErrorMessage()))
+
+    def _release_request(self, request):
+        spool = request.meta.get('cdr_media_spool')
+        if spool is not None:
+            self._release(spool)
+
+    def _inc_store_stats(self, info, name):
+        info.spider.crawler.stats.inc_value(
+            'media_store/{}'.format(name), spider=info.spider)
 
     def item_completed(self, results, item, info):
         item['objects'] = []
@@ -83,10 +388,12 @@ class CDRMediaPipeline(FilesPipeline):
             path = res['path']
             if isinstance(self.store, S3FilesStore):
                 path = self.s3_path(path)
-            item['objects'].append(media_cdr_item(
-                res['url'],
-                stored_url=path,
-                headers=res['headers'],
+            headers = res['response_headers']
+            item['objects'].append(CDRMediaItem(
+                obj_original_url=res['url'],
+                obj_stored_url=path,
+                content_type=headers.get('content-type', ''),
+                response_headers=headers,
                 timestamp_crawl=res['timestamp_crawl'],
             ))
         return item
@@ -103,12 +410,166 @@ class CDRMediaPipeline(FilesPipeline):
 
     def file_path(self, request, response=None, info=None):
         assert response is not None
-        return hashlib.sha256(response.body).hexdigest().upper()
+        spool = self._valid_spool(request, response)
+        if spool is not None:
+            return spool.sha256.hexdigest().upper()
+        return content_key(response.body)
 
     def media_downloaded(self, response, request, info):
+        self._release_slot(request)
+        timestamp_crawl = timestamp_now()
+        entry = request.meta.get('cdr_media_index_entry')
+        if response.status == 304 and entry is not None:
+            self.media_index.touch(request.url)
+            self.inc_stats(info.spider, 'uptodate')
+            return self._indexed_result(request, entry, timestamp_crawl)
         result = super(CDRMediaPipeline, self)\
             .media_downloaded(response, request, info)
-        result.pop('checksum', None)
-        result['headers'] = response.headers
-        result['timestamp_crawl'] = format_timestamp(datetime.utcnow())
+        # results are cached, so keep only what item_completed needs
+        headers = headers_to_dict(response.headers)
+        result = {
+            'url': result['url'],
+            'path': result['path'],
+            'response_headers': headers,
+            'timestamp_crawl': timestamp_crawl,
+        }
+        if self.media_index is not None:
+            self.media_index.put(
+                request.url, result['path'], headers, timestamp_crawl)
         return result
+
+    def _indexed_result(self, request, entry, timestamp_crawl):
+        return {
+            'url': request.url,
+            'path': entry['path'],
+            'response_headers': entry['headers'],
+            'timestamp_crawl': timestamp_crawl,
+        }
+
+
+class _MediaCache(cachetools.LRUCache):
+    """ Cache of download results, with hits, misses and evictions
+    counted in crawler stats.
+    """
+    def __init__(self, spider, maxsize, getsizeof=None):
+        super(_MediaCache, self).__init__(maxsize=maxsize, getsizeof=getsizeof)
+        self._spider = spider
+        self._internal = False
+
+    def __contains__(self, key):
+        # MediaPipeline checks each request once, cachetools also
+        # checks keys internally when getting and evicting items
+        found = super(_MediaCache, self).__contains__(key)
+        if not self._internal:
+            self._inc('hit' if found else 'miss')
+        return found
+
+    def __getitem__(self, key):
+        self._internal = True
+        try:
+            return super(_MediaCache, self).__getitem__(key)
+        finally:
+            self._internal = False
+
+    def __setitem__(self, key, value):
+        if self.getsizeof(value) > self.maxsize:
+            return  # larger than the whole cache
+        super(_MediaCache, self).__setitem__(key, value)
+
+    def popitem(self):
+        self._inc('eviction')
+        self._internal = True
+        try:
+            return super(_MediaCache, self).popitem()
+        finally:
+            self._internal = False
+
+    def _inc(self, name):
+        self._spider.crawler.stats.inc_value(
+            'media_cache/{}'.format(name), spider=self._spider)
+
+
+def _result_size(result):
+    """ Approximate size of a cached result in bytes.
+    """
+    if not isinstance(result, dict):
+        return 1000  # a failure, without frames
+    size = 500  # dict and key overhead
+    for key in ['url', 'path', 'timestamp_crawl']:
+        size += 50 + len(result[key])
+    for key, value in result['response_headers'].items():
+        size += 150 + len(key) + len(value)
+    return size
+
+
+def _host(request):
+    return urlparse_cached(request).hostname
+
+
+def _set_conditional_headers(request, headers):
+    headers = {k.lower(): v for k, v in headers.items()}
+    if 'etag' in headers:
+        request.headers['If-None-Match'] = headers['etag']
+    if 'last-modified' in headers:
+        request.headers['If-Modified-Since'] = headers['last-modified']
+
+
+def _move_file(src, dest):
+    """ Move src to dest atomically, also if they are on different
+    filesystems (then dest is replaced by a copy).
+    """
+    try:
+        os.replace(src, dest)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(dest), prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f, open(src, 'rb') as src_f:
+                shutil.copyfileobj(src_f, f)
+            os.replace(tmp_path, dest)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        os.remove(src)
+
+
+class _Spool:
+    """ Media body being downloaded: it is hashed as it arrives, and
+    written to a temporary file (created on first write).
+    """
+    def __init__(self, spool_dir):
+        self.spool_dir = spool_dir
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.path = None
+        self.content_encoding = None
+        self._file = None
+
+    def write(self, data):
+        self.size += len(data)
+        if self.spool_dir is None:
+            return  # only size is tracked
+        if self._file is None:
+            fd, self.path = tempfile.mkstemp(
+                dir=self.spool_dir, prefix='cdr-media-')
+            self._file = os.fdopen(fd, 'wb')
+        self.sha256.update(data)
+        self._file.write(data)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def discard(self):
+        """ Remove spooled data, allowing to write the body again.
+        """
+        self.close()
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+        self.path = None
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.content_encoding = None
@@ -0,0 +1,253 @@
+""" Relayout of stored media objects into reverse domain folder structure,
+e.g. "ABCD.jpg" downloaded from "http://images.example.com/1.jpg"
+is put into "com/example/images/ABCD".
+
+Can be used as a standalone tool (``cdr-media-relayout``),
+and by ``cdr-es-upload --reverse-domain-storage``.
+"""
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import errno
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from six.moves.urllib.parse import urlsplit
+
+import cachetools
+
+from . import jl_io
+
+
+MODES = ['copy', 'hardlink', 'reflink', 'rename']
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Put media objects of CDR items into reverse domain '
+                    'folder structure')
+    arg = parser.add_argument
+    arg('inputs', nargs='+', help='CDR items in .jl, .jl.gz, .jl.zst '
+                                  'or .jl.lz4 format')
+    arg('--media-root', required=True,
+        help='path to the root of stored media objects')
+    arg('--mode', choices=MODES, default='hardlink',
+        help='how to put objects into the new location (see Relayout)')
+    arg('--threads', type=int, default=16,
+        help='number of threads doing file operations')
+    arg('--output', help='write items with updated obj_stored_url here')
+    arg('--broken', action='store_true',
+        help='specify if input might be broken (incomplete)')
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s [%(levelname)s] %(module)s: %(message)s')
+
+    relayout = Relayout(args.media_root, mode=args.mode,
+                        threads=args.threads)
+    writer = jl_io.JLWriter(args.output) if args.output else None
+    t0 = time.time()
+    try:
+        for filename in args.inputs:
+            logging.info('Starting {}'.format(filename))
+            for item in jl_io.iter_items(filename, broken=args.broken):
+                relayout.relayout_item(item)
+                if writer:
+                    writer.write_item(item)
+                if time.time() - t0 > 10:
+                    logging.info(relayout)
+                    t0 = time.time()
+    finally:
+        relayout.close()
+        if writer:
+            writer.close()
+    logging.info(relayout)
+    if relayout.n_failed:
+        sys.exit(1)
+
+
+def reverse_domain_path(original_url, stored_url):
+    """ New stored url (relative to media root) for an object
+    downloaded from original_url and stored at stored_url.
+    """
+    assert '/' not in stored_url
+    domain = urlsplit(original_url).netloc
+    if ':' in domain:
+        domain, _ = domain.split(':', 1)
+    parents = [p for p in reversed(domain.split('.')) if p]
+    stored_url_noext, _ = os.path.splitext(stored_url)
+    return os.path.sep.join(parents + [stored_url_noext])
+
+
+class Relayout:
+    """ Puts objects into new locations in a thread pool, with ``mode``:
+
+    - "copy": copy files (default, needs twice the space),
+    - "hardlink": create hardlinks (needs the same filesystem),
+    - "reflink": copy-on-write copies where supported (e.g. btrfs, xfs),
+      falling back to copying,
+    - "rename": move files: objects are hardlinked, and original files
+      are removed in ``close()``, so objects referenced by several items
+      are found no matter when they are seen again. This needs the same
+      filesystem, and only one ``Relayout`` working on the media root.
+
+    Call ``wait()`` to wait for scheduled operations,
+    and ``close()`` when done.
+    """
+    def __init__(self, media_root, mode='copy', threads=8,
+                 max_cached=100000):
+        assert mode in MODES
+        self.media_root = media_root
+        self.mode = mode
+        self.closed = False
+        self.n_done = self.n_existing = self.n_failed = 0
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._futures = deque()
+        self._max_in_flight = 100 * threads
+        self._lock = threading.Lock()
+        self._created_dirs = set()
+        self._scheduled = cachetools.LRUCache(maxsize=max_cached)
+        self._to_remove = None  # original paths, removed in close()
+        if mode == 'rename':
+            self._to_remove = tempfile.TemporaryFile(mode='w+')
+
+    def relayout_item(self, item):
+        """ Update obj_stored_url of item objects and schedule
+        putting objects into new locations.
+        """
+        for obj in item.get('objects', []):
+            stored_url = obj['obj_stored_url']
+            new_stored_url = reverse_domain_path(
+                obj['obj_original_url'], stored_url)
+            self.schedule(stored_url, new_stored_url)
+            obj['obj_stored_url'] = new_stored_url
+
+    def schedule(self, src, dest):
+        if dest in self._scheduled:
+            return
+        self._scheduled[dest] = True
+        while self._futures and self._futures[0].done():
+            self._futures.popleft().result()
+        if len(self._futures) >= self._max_in_flight:
+            self._futures.popleft().result()
+        self._futures.append(self._executor.submit(self._relayout, src, dest))
+
+    def _relayout(self, src, dest):
+        src = os.path.join(self.media_root, src)
+        dest = os.path.join(self.media_root, dest)
+        try:
+            if os.path.exists(dest):
+                self._count('n_existing')
+                return
+            self._makedirs(os.path.dirname(dest))
+            if self.mode == 'rename':
+                _link(src, dest)
+                with self._lock:
+                    self._to_remove.write(src + '\n')
+            elif self.mode == 'hardlink':
+                _link(src, dest)
+            elif self.mode == 'reflink':
+                _reflink(src, dest)
+            else:
+                _copy(src, dest)
+        except OSError as e:
+            logging.error('Failed to put {} to {}: {}'.format(src, dest, e))
+            self._count('n_failed')
+        else:
+            self._count('n_done')
+
+    def _makedirs(self, path):
+        if path in self._created_dirs:
+            return
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            self._created_dirs.add(path)
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def wait(self):
+        while self._futures:
+            self._futures.popleft().result()
+
+    def pop_counts(self):
+        """ Return ``(n_done, n_existing, n_failed)`` and reset them.
+        """
+        with self._lock:
+            counts = (self.n_done, self.n_existing, self.n_failed)
+            self.n_done = self.n_existing = self.n_failed = 0
+        return counts
+
+    def add_counts(self, counts):
+        with self._lock:
+            n_done, n_existing, n_failed = counts
+            self.n_done += n_done
+            self.n_existing += n_existing
+            self.n_failed += n_failed
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
+        if self._to_remove is not None:
+            self._remove_originals()
+        self.closed = True
+
+    def _remove_originals(self):
+        self._to_remove.seek(0)
+        for line in self._to_remove:
+            try:
+                os.remove(line[:-1])
+            except FileNotFoundError:
+                pass  # the same object was put into several places
+        self._to_remove.close()
+        self._to_remove = None
+
+    def __str__(self):
+        return ('Relayout: {:,} objects done, {:,} already existed, '
+                '{:,} failed'.format(
+                    self.n_done, self.n_existing, self.n_failed))
+
+
+def _copy(src, dest):
+    tmp = '{}.tmp{}'.format(dest, threading.get_ident())
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+
+
+def _link(src, dest):
+    try:
+        os.link(src, dest)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+_FICLONE = 0x40049409  # from linux/fs.h
+
+
+def _reflink(src, dest):
+    if fcntl is None:
+        _copy(src, dest)
+        return
+    tmp = '{}.tmp{}'.format(dest, threading.get_ident())
+    try:
+        with open(src, 'rb') as src_f, open(tmp, 'wb') as tmp_f:
+            fcntl.ioctl(tmp_f.fileno(), _FICLONE, src_f.fileno())
+    except OSError as e:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        if e.errno in {errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL,
+                       errno.ENOTTY}:
+            _copy(src, dest)
+            return
+        raise
+    os.replace(tmp, dest)
@@ -1,29 +1,56 @@
+from concurrent.futures import (
+    ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED)
+import codecs
 import hashlib
-from datetime import datetime
+import json
+import time
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
 from .items import CDRItem, CDRMediaItem
 
 
 def text_cdr_item(response, crawler_name, team_name,
-                  objects=None, metadata=None, item_cls=CDRItem):
-    content_type = response.headers.get('content-type', b'')
+                  objects=None, metadata=None, item_cls=CDRItem,
+                  raw_bytes=False, content_hash=False):
+    """ CDR item for a text response. With ``raw_bytes=True``,
+    ``raw_content`` is the response body (bytes) and ``raw_content_encoding``
+    is set: the body is not decoded until ``decode_raw_content`` is called.
+    With ``content_hash=True``, ``raw_content_hash`` is set.
+    """
+    headers = response.headers
+    content_type = headers.get('content-type', b'')
     extra = {}
     if metadata is not None:
         extra['metadata'] = metadata
+    if raw_bytes:
+        extra['raw_content'] = response.body
+        extra['raw_content_encoding'] = response.encoding
+    else:
+        extra['raw_content'] = response.text
+    if content_hash:
+        extra['raw_content_hash'] = raw_content_hash(
+            response.text if not raw_bytes else response.body,
+            response.encoding)
     return cdr_item(
         response.url,
         crawler_name=crawler_name,
         team_name=team_name,
         content_type=content_type.decode('ascii', 'ignore'),
-        raw_content=response.text,
-        response_headers=response.headers.to_unicode_dict(),
+        response_headers=headers_to_dict(headers),
         item_cls=item_cls,
         objects=objects or [],
         **extra)
 
 
 def cdr_item(url, crawler_name, team_name, item_cls=CDRItem, **extra):
-    timestamp_crawl = format_timestamp(datetime.utcnow())
+    timestamp_crawl = timestamp_now()
     return item_cls(
         _id=format_id(url, timestamp_crawl),
         crawler=crawler_name,
@@ -39,19 +66,122 @@ def media_cdr_item(url, stored_url, headers, timestamp_crawl=None):
         obj_original_url=url,
         obj_stored_url=stored_url,
         content_type=get_content_type(headers),
-        response_headers=headers.to_unicode_dict(),
-        timestamp_crawl=timestamp_crawl or format_timestamp(datetime.utcnow()),
+        response_headers=headers_to_dict(headers),
+        timestamp_crawl=timestamp_crawl or timestamp_now(),
     )
 
 
+def decode_raw_content(item):
+    """ Decode ``raw_content`` of an item created with
+    ``text_cdr_item(raw_bytes=True)`` in place, and return the item.
+    """
+    raw_content = item.get('raw_content')
+    if isinstance(raw_content, (bytes, memoryview)):
+        encoding = item.pop('raw_content_encoding', None) or 'utf8'
+        item['raw_content'] = bytes(raw_content).decode(encoding, 'replace')
+    return item
+
+
+def raw_content_hash(raw_content, encoding='utf8'):
+    """ SHA-1 hex digest of raw_content encoded as UTF-8, where raw_content
+    is text, or bytes in given encoding. UTF-8 bytes are hashed as is,
+    without decoding them (so the hash differs from the hash of decoded
+    text if they are not valid UTF-8).
+    """
+    if isinstance(raw_content, str):
+        raw_content = raw_content.encode('utf8')
+    elif codecs.lookup(encoding).name != 'utf-8':
+        raw_content = bytes(raw_content).decode(encoding, 'replace')\
+            .encode('utf8')
+    return hashlib.sha1(raw_content).hexdigest()
+
+
 def get_content_type(headers):
     return headers.get('content-type', b'').decode('ascii', 'ignore')
 
 
+def headers_to_dict(headers):
+    """ Same as ``headers.to_unicode_dict()`` for scrapy Headers,
+    but returns a plain dict and is faster.
+    """
+    return {key.decode('utf8').lower(): b','.join(values).decode('utf8')
+            for key, values in headers.items()}
+
+
 def format_timestamp(dt):
     return '{}Z'.format(dt.isoformat())
 
 
+_timestamp_second = (None, None)
+
+
+def timestamp_now():
+    """ Current UTC time formatted as by
+    ``format_timestamp(datetime.utcnow())``, but faster: formatting
+    of the date and time up to seconds is cached.
+    Microseconds are always included.
+    """
+    global _timestamp_second
+    t = time.time()
+    second = int(t)
+    cached_second, prefix = _timestamp_second
+    if second != cached_second:
+        prefix = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(second))
+        _timestamp_second = (second, prefix)
+    return '{}.{:06d}Z'.format(prefix, int((t - second) * 1e6))
+
+
 def format_id(url, timestamp_crawl):
     key = '{}-{}'.format(url, timestamp_crawl).encode('utf-8')
     return hashlib.sha256(key).hexdigest().upper()
+
+
+def json_dumps_bytes(obj):
+    """ Serialize obj to JSON encoded as UTF-8 bytes, using the fastest
+    available encoder (orjson, then ujson, then stdlib json).
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:  # e.g. non-str keys or surrogates
+            pass
+    elif ujson is not None:
+        try:
+            return ujson.dumps(
+                obj, ensure_ascii=False, escape_forward_slashes=False,
+            ).encode('utf8')
+        except (TypeError, OverflowError, UnicodeEncodeError):
+            pass
+    try:
+        return json.dumps(obj, ensure_ascii=False).encode('utf8')
+    except UnicodeEncodeError:
+        return json.dumps(obj).encode('utf8')
+
+
+def imap_fixed_output_buffer(fn, it, threads: int,
+                             executor_cls=ThreadPoolExecutor,
+                             max_in_flight=None,
+                             ordered=True):
+    """ Like executor.map, but keeps at most threads + 1 results
+    in flight, so it runs in constant memory if ``it`` is large.
+    Pass ``executor_cls=ProcessPoolExecutor`` for CPU-bound functions.
+    ``max_in_flight`` is a function returning current maximum number
+    of results in flight, if it needs to change.
+    If not ``ordered``, results are yielded as soon as they are ready.
+    """
+    if max_in_flight is None:
+        max_in_flight = lambda: threads + 1
+    with executor_cls(max_workers=threads) as executor:
+        futures = []
+        for i, x in enumerate(it):
+            while len(futures) >= max_in_flight():
+                if ordered:
+                    future, futures = futures[0], futures[1:]
+                else:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    future = done.pop()
+                    futures.remove(future)
+                yield future.result()
+            futures.append(executor.submit(fn, x))
+        for future in (futures if ordered else as_completed(futures)):
+            yield future.result()
@@ -1,44 +1,127 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-try:
-    import ujson as json
-except ImportError:
-    import json
-import gzip
+from functools import partial
+import glob
+from itertools import islice
+import json
+import multiprocessing
 
-import json_lines
-
-from .items import CDRItem
-from .utils import format_timestamp, format_id
+from . import jl_io
+from .utils import (
+    format_timestamp, format_id, json_dumps_bytes, imap_fixed_output_buffer)
 
 
 def main():
     parser = argparse.ArgumentParser()
     arg = parser.add_argument
-    arg('input', help='.jl or .jl.gz file in CDRv2 format')
-    arg('output', help='path to .jl or .jl.gz output in CDRv3 format')
+    arg('inputs', nargs='+',
+        help='.jl, .jl.gz, .jl.zst or .jl.lz4 files in CDRv2 format '
+             '(glob patterns are expanded)')
+    arg('output', help='path to .jl, .jl.gz, .jl.zst or .jl.lz4 output '
+                       'in CDRv3 format')
     arg('--broken', action='store_true',
         help='specify if input might be broken (incomplete)')
+    arg('--workers', type=int, default=multiprocessing.cpu_count(),
+        help='number of worker processes (default: number of CPUs)')
+    arg('--batch-size', type=int, default=1000,
+        help='number of lines converted by a worker at once')
+    arg('--shards', type=int, default=1,
+        help='write output to N files (output.shard0.jl.gz, etc.)')
+    arg('--unordered', action='store_true',
+        help='do not preserve input order (a bit faster with many workers)')
+    arg('--compression-level', type=int,
+        help='compression level (default depends on output format)')
+    arg('--compression-threads', type=int, default=2,
+        help='number of threads used for compression of each shard')
     args = parser.parse_args()
-    assert args.input != args.output
-
-    with json_lines.open(args.input, broken=args.broken) as f:
-        opener = gzip.open if args.output.endswith('.gz') else open
-        with opener(args.output, 'wt') as outf:
-            for v2_item in f:
-                dt = datetime.fromtimestamp(v2_item['timestamp'] / 1e3)
-                timestamp_crawl = format_timestamp(dt)
-                assert v2_item['version'] == 2.0
-                v3_item = CDRItem(
-                    _id=format_id(v2_item['url'], timestamp_crawl),
-                    crawler=v2_item['crawler'],
-                    team=v2_item['team'],
-                    timestamp_crawl=timestamp_crawl,
-                    version=3.0,
-                    url=v2_item['url'],
-                    raw_content=v2_item['raw_content'],
-                    content_type=v2_item['content_type'],
-                    response_headers={'content-type': v2_item['content_type']},
-                )
-                outf.write(json.dumps(dict(v3_item)))
-                outf.write('\n')
+
+    inputs = _expand_inputs(args.inputs)
+    assert args.output not in inputs
+
+    lines = (line for path in inputs
+             for line, _ in jl_io.iter_lines(path, broken=args.broken))
+    batches = _batches(lines, args.batch_size)
+    convert = partial(convert_lines, broken=args.broken)
+    if args.workers > 1:
+        results = imap_fixed_output_buffer(
+            convert, batches, args.workers,
+            executor_cls=ProcessPoolExecutor,
+            ordered=not args.unordered)
+    else:
+        results = map(convert, batches)
+
+    if args.shards > 1:
+        paths = [jl_io.part_path(args.output, 'shard{}'.format(i))
+                 for i in range(args.shards)]
+    else:
+        paths = [args.output]
+    writers = [jl_io.JLWriter(path, level=args.compression_level,
+                              threads=args.compression_threads)
+               for path in paths]
+    n_items = 0
+    try:
+        for i, (data, n_batch_items) in enumerate(results):
+            writers[i % len(writers)].write(data)
+            n_items += n_batch_items
+    finally:
+        for writer in writers:
+            writer.close()
+    print('{:,} items converted to {}'.format(n_items, ', '.join(paths)))
+
+
+def _expand_inputs(patterns):
+    inputs = []
+    for pattern in patterns:
+        inputs.extend(sorted(glob.glob(pattern)) or [pattern])
+    return inputs
+
+
+def _batches(it, size):
+    it = iter(it)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+def convert_lines(lines, broken=False):
+    """ Convert a batch of raw CDRv2 lines into CDRv3,
+    returning serialized lines (bytes) and the number of items.
+    """
+    items = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            v2_item = json.loads(line.decode('utf8'))
+        except ValueError:
+            if not broken:
+                raise
+            continue
+        items.append(convert_item(v2_item))
+    return (b''.join(json_dumps_bytes(item) + b'\n' for item in items),
+            len(items))
+
+
+def convert_item(v2_item):
+    """ Convert a CDRv2 item into a CDRv3 item (a dict with CDRItem fields).
+    """
+    dt = datetime.fromtimestamp(v2_item['timestamp'] / 1e3)
+    timestamp_crawl = format_timestamp(dt)
+    if v2_item['version'] != 2.0:
+        raise ValueError('Expected a CDRv2 item, got version {}'
+                         .format(v2_item['version']))
+    return {
+        '_id': format_id(v2_item['url'], timestamp_crawl),
+        'crawler': v2_item['crawler'],
+        'team': v2_item['team'],
+        'timestamp_crawl': timestamp_crawl,
+        'version': 3.0,
+        'url': v2_item['url'],
+        'raw_content': v2_item['raw_content'],
+        'content_type': v2_item['content_type'],
+        'response_headers': {'content-type': v2_item['content_type']},
+    }
+
@@ -8,7 +8,6 @@ setup(
     install_requires=[
         'botocore',
         'cachetools',
-        'json_lines',
         'requests',
         'scrapy',
         'six',
@@ -22,6 +21,13 @@ setup(
         'kafka': [
             'kafka-python',
         ],
+        'async': [
+            'aiohttp',
+        ],
+        'compression': [
+            'zstandard',
+            'lz4',
+        ],
         ':python_version<"3.0"': ['futures'],
     },
     entry_points={
@@ -30,6 +36,8 @@ setup(
             'cdr-es-upload=scrapy_cdr.es_upload:main',
             'cdr-es-download=scrapy_cdr.es_download:main',
             'cdr-kafka-upload=scrapy_cdr.kafka_upload:main',
+            'cdr-kafka-to-es=scrapy_cdr.kafka_to_es:main',
+            'cdr-media-relayout=scrapy_cdr.media_relayout:main',
             ],
     },
     license='MIT license',
@@ -0,0 +1,153 @@
+import argparse
+import gzip
+from multiprocessing import Value
+import signal
+import sys
+
+import pytest
+
+from scrapy_cdr import es_download, jl_io
+from scrapy_cdr.es_download import (
+    _part_path, _merge, _download_slice, adaptive_chunk_size)
+from .test_es_upload import make_items
+
+
+def test_part_path():
+    assert _part_path('out.jl.gz', 3) == 'out.part3.jl.gz'
+    assert _part_path('dir/out.jl', 0) == 'dir/out.part0.jl'
+
+
+def test_merge_gzip(tmpdir):
+    paths = [str(tmpdir.join('out.part{}.jl.gz'.format(i))) for i in range(3)]
+    for i, path in enumerate(paths):
+        with gzip.open(path, 'wb') as f:
+            f.write('{{"part": {}}}\n'.format(i).encode('utf8'))
+    output = str(tmpdir.join('out.jl.gz'))
+    _merge(paths, output)
+    with gzip.open(output, 'rb') as f:
+        assert f.read() == b'{"part": 0}\n{"part": 1}\n{"part": 2}\n'
+    assert not any(tmpdir.join(p).exists() for p in paths)
+
+
+class FakeES:
+    def __init__(self, doc_size):
+        self.doc_size = doc_size
+
+    def search(self, index, body):
+        assert body['size'] == 20
+        return {'hits': {'hits': [
+            {'_source': {'raw_content': 'x' * self.doc_size}}] * 20}}
+
+
+def test_adaptive_chunk_size():
+    assert adaptive_chunk_size(FakeES(100), 'index', {}) == 5000
+    assert adaptive_chunk_size(FakeES(100000), 'index', {}) == 209
+    assert adaptive_chunk_size(FakeES(10**6), 'index', {}) == 100
+
+
+class FakeScrollES:
+    """ A stand-in for elasticsearch.Elasticsearch which serves docs
+    with sliced scrolls and _source filtering.
+    """
+    def __init__(self, docs):
+        self.docs = docs
+        self._scrolls = {}
+
+    def info(self):
+        return {}
+
+    def count(self, index, body, **kwargs):
+        return {'count': len(self.docs)}
+
+    def search(self, index, body, scroll=None, size=None, **kwargs):
+        assert index == 'index'
+        docs = self.docs
+        if 'slice' in body:
+            docs = docs[body['slice']['id']::body['slice']['max']]
+        hits = [{'_id': doc['_id'], '_source': _filter_source(
+            doc, body.get('_source', {}))} for doc in docs]
+        if scroll is None:  # a sample for adaptive_chunk_size
+            return {'hits': {'hits': hits[:body['size']]}}
+        scroll_id = str(len(self._scrolls))
+        self._scrolls[scroll_id] = (hits, size)
+        return self.scroll(scroll_id)
+
+    def scroll(self, scroll_id, **kwargs):
+        hits, size = self._scrolls[scroll_id]
+        self._scrolls[scroll_id] = (hits[size:], size)
+        return {'_scroll_id': scroll_id, 'hits': {'hits': hits[:size]},
+                '_shards': {'failed': 0, 'total': 1}}
+
+    def clear_scroll(self, body, **kwargs):
+        for scroll_id in body['scroll_id']:
+            del self._scrolls[scroll_id]
+
+
+def _filter_source(doc, source):
+    return {k: v for k, v in doc.items()
+            if k in source.get('includes', doc) and
+            k not in source.get('excludes', [])}
+
+
+DOCS = make_items(25)
+
+
+@pytest.fixture
+def fake_scroll_es(monkeypatch):
+    monkeypatch.setattr(es_download.elasticsearch, 'Elasticsearch',
+                        lambda hosts, **kwargs: FakeScrollES(DOCS))
+    # pool workers are stopped with SIGTERM, and would inherit
+    # the handler of the reactor running the tests
+    handler = signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    yield
+    signal.signal(signal.SIGTERM, handler)
+
+
+def run_main(monkeypatch, *args):
+    monkeypatch.setattr(
+        sys, 'argv', ['cdr-es-download'] + list(map(str, args)))
+    es_download.main()
+
+
+def test_download_slice(tmpdir, monkeypatch, fake_scroll_es):
+    monkeypatch.setattr(es_download, '_total', Value('l', 0))
+    args = argparse.Namespace(
+        index='index', host='localhost', user=None, password=None,
+        domain=None, id=None, fields=None, exclude_fields=None,
+        slices=3, chunk_size=4, compression_level=None,
+        compression_threads=1)
+    path = str(tmpdir.join('out.part1.jl.gz'))
+    assert _download_slice(args, 1, path) == 8
+    assert list(jl_io.iter_items(path)) == DOCS[1::3]
+    assert es_download._total.value == 8
+
+
+@pytest.mark.parametrize(['keep_parts'], [[False], [True]])
+def test_download_slices(tmpdir, monkeypatch, fake_scroll_es, keep_parts):
+    output = str(tmpdir.join('out.jl.gz'))
+    run_main(monkeypatch, output, 'index', '--slices', 3, '--chunk-size', 4,
+             *(['--keep-parts'] if keep_parts else []))
+    paths = [_part_path(output, i) for i in range(3)]
+    if keep_parts:
+        for i, path in enumerate(paths):
+            assert list(jl_io.iter_items(path)) == DOCS[i::3]
+        assert not tmpdir.join('out.jl.gz').exists()
+    else:
+        items = list(jl_io.iter_items(output))
+        assert sorted(item['_id'] for item in items) == sorted(
+            doc['_id'] for doc in DOCS)
+        assert items == DOCS[0::3] + DOCS[1::3] + DOCS[2::3]
+        assert tmpdir.listdir() == [tmpdir.join('out.jl.gz')]
+
+
+@pytest.mark.parametrize(['args', 'fields'], [
+    [['--fields', 'url,raw_content'], {'url', 'raw_content'}],
+    [['--exclude-fields', 'raw_content,metadata'],
+     {'_id', 'url', 'timestamp_crawl'}],
+])
+def test_download_fields(tmpdir, monkeypatch, fake_scroll_es, args, fields):
+    output = str(tmpdir.join('out.jl'))
+    run_main(monkeypatch, output, 'index', '--slices', 2, *args)
+    items = list(jl_io.iter_items(output))
+    assert len(items) == len(DOCS)
+    assert all(set(item) == fields for item in items)
@@ -0,0 +1,38 @@
+import hashlib
+
+from scrapy_cdr.es_download_hashes import _hash_row, _source_fields
+
+
+class FakeES:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def get(self, index, doc_type, id, _source_include):
+        assert _source_include == 'raw_content'
+        return {'_source': {'raw_content': self.docs[id]['raw_content']}}
+
+
+def make_hit(id_, **source):
+    source.update(timestamp_crawl='2017-02-15T20:30:59Z', team='team',
+                  url='http://example.com/{}'.format(id_))
+    return {'_index': 'index', '_type': 'document', '_id': id_,
+            '_source': source}
+
+
+def test_hash_row():
+    sha1 = hashlib.sha1(b'content').hexdigest()
+    row = _hash_row(make_hit('a', raw_content='content'), client=None)
+    assert row == ['2017-02-15T20:30:59Z', sha1, 'team',
+                   'http://example.com/a', 'http://example.com/a']
+    assert _hash_row(make_hit('a', raw_content=None), client=None)[1] == \
+        hashlib.sha1(b'').hexdigest()
+
+
+def test_hash_row_hash_field():
+    assert _source_fields('content_sha1') == [
+        'timestamp_crawl', 'team', 'url', 'content_sha1']
+    client = FakeES({'b': {'raw_content': 'content'}})
+    assert _hash_row(make_hit('a', content_sha1='abc'), client,
+                     hash_field='content_sha1')[1] == 'abc'
+    assert _hash_row(make_hit('b'), client, hash_field='content_sha1')[1] == \
+        hashlib.sha1(b'content').hexdigest()
@@ -0,0 +1,139 @@
+import json
+import threading
+import time
+
+from scrapy.utils.test import get_crawler
+from twisted.internet.defer import Deferred
+
+from scrapy_cdr import es_pipeline
+from scrapy_cdr.es_pipeline import CDRElasticsearchPipeline
+from .test_es_upload import (
+    fake_es, make_items, kwargs_serializer, FakeES, RejectingES)
+from .utils import inlineCallbacks
+
+
+def make_pipeline(**settings):
+    crawler = get_crawler(settings_dict=dict(
+        CDR_ES_HOST='localhost', CDR_ES_INDEX='index', **settings))
+    return CDRElasticsearchPipeline.from_crawler(crawler), crawler.stats
+
+
+@inlineCallbacks
+def test_es_pipeline(fake_es):
+    pipeline, stats = make_pipeline(
+        CDR_ES_CHUNK_SIZE=10, CDR_ES_MAX_IN_FLIGHT=1)
+    pipeline.open_spider(spider=None)
+    items = make_items(25)
+    n_waited = 0
+    for item in items:
+        result = pipeline.process_item(dict(item), spider=None)
+        if isinstance(result, Deferred):  # backpressure
+            n_waited += 1
+            result = yield result
+        assert result['_id'] == item['_id']
+        assert pipeline.n_in_flight <= 1
+    # the first chunk is sent at once, the second one after the first
+    assert n_waited == 1
+    yield pipeline.close_spider(spider=None)
+    client, = fake_es
+    assert len(client.docs) == 25
+    assert client.n_requests == 3
+    doc = client.docs['ID7']
+    assert 'timestamp_index' in doc
+    assert 'metadata' not in doc
+    assert doc['raw_content'] == 'content 7'
+    assert doc['url'] == 'http://example.com/7'
+    assert stats.get_value('es_pipeline/created') == 25
+
+
+@inlineCallbacks
+def test_es_pipeline_retry(monkeypatch):
+    client = RejectingES({'ID3': 2, 'ID5': 10}, **kwargs_serializer())
+    monkeypatch.setattr(es_pipeline.elasticsearch, 'Elasticsearch',
+                        lambda hosts, **kwargs: client)
+    pipeline, stats = make_pipeline(
+        CDR_ES_CHUNK_SIZE=4, CDR_ES_MAX_RETRIES=3,
+        CDR_ES_RETRY_BACKOFF=0.01, CDR_ES_FLUSH_INTERVAL=0.05)
+    pipeline.open_spider(spider=None)
+    for item in make_items(10):
+        yield pipeline.process_item(item, spider=None)
+    yield pipeline.close_spider(spider=None)
+    assert set(client.docs) == {'ID{}'.format(i) for i in range(10)} - {'ID5'}
+    assert stats.get_value('es_pipeline/created') == 9
+    assert stats.get_value('es_pipeline/retried') == 5
+    assert stats.get_value('es_pipeline/failed') == 1
+
+
+class SlowES(FakeES):
+    """ Takes some time to process bulk requests, recording
+    the maximum number of concurrent requests.
+    """
+    def __init__(self, **kwargs):
+        super(SlowES, self).__init__(**kwargs)
+        self.n_concurrent = self.max_concurrent = 0
+        self._lock = threading.Lock()
+
+    def bulk(self, body, **kwargs):
+        with self._lock:
+            self.n_concurrent += 1
+            self.max_concurrent = max(self.max_concurrent, self.n_concurrent)
+        time.sleep(0.02)
+        try:
+            return super(SlowES, self).bulk(body, **kwargs)
+        finally:
+            with self._lock:
+                self.n_concurrent -= 1
+
+
+@inlineCallbacks
+def test_es_pipeline_bounded(monkeypatch):
+    client = SlowES(**kwargs_serializer())
+    monkeypatch.setattr(es_pipeline.elasticsearch, 'Elasticsearch',
+                        lambda hosts, **kwargs: client)
+    pipeline, stats = make_pipeline(
+        CDR_ES_CHUNK_SIZE=3, CDR_ES_MAX_IN_FLIGHT=2)
+    pipeline.open_spider(spider=None)
+    results = [pipeline.process_item(item, spider=None)
+               for item in make_items(30)]
+    # items are not waited for, but chunks are not sent all at once
+    assert pipeline.n_in_flight == 2
+    assert sum(isinstance(r, Deferred) for r in results) == 30 - 6 - 2
+    for result in results:
+        yield result
+    yield pipeline.close_spider(spider=None)
+    assert len(client.docs) == 30
+    assert client.n_requests == 10
+    assert client.max_concurrent <= 2
+    assert stats.get_value('es_pipeline/created') == 30
+
+
+class BrokenES(FakeES):
+    def bulk(self, body, **kwargs):
+        raise RuntimeError('broken')
+
+
+@inlineCallbacks
+def test_es_pipeline_errors(monkeypatch):
+    client = BrokenES(**kwargs_serializer())
+    monkeypatch.setattr(es_pipeline.elasticsearch, 'Elasticsearch',
+                        lambda hosts, **kwargs: client)
+    pipeline, stats = make_pipeline(CDR_ES_CHUNK_SIZE=4)
+    pipeline.open_spider(spider=None)
+    for item in make_items(10):
+        yield pipeline.process_item(item, spider=None)
+    yield pipeline.close_spider(spider=None)
+    assert stats.get_value('es_pipeline/errors') == 3
+    assert stats.get_value('es_pipeline/failed') == 10
+
+
+def test_with_fields():
+    fields = b'{"timestamp_index":"2017-01-01T00:00:00Z"}'
+    for source, expected in [
+            (b'{"url":"u"}', {'url': 'u'}), (b'{}', {}), (b'{ }', {})]:
+        body = es_pipeline._with_fields(b'{"index":{}}\n' + source + b'\n',
+                                        fields)
+        action, doc, end = body.split(b'\n')
+        assert action == b'{"index":{}}'
+        assert end == b''
+        expected['timestamp_index'] = '2017-01-01T00:00:00Z'
+        assert json.loads(doc.decode('utf8')) == expected
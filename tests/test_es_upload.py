@@ -0,0 +1,353 @@
+import gzip
+import json
+import sys
+import threading
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+from elasticsearch.serializer import JSONSerializer
+
+from scrapy_cdr import es_upload
+
+
+class FakeTransport:
+    def __init__(self, client, serializer):
+        self.client = client
+        self.serializer = serializer
+
+    def perform_request(self, method, url, params=None, body=None):
+        assert (method, url) == ('POST', '/_bulk')
+        return self.client.bulk(self.serializer.dumps(body))
+
+
+class FakeES:
+    """ A stand-in for elasticsearch.Elasticsearch which indexes
+    bulk requests into a dict.
+    """
+    def __init__(self, serializer=None, **kwargs):
+        self.transport = FakeTransport(self, serializer or JSONSerializer())
+        self.docs = {}
+        self.n_requests = 0
+
+    def info(self):
+        return {}
+
+    def bulk(self, body, **kwargs):
+        self.n_requests += 1
+        if isinstance(body, bytes):
+            body = body.decode('utf8')
+        lines = iter(body.splitlines())
+        items = []
+        for line in lines:
+            (op_type, meta), = json.loads(line).items()
+            if op_type != 'delete':
+                self.docs[meta['_id']] = json.loads(next(lines))
+            else:
+                self.docs.pop(meta['_id'], None)
+            items.append({op_type: {
+                '_id': meta['_id'], 'status': 201, 'result': 'created'}})
+        return {'items': items}
+
+
+@pytest.fixture
+def fake_es(monkeypatch):
+    clients = []
+
+    def make_client(hosts, serializer=None, **kwargs):
+        clients.append(FakeES(serializer=serializer))
+        return clients[-1]
+
+    monkeypatch.setattr(es_upload.elasticsearch, 'Elasticsearch', make_client)
+    yield clients
+
+
+def make_items(n):
+    return [{'_id': 'ID{}'.format(i),
+             'url': 'http://example.com/{}'.format(i),
+             'timestamp_crawl': '2017-02-15T20:30:59Z',
+             'raw_content': 'content {}'.format(i),
+             'metadata': {'depth': 1},
+             } for i in range(n)]
+
+
+def write_jl_gz(path, items):
+    with gzip.open(str(path), 'wt') as f:
+        for item in items:
+            f.write(json.dumps(item))
+            f.write('\n')
+
+
+def run_main(monkeypatch, *args):
+    monkeypatch.setattr(sys, 'argv', ['cdr-es-upload'] + list(map(str, args)))
+    es_upload.main()
+
+
+@pytest.mark.parametrize(['extra_args'], [
+    [[]],
+    [['--parse-workers', '2', '--parse-chunk-size', '7']],
+])
+def test_upload(tmpdir, monkeypatch, fake_es, extra_args):
+    items = make_items(50)
+    write_jl_gz(tmpdir.join('items.jl.gz'), items[:30])
+    write_jl_gz(tmpdir.join('items2.jl.gz'), items[30:])
+    run_main(monkeypatch, tmpdir.join('items.jl.gz'),
+             tmpdir.join('items2.jl.gz'), 'index',
+             '--chunk-size', '10', *extra_args)
+    client, = fake_es
+    assert len(client.docs) == 50
+    assert client.n_requests == 5
+    doc = client.docs['ID7']
+    assert 'timestamp_index' in doc
+    assert 'metadata' not in doc
+    assert doc['raw_content'] == 'content 7'
+
+
+@pytest.mark.parametrize(['extra_args'], [
+    [[]], [['--parse-workers', '2', '--parse-chunk-size', '3']]])
+def test_upload_reverse_domain_storage(
+        tmpdir, monkeypatch, fake_es, extra_args):
+    media_root = tmpdir.join('media').ensure(dir=True)
+    items = make_items(10)
+    for i, item in enumerate(items):
+        media_root.join('{}.jpg'.format(i)).write('{}'.format(i))
+        item['objects'] = [{
+            'obj_original_url': 'http://img{}.example.com/1.jpg'.format(i),
+            'obj_stored_url': '{}.jpg'.format(i),
+        }]
+    write_jl_gz(tmpdir.join('items.jl.gz'), items)
+    run_main(monkeypatch, tmpdir.join('items.jl.gz'), 'index',
+             '--reverse-domain-storage', '--media-root', media_root,
+             '--reverse-domain-mode', 'hardlink', *extra_args)
+    client, = fake_es
+    for i in range(10):
+        stored_url = 'com/example/img{}/{}'.format(i, i)
+        assert client.docs['ID{}'.format(i)]['objects'][0][
+            'obj_stored_url'] == stored_url
+        assert media_root.join(stored_url).read() == str(i)
+
+
+@pytest.mark.parametrize(['extra_args'], [
+    [[]], [['--parse-workers', '2', '--parse-chunk-size', '3']]])
+def test_upload_reverse_domain_storage_missing(
+        tmpdir, monkeypatch, fake_es, extra_args):
+    media_root = tmpdir.join('media').ensure(dir=True)
+    items = make_items(10)
+    for i, item in enumerate(items):
+        if i != 5:
+            media_root.join('{}.jpg'.format(i)).write('{}'.format(i))
+        item['objects'] = [{
+            'obj_original_url': 'http://img{}.example.com/1.jpg'.format(i),
+            'obj_stored_url': '{}.jpg'.format(i),
+        }]
+    write_jl_gz(tmpdir.join('items.jl.gz'), items)
+    with pytest.raises(SystemExit) as e:
+        run_main(monkeypatch, tmpdir.join('items.jl.gz'), 'index',
+                 '--reverse-domain-storage', '--media-root', media_root,
+                 '--reverse-domain-mode', 'hardlink', *extra_args)
+    assert e.value.code == 1
+    client, = fake_es
+    assert len(client.docs) == 10
+
+
+def test_parse_lines():
+    args = es_upload.argparse.Namespace(
+        format='CDRv3', reverse_domain_storage=False, op_type='index',
+        index='index', type='document', broken=True)
+    lines = [json.dumps(item).encode('utf8') for item in make_items(2)]
+    lines.append(b'{"broken')
+    actions, relayout_counts = es_upload._parse_lines(
+        [(line, i) for i, line in enumerate(lines)], args)
+    assert relayout_counts is None
+    assert [position for _, position in actions] == [0, 1]
+    action, data, end = actions[1][0].split(b'\n')
+    assert json.loads(action.decode('utf8')) == {'index': {
+        '_index': 'index', '_type': 'document', '_id': 'ID1'}}
+    assert json.loads(data.decode('utf8'))['url'] == 'http://example.com/1'
+    assert end == b''
+
+
+class FailingES(FakeES):
+    def __init__(self, fail_after, **kwargs):
+        super(FailingES, self).__init__(**kwargs)
+        self.fail_after = fail_after
+
+    def bulk(self, body, **kwargs):
+        if self.n_requests == self.fail_after:
+            raise es_upload.elasticsearch.ConnectionError('N/A', 'down', None)
+        return super(FailingES, self).bulk(body, **kwargs)
+
+
+def test_checkpoint(tmpdir, monkeypatch):
+    items = make_items(50)
+    inputs = [tmpdir.join('items.jl.gz'), tmpdir.join('items2.jl')]
+    write_jl_gz(inputs[0], items[:30])
+    with inputs[1].open('wt') as f:
+        f.write(''.join(json.dumps(item) + '\n' for item in items[30:]))
+    checkpoint = tmpdir.join('checkpoint.json')
+    args = inputs + ['index', '--chunk-size', '10', '--threads', '1',
+                     '--max-retries', '0',
+                     '--checkpoint', checkpoint]
+
+    failing_client = FailingES(fail_after=4, **kwargs_serializer())
+    monkeypatch.setattr(es_upload.elasticsearch, 'Elasticsearch',
+                        lambda hosts, **kwargs: failing_client)
+    with pytest.raises(SystemExit):
+        run_main(monkeypatch, *args)
+    assert len(failing_client.docs) == 40
+    positions = json.loads(checkpoint.read())
+    assert positions[str(inputs[0])]['eof']
+    assert positions[str(inputs[1])]['line'] == 10
+
+    client = FakeES(**kwargs_serializer())
+    monkeypatch.setattr(es_upload.elasticsearch, 'Elasticsearch',
+                        lambda hosts, **kwargs: client)
+    run_main(monkeypatch, *args)
+    assert sorted(client.docs) == sorted(
+        item['_id'] for item in items[40:])
+    run_main(monkeypatch, *args)
+    assert client.n_requests == 1
+
+
+class RejectingES(FakeES):
+    """ Rejects documents with given ids a given number of times.
+    """
+    def __init__(self, rejections, **kwargs):
+        super(RejectingES, self).__init__(**kwargs)
+        self.rejections = rejections
+
+    def bulk(self, body, **kwargs):
+        resp = super(RejectingES, self).bulk(body, **kwargs)
+        for item in resp['items']:
+            info = item['index']
+            if self.rejections.get(info['_id']):
+                self.rejections[info['_id']] -= 1
+                del self.docs[info['_id']]
+                info.update(status=429, error='es_rejected_execution_exception')
+                del info['result']
+        return resp
+
+
+def test_retry(tmpdir, monkeypatch):
+    items = make_items(20)
+    write_jl_gz(tmpdir.join('items.jl.gz'), items)
+    client = RejectingES({'ID3': 2, 'ID5': 10}, **kwargs_serializer())
+    monkeypatch.setattr(es_upload.elasticsearch, 'Elasticsearch',
+                        lambda hosts, **kwargs: client)
+    dead_letter = tmpdir.join('failed.jl.gz')
+    checkpoint = tmpdir.join('checkpoint.json')
+    with pytest.raises(SystemExit):
+        run_main(monkeypatch, tmpdir.join('items.jl.gz'), 'index',
+                 '--chunk-size', '4', '--max-retries', '3',
+                 '--retry-backoff', '0.01', '--dead-letter', dead_letter,
+                 '--checkpoint', checkpoint)
+    assert sorted(client.docs) == sorted(
+        item['_id'] for item in items if item['_id'] != 'ID5')
+    with gzip.open(str(dead_letter), 'rt') as f:
+        failed, = [json.loads(line) for line in f]
+    assert failed['_id'] == 'ID5'
+    assert failed['url'] == items[5]['url']
+    assert json.loads(checkpoint.read())[
+        str(tmpdir.join('items.jl.gz'))]['eof']
+
+
+def test_adaptive_controller():
+    controller = es_upload.AdaptiveController(
+        max_chunk_bytes=4 * 2**20, max_in_flight=4, target_latency=10)
+    assert (controller.max_in_flight, controller.max_chunk_bytes) == (1, 2**20)
+    for _ in range(20):
+        controller.record(latency=1, n_bytes=controller.max_chunk_bytes,
+                          n_rejected=0)
+    assert (controller.max_in_flight, controller.max_chunk_bytes) == (
+        4, 4 * 2**20)
+    controller.record(latency=1, n_bytes=2**20, n_rejected=3)
+    assert (controller.max_in_flight, controller.max_chunk_bytes) == (
+        2, 2 * 2**20)
+    # was sent before the decrease
+    controller.record(latency=1, n_bytes=2**20, n_rejected=1)
+    assert (controller.max_in_flight, controller.max_chunk_bytes) == (
+        2, 2 * 2**20)
+    controller._decreased_at -= 100
+    controller.record(latency=20, n_bytes=2**20, n_rejected=0)
+    assert (controller.max_in_flight, controller.max_chunk_bytes) == (
+        2, 2**20)
+
+
+def test_upload_adaptive(tmpdir, monkeypatch):
+    items = make_items(200)
+    write_jl_gz(tmpdir.join('items.jl.gz'), items)
+    client = RejectingES({'ID{}'.format(i): 1 for i in range(0, 200, 30)},
+                         **kwargs_serializer())
+    monkeypatch.setattr(es_upload.elasticsearch, 'Elasticsearch',
+                        lambda hosts, **kwargs: client)
+    run_main(monkeypatch, tmpdir.join('items.jl.gz'), 'index',
+             '--adaptive', '--chunk-size', '10000',
+             '--retry-backoff', '0.01')
+    assert len(client.docs) == 200
+
+
+class ESHandler(BaseHTTPRequestHandler):
+    """ Serves FakeES over HTTP.
+    """
+    def do_GET(self):
+        self._respond(200, {})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self._respond(200, self.server.es.bulk(body))
+
+    def _respond(self, status, data):
+        data = json.dumps(data).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def es_server():
+    server = HTTPServer(('127.0.0.1', 0), ESHandler)
+    server.es = FakeES()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize(['engine'], [['threads'], ['async']])
+def test_upload_http(tmpdir, monkeypatch, es_server, engine):
+    items = make_items(100)
+    write_jl_gz(tmpdir.join('items.jl.gz'), items)
+    run_main(monkeypatch, tmpdir.join('items.jl.gz'), 'index',
+             '--host', '127.0.0.1:{}'.format(es_server.server_port),
+             '--engine', engine, '--threads', '20', '--chunk-size', '3')
+    assert len(es_server.es.docs) == 100
+    assert es_server.es.n_requests == 34
+
+
+def kwargs_serializer():
+    return {'serializer': es_upload.BulkJSONSerializer()}
+
+
+def test_chunk_actions():
+    bodies = [b'a' * 10, b'b' * 5, b'c' * 20, b'd', b'e', b'f', b'g']
+    chunks = es_upload._chunk_actions(enumerate(bodies), 3, 16)
+    assert [[i for i, _ in chunk] for chunk in chunks] == [
+        [0, 1], [2], [3, 4, 5], [6]]
+
+
+def test_serialize_action():
+    body = es_upload.serialize_action({
+        '_op_type': 'index', '_index': 'i', '_type': 't', '_id': '1',
+        '_source': {'raw_content': u'\u043f\u0440\u0438\u0432\u0435\u0442'},
+    })
+    action, data, _ = body.split(b'\n')
+    assert json.loads(data.decode('utf8')) == {
+        'raw_content': u'\u043f\u0440\u0438\u0432\u0435\u0442'}
+    assert es_upload.serialize_action(
+        {'_op_type': 'delete', '_id': '1'}).count(b'\n') == 1
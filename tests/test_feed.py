@@ -0,0 +1,121 @@
+import io
+import json
+import threading
+
+import pytest
+from scrapy.http.headers import Headers
+from scrapy.http.response.text import TextResponse
+from scrapy.utils.test import get_crawler
+from twisted.internet.defer import Deferred
+
+from scrapy_cdr import jl_io, text_cdr_item
+from scrapy_cdr.feed import CDRFeedExporter, JsonLinesItemExporter
+from scrapy_cdr.utils import media_cdr_item
+from .utils import inlineCallbacks
+
+
+def make_item(i, **kwargs):
+    response = TextResponse(
+        url='http://example.com/{}'.format(i),
+        headers={'Content-Type': 'text/html'},
+        body='élève {}'.format(i).encode('utf8'), encoding='utf8')
+    return text_cdr_item(
+        response, crawler_name='crawler', team_name='team',
+        objects=[media_cdr_item('http://example.com/1.png', 'ABCD',
+                                Headers({'Content-Type': 'image/png'}))],
+        **kwargs)
+
+
+def test_json_lines_exporter():
+    f = io.BytesIO()
+    exporter = JsonLinesItemExporter(f)
+    exporter.start_exporting()
+    exporter.export_item(make_item(0))
+    exporter.export_item(make_item(1, raw_bytes=True))
+    exporter.finish_exporting()
+    items = [json.loads(line) for line in f.getvalue().decode('utf8')
+             .splitlines()]
+    assert [item['raw_content'] for item in items] == ['élève 0', 'élève 1']
+    assert 'raw_content_encoding' not in items[1]
+    assert items[0]['objects'][0]['obj_stored_url'] == 'ABCD'
+
+
+@inlineCallbacks
+@pytest.mark.parametrize(['max_items'], [[0], [3]])
+def test_feed_exporter(tmpdir, max_items):
+    path = str(tmpdir.join('items.jl.gz'))
+    crawler = get_crawler(settings_dict={
+        'CDR_FEED_PATH': path,
+        'CDR_FEED_MAX_ITEMS': max_items,
+        'CDR_FEED_QUEUE_SIZE': 2,
+    })
+    ext = CDRFeedExporter.from_crawler(crawler)
+    ext.spider_opened(spider=None)
+    for i in range(10):
+        ext.item_scraped(make_item(i, raw_bytes=i % 2), spider=None)
+    yield ext.spider_closed(spider=None)
+    if max_items:
+        paths = [jl_io.part_path(path, 'part{}'.format(i)) for i in range(4)]
+    else:
+        paths = [path]
+    assert ext.writer.paths == paths
+    urls = [item['url'] for p in paths for item in jl_io.iter_items(p)]
+    assert urls == ['http://example.com/{}'.format(i) for i in range(10)]
+    items = list(jl_io.iter_items(paths[-1]))
+    assert items[-1]['raw_content'] == 'élève 9'
+
+
+@inlineCallbacks
+def test_feed_exporter_backpressure(tmpdir):
+    crawler = get_crawler(settings_dict={
+        'CDR_FEED_PATH': str(tmpdir.join('items.jl')),
+        'CDR_FEED_QUEUE_SIZE': 1,
+    })
+    ext = CDRFeedExporter.from_crawler(crawler)
+    can_write = threading.Event()
+    write = ext.writer.write
+
+    def slow_write(line):
+        can_write.wait()
+        write(line)
+
+    ext.writer.write = slow_write
+    ext.spider_opened(spider=None)
+    results = [ext.item_scraped(make_item(i), spider=None) for i in range(5)]
+    # the reactor is not blocked while the writer is stuck
+    waiting = [d for d in results if isinstance(d, Deferred)]
+    assert len(waiting) >= 3
+    assert not any(d.called for d in waiting)
+    can_write.set()
+    for d in waiting:
+        yield d
+    yield ext.spider_closed(spider=None)
+    urls = [item['url'] for item in jl_io.iter_items(ext.writer.path)]
+    assert urls == ['http://example.com/{}'.format(i) for i in range(5)]
+    assert crawler.stats.get_value('cdr_feed/written') == 5
+    assert crawler.stats.get_value('cdr_feed/dropped') == 0
+
+
+@inlineCallbacks
+def test_feed_exporter_write_error(tmpdir, caplog):
+    crawler = get_crawler(settings_dict={
+        'CDR_FEED_PATH': str(tmpdir.join('items.jl')),
+    })
+    ext = CDRFeedExporter.from_crawler(crawler)
+    write = ext.writer.write
+
+    def failing_write(line):
+        if ext.writer.n_items == 3:
+            raise OSError('No space left on device')
+        write(line)
+
+    ext.writer.write = failing_write
+    ext.spider_opened(spider=None)
+    for i in range(10):
+        ext.item_scraped(make_item(i), spider=None)
+    yield ext.spider_closed(spider=None)
+    assert len(list(jl_io.iter_items(ext.writer.path))) == 3
+    assert crawler.stats.get_value('cdr_feed/written') == 3
+    assert crawler.stats.get_value('cdr_feed/dropped') == 7
+    assert any(r.levelname == 'ERROR' and '7 items were not written' in
+               r.getMessage() for r in caplog.records)
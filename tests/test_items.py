@@ -1,9 +1,12 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+import hashlib
 
 from scrapy.http.headers import Headers
 from scrapy.http.response.text import TextResponse
 
-from scrapy_cdr.utils import text_cdr_item, media_cdr_item
+from scrapy_cdr.utils import (
+    text_cdr_item, media_cdr_item, headers_to_dict, timestamp_now,
+    decode_raw_content)
 
 
 def test_text_cdr_item():
@@ -50,3 +53,58 @@ def test_media_cdr_item():
         'response_headers': {'content-type': 'image/png',
                              'another-header': 'another_value'},
     }
+
+
+def test_text_cdr_item_dict():
+    response = TextResponse(
+        url='http://example.com', body=b'a body', encoding='utf8')
+    item = text_cdr_item(response, crawler_name='crawler', team_name='team',
+                         item_cls=dict)
+    assert type(item) is dict
+    assert item['raw_content'] == 'a body'
+    check_timestamp_crawl(item)
+
+
+def test_timestamp_now():
+    before = datetime.utcnow()
+    timestamp = timestamp_now()
+    after = datetime.utcnow()
+    eps = timedelta(milliseconds=1)  # rounding differs from datetime
+    assert before - eps <= datetime.strptime(
+        timestamp, '%Y-%m-%dT%H:%M:%S.%fZ') <= after + eps
+
+
+def test_headers_to_dict():
+    headers = Headers({'Content-Type': 'text/plain',
+                       'Set-Cookie': ['a=1', 'b=2'],
+                       'X-Thing': 'élève'})
+    assert headers_to_dict(headers) == headers.to_unicode_dict()
+
+
+def test_text_cdr_item_raw_bytes():
+    body = 'élève'.encode('cp1251', 'ignore') + 'тест'.encode('cp1251')
+    response = TextResponse(
+        url='http://example.com', body=body, encoding='cp1251')
+    text_item = text_cdr_item(
+        response, crawler_name='crawler', team_name='team',
+        content_hash=True)
+    item = text_cdr_item(
+        response, crawler_name='crawler', team_name='team',
+        raw_bytes=True, content_hash=True)
+    assert item['raw_content'] is response.body
+    assert item['raw_content_encoding'] == 'cp1251'
+    assert item['raw_content_hash'] == text_item['raw_content_hash'] == \
+        hashlib.sha1(response.text.encode('utf8')).hexdigest()
+    decode_raw_content(item)
+    assert item['raw_content'] == response.text
+    assert 'raw_content_encoding' not in item
+
+    response = TextResponse(
+        url='http://example.com', body='тест'.encode('utf8'),
+        encoding='utf8')
+    item = text_cdr_item(
+        response, crawler_name='crawler', team_name='team',
+        raw_bytes=True, content_hash=True)
+    assert item['raw_content_hash'] == \
+        hashlib.sha1(response.text.encode('utf8')).hexdigest()
+    assert decode_raw_content(item)['raw_content'] == 'тест'
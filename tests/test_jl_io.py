@@ -0,0 +1,125 @@
+import gzip
+from itertools import islice
+import random
+
+import pytest
+
+from scrapy_cdr import jl_io
+
+
+LINES = [('{{"i": {}, "x": "{}"}}\n'.format(i, 'y' * (i * 7 % 3000)))
+         .encode('utf8') for i in range(2000)]
+
+
+def write_multi_member_gzip(path, data, seed=1):
+    rng = random.Random(seed)
+    with open(path, 'wb') as f:
+        pos = 0
+        while pos < len(data):
+            size = rng.randint(1, 200000)
+            f.write(gzip.compress(data[pos:pos + size]))
+            pos += size
+
+
+def skip_if_unsupported(filename):
+    if filename.endswith('.zst'):
+        pytest.importorskip('zstandard')
+    if filename.endswith('.lz4'):
+        pytest.importorskip('lz4.frame')
+
+
+@pytest.mark.parametrize(['filename'], [
+    ['items.jl'], ['items.jl.gz'], ['items-multi.jl.gz'],
+    ['items-writer.jl.gz'], ['items-writer.jl.zst'],
+    ['items-writer.jl.lz4']])
+def test_iter_lines_resume(tmpdir, filename):
+    skip_if_unsupported(filename)
+    path = str(tmpdir.join(filename))
+    data = b''.join(LINES)
+    if 'multi' in filename:
+        write_multi_member_gzip(path, data)
+    elif 'writer' in filename:
+        with jl_io.JLWriter(path, threads=3, block_size=100000) as writer:
+            for line in LINES:
+                writer.write(line)
+    else:
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(path, 'wb') as f:
+            f.write(data)
+    result = list(jl_io.iter_lines(path))
+    assert [line for line, _ in result] == LINES
+    assert [p.eof for _, p in result[-2:]] == [False, True]
+    for n in [1, 500, 1999]:
+        start = result[n - 1][1]
+        rest = list(jl_io.iter_lines(path, start=dict(start._asdict())))
+        assert [line for line, _ in rest] == LINES[n:]
+        assert [p.line for _, p in rest[:1]] == [n + 1][:len(rest)]
+
+
+def check_resume_everywhere(path, lines):
+    result = list(jl_io.iter_lines(path))
+    assert [line for line, _ in result] == lines
+    for n, (_, start) in enumerate(result, 1):
+        rest = list(islice(jl_io.iter_lines(path, start=start), 2))
+        assert rest == result[n:n + 2]
+
+
+def test_iter_lines_resume_large_members(tmpdir):
+    # members decompress into many READ_SIZE chunks
+    path = str(tmpdir.join('items.jl.gz'))
+    lines = [('{{"i": {}, "x": "{}"}}\n'.format(i, 'a' * 20000))
+             .encode('utf8') for i in range(400)]
+    with jl_io.JLWriter(path, block_size=2 * 2**20) as writer:
+        for line in lines:
+            writer.write(line)
+    check_resume_everywhere(path, lines)
+
+
+def test_iter_lines_resume_small_reads(tmpdir, monkeypatch):
+    monkeypatch.setattr(jl_io, 'READ_SIZE', 37)
+    path = str(tmpdir.join('items.jl.gz'))
+    lines = LINES[:200]
+    rng = random.Random(2)
+    with open(path, 'wb') as f:
+        for i in range(0, len(lines), 7):
+            f.write(gzip.compress(b''.join(lines[i:i + 7])))
+            f.write(b'\x00' * rng.randint(0, 3))
+    check_resume_everywhere(path, lines)
+
+
+def test_iter_lines_broken(tmpdir):
+    path = str(tmpdir.join('items.jl.gz'))
+    with open(path, 'wb') as f:
+        f.write(gzip.compress(b''.join(LINES))[:-5000])
+    with pytest.raises(EOFError):
+        list(jl_io.iter_lines(path))
+    lines = [line for line, _ in jl_io.iter_lines(path, broken=True)]
+    assert 0 < len(lines) < len(LINES)
+    assert lines == LINES[:len(lines) - 1] + [lines[-1]]
+
+
+@pytest.mark.parametrize(['filename', 'threads'], [
+    ['items.jl', 1], ['items.jl.gz', 1], ['items.jl.gz', 4],
+    ['items.jl.zst', 4], ['items.jl.lz4', 2]])
+def test_writer(tmpdir, filename, threads):
+    skip_if_unsupported(filename)
+    path = str(tmpdir.join(filename))
+    items = [{'i': i, 'text': u'\u043f' * i} for i in range(1000)]
+    with jl_io.JLWriter(path, level=1, threads=threads,
+                        block_size=3000) as writer:
+        for item in items:
+            writer.write_item(item)
+    assert list(jl_io.iter_items(path)) == items
+    if filename.endswith('.gz'):
+        with gzip.open(path, 'rb') as f:
+            assert f.read() == b''.join(line for line, _ in
+                                        jl_io.iter_lines(path))
+
+
+def test_iter_items_broken(tmpdir):
+    path = str(tmpdir.join('items.jl'))
+    with open(path, 'wb') as f:
+        f.write(b'{"a": 1}\n\n{"a": 2}\n{"a"')
+    with pytest.raises(ValueError):
+        list(jl_io.iter_items(path))
+    assert list(jl_io.iter_items(path, broken=True)) == [{'a': 1}, {'a': 2}]
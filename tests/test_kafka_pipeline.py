@@ -0,0 +1,115 @@
+import json
+import threading
+
+from kafka.errors import KafkaTimeoutError, MessageSizeTooLargeError
+from scrapy.http import TextResponse
+from scrapy.utils.test import get_crawler
+from twisted.internet.defer import Deferred
+
+from scrapy_cdr import kafka_pipeline
+from scrapy_cdr.kafka_pipeline import CDRKafkaPipeline
+from scrapy_cdr.utils import text_cdr_item
+from .test_kafka_upload import FakeProducer
+from .utils import inlineCallbacks
+
+
+class LingeringProducer(FakeProducer):
+    """ Delivers messages shortly after they are sent, like a producer
+    with linger_ms set.
+    """
+    def __init__(self, *args, **kwargs):
+        super(LingeringProducer, self).__init__(*args, **kwargs)
+        self.closed = False
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def send(self, topic, value, **kwargs):
+        with self._lock:
+            future = super(LingeringProducer, self).send(
+                topic, value, **kwargs)
+            if self._timer is None:
+                self._timer = threading.Timer(0.01, self.flush)
+                self._timer.start()
+        return future
+
+    def flush(self):
+        with self._lock:
+            self._timer = None
+            self._deliver()
+
+    def close(self):
+        self.closed = True
+
+
+def make_items(n):
+    return [text_cdr_item(
+        TextResponse(url='http://example.com/{}'.format(i),
+                     body='content {}'.format(i).encode('utf8'),
+                     encoding='utf8'),
+        crawler_name='crawler', team_name='team', raw_bytes=True)
+        for i in range(n)]
+
+
+def make_pipeline(monkeypatch, producer, **settings):
+    monkeypatch.setattr(kafka_pipeline, 'KafkaProducer',
+                        lambda **kwargs: producer)
+    crawler = get_crawler(settings_dict=dict(
+        CDR_KAFKA_TOPIC='topic', **settings))
+    return CDRKafkaPipeline.from_crawler(crawler), crawler.stats
+
+
+@inlineCallbacks
+def test_kafka_pipeline(monkeypatch):
+    items = make_items(50)
+    producer = LingeringProducer(failures={
+        items[3]['url']: KafkaTimeoutError,
+        items[7]['url']: MessageSizeTooLargeError,
+    })
+    pipeline, stats = make_pipeline(
+        monkeypatch, producer,
+        CDR_KAFKA_MAX_IN_FLIGHT=5, CDR_KAFKA_KEY='_id',
+        CDR_KAFKA_PARTITIONER='crc32')
+    n_waited = 0
+    for item in items:
+        result = pipeline.process_item(item, spider=None)
+        if isinstance(result, Deferred):  # backpressure
+            n_waited += 1
+            result = yield result
+        assert result is item
+    assert n_waited > 0
+    yield pipeline.close_spider(spider=None)
+    assert producer.closed
+    assert producer.max_pending <= 5
+    messages = [json.loads(m.decode('utf8')) for m in producer.messages]
+    assert ({m['url'] for m in messages} ==
+            {item['url'] for i, item in enumerate(items) if i != 7})
+    message = next(m for m in messages if m['url'] == items[1]['url'])
+    assert message['raw_content'] == 'content 1'
+    assert 'timestamp_index' in message
+    assert all(kwargs['key'] is not None and kwargs['partition'] in {0, 1, 2}
+               for kwargs in producer.sent_kwargs)
+    assert stats.get_value('kafka_pipeline/delivered') == 49
+    assert stats.get_value('kafka_pipeline/retried') == 1
+    assert stats.get_value('kafka_pipeline/failed') == 1
+
+
+def test_kafka_pipeline_released_before_waiting(monkeypatch):
+    producer = FakeProducer()
+    producer.close = lambda: None
+    pipeline, _ = make_pipeline(
+        monkeypatch, producer, CDR_KAFKA_MAX_IN_FLIGHT=1)
+    try_send = pipeline.window.try_send
+
+    def try_send_and_deliver(message, **kwargs):
+        sent = try_send(message, **kwargs)
+        if not sent:
+            producer.flush()  # before the item is added to pending
+        return sent
+
+    pipeline.window.try_send = try_send_and_deliver
+    item1, item2 = make_items(2)
+    assert pipeline.process_item(item1, spider=None) is item1
+    result = pipeline.process_item(item2, spider=None)
+    assert isinstance(result, Deferred)
+    assert result.called
+    assert len(producer.pending) == 1
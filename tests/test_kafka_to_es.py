@@ -0,0 +1,149 @@
+from collections import namedtuple
+import io
+import json
+import sys
+
+import pytest
+from kafka.structs import TopicPartition
+
+from scrapy_cdr import kafka_to_es
+from scrapy_cdr.blob_store import open_store
+from .test_es_upload import RejectingES, make_items, kwargs_serializer
+
+
+Message = namedtuple('Message', ['topic', 'partition', 'offset', 'value'])
+
+
+class FakeConsumer:
+    """ A stand-in for kafka.KafkaConsumer, with messages spread between
+    partitions and committed offsets kept between instances.
+    """
+    def __init__(self, topic, values, committed, n_partitions=3):
+        self.committed = committed
+        self.partitions = {}
+        for i, value in enumerate(values):
+            messages = self.partitions.setdefault(
+                TopicPartition(topic, i % n_partitions), [])
+            messages.append(Message(topic, i % n_partitions, len(messages),
+                                    value))
+        self.positions = {tp: getattr(committed.get(tp), 'offset', 0)
+                          for tp in self.partitions}
+
+    def poll(self, timeout_ms, max_records):
+        records = {}
+        for tp, messages in sorted(self.partitions.items()):
+            position = self.positions[tp]
+            batch = messages[position:position + max_records -
+                             sum(map(len, records.values()))]
+            if batch:
+                records[tp] = batch
+                self.positions[tp] += len(batch)
+        return records
+
+    def commit(self, offsets):
+        self.committed.update(offsets)
+
+    def close(self, autocommit=True):
+        assert not autocommit
+
+
+class FakeS3Client:
+    """ A stand-in for botocore S3 client, keeping objects in a dict.
+    """
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Bucket, Key] = Body
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self.objects[Bucket, Key])}
+
+
+def run_main(monkeypatch, client, consumer_factory, *args):
+    monkeypatch.setattr(kafka_to_es.elasticsearch, 'Elasticsearch',
+                        lambda hosts, **kwargs: client)
+    monkeypatch.setattr(kafka_to_es, 'KafkaConsumer', consumer_factory)
+    monkeypatch.setattr(sys, 'argv', [
+        'cdr-kafka-to-es', 'topic', 'index', '--idle-timeout', '0',
+        '--batch-timeout', '0.01'] + list(map(str, args)))
+    kafka_to_es.main()
+
+
+def test_kafka_to_es(tmpdir, monkeypatch):
+    items = make_items(50)
+    store = open_store(str(tmpdir.join('store')))
+    items[3]['raw_content_stored_url'] = store.stored_url(
+        store.put(items[3].pop('raw_content').encode('utf8')))
+    values = [json.dumps(item).encode('utf8') for item in items]
+    values.insert(10, b'not json')
+    committed = {}
+    consumers = []
+
+    def consumer_factory(topic, **kwargs):
+        assert kwargs['group_id'] == 'cdr-kafka-to-es'
+        assert not kwargs['enable_auto_commit']
+        consumers.append(FakeConsumer(topic, values, committed))
+        return consumers[-1]
+
+    client = RejectingES({'ID20': 10}, **kwargs_serializer())
+    with pytest.raises(SystemExit):
+        run_main(monkeypatch, client, consumer_factory,
+                 '--batch-size', '7', '--chunk-size', '3',
+                 '--max-retries', '1', '--retry-backoff', '0.01',
+                 '--offload-store', tmpdir.join('store'))
+    assert client.docs['ID3']['raw_content'] == 'content 3'
+    assert 'raw_content_stored_url' not in client.docs['ID3']
+    # ID20 is message 21, offset 7 in partition 0
+    assert committed[TopicPartition('topic', 0)].offset == 7
+    assert all(offset.offset > 0 for offset in committed.values())
+
+    client.rejections.clear()
+    run_main(monkeypatch, client, consumer_factory)
+    assert len(client.docs) == 50
+    assert {tp.partition: offset.offset
+            for tp, offset in committed.items()} == {0: 17, 1: 17, 2: 17}
+
+
+def test_kafka_to_es_dead_letter(tmpdir, monkeypatch):
+    items = make_items(10)
+    values = [json.dumps(item).encode('utf8') for item in items]
+    committed = {}
+    client = RejectingES({'ID5': 10}, **kwargs_serializer())
+    dead_letter = tmpdir.join('failed.jl')
+    run_main(monkeypatch, client,
+             lambda topic, **kwargs: FakeConsumer(topic, values, committed),
+             '--max-retries', '0', '--dead-letter', dead_letter)
+    assert len(client.docs) == 9
+    assert json.loads(dead_letter.read())['_id'] == 'ID5'
+    assert sum(offset.offset for offset in committed.values()) == 10
+
+
+def test_committable_offsets():
+    tp0, tp1 = TopicPartition('t', 0), TopicPartition('t', 1)
+    offsets, failed = kafka_to_es.committable_offsets(
+        {(tp0, 5): True, (tp1, 3): True, (tp0, 6): False, (tp1, 4): True,
+         (tp0, 7): True})
+    assert failed
+    assert {tp: o.offset for tp, o in offsets.items()} == {tp0: 6, tp1: 5}
+
+
+def test_kafka_to_es_s3_offload(monkeypatch):
+    import botocore.session
+    s3_client = FakeS3Client()
+    session = botocore.session.get_session()
+    monkeypatch.setattr(session, 'create_client',
+                        lambda *args, **kwargs: s3_client)
+    monkeypatch.setattr(botocore.session, 'get_session', lambda: session)
+    items = make_items(3)
+    store = open_store('s3://bucket/cdr/raw')
+    key = store.put(items[1].pop('raw_content').encode('utf8'))
+    items[1]['raw_content_stored_url'] = store.stored_url(key)
+    assert list(s3_client.objects) == [('bucket', 'cdr/raw/' + key)]
+    values = [json.dumps(item).encode('utf8') for item in items]
+    committed = {}
+    client = RejectingES({}, **kwargs_serializer())
+    run_main(monkeypatch, client,
+             lambda topic, **kwargs: FakeConsumer(topic, values, committed),
+             '--offload-store', 's3://bucket/cdr/raw')
+    assert client.docs['ID1']['raw_content'] == 'content 1'
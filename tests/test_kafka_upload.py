@@ -0,0 +1,222 @@
+import gzip
+import json
+import sys
+import threading
+from six.moves.urllib.parse import urlsplit
+
+import pytest
+from kafka.errors import KafkaTimeoutError, MessageSizeTooLargeError
+from kafka.future import Future
+
+from scrapy_cdr import kafka_upload
+from scrapy_cdr.blob_store import open_store, content_key
+
+
+class FakeProducer:
+    """ A stand-in for kafka.KafkaProducer which delivers messages
+    in a separate thread on flush, failing some of them.
+    """
+    def __init__(self, failures=None, **kwargs):
+        self.kwargs = kwargs
+        self.failures = failures or {}
+        self.messages = []
+        self.sent_kwargs = []
+        self.pending = []
+        self.max_pending = 0
+
+    def partitions_for(self, topic):
+        return {0, 1, 2}
+
+    def send(self, topic, value, **kwargs):
+        future = Future()
+        self.sent_kwargs.append(kwargs)
+        self.pending.append((value, future))
+        self.max_pending = max(self.max_pending, len(self.pending))
+        if len(self.pending) >= 10:
+            self._deliver()
+        return future
+
+    def flush(self):
+        self._deliver()
+
+    def _deliver(self):
+        pending, self.pending = self.pending, []
+        thread = threading.Thread(target=self._deliver_in_thread,
+                                  args=(pending,))
+        thread.start()
+        thread.join()
+
+    def _deliver_in_thread(self, pending):
+        for value, future in pending:
+            url = json.loads(value.decode('utf8'))['url']
+            if self.failures.get(url):
+                error = self.failures[url]
+                if error is KafkaTimeoutError:
+                    self.failures[url] = None
+                future.failure(error())
+            else:
+                self.messages.append(value)
+                future.success(None)
+
+
+def test_kafka_upload(tmpdir, monkeypatch):
+    items = [{'url': 'http://example.com/{}'.format(i)} for i in range(100)]
+    path = tmpdir.join('items.jl.gz')
+    with gzip.open(str(path), 'wt') as f:
+        for item in items:
+            f.write(json.dumps(item) + '\n')
+    producer = FakeProducer(failures={
+        items[3]['url']: KafkaTimeoutError,
+        items[7]['url']: MessageSizeTooLargeError,
+    })
+    monkeypatch.setattr(kafka_upload, 'KafkaProducer',
+                        lambda **kwargs: producer)
+    monkeypatch.setattr(sys, 'argv', [
+        'cdr-kafka-upload', str(path), 'topic', '--max-in-flight', '20'])
+    with pytest.raises(SystemExit):
+        kafka_upload.main()
+    urls = {json.loads(m.decode('utf8'))['url'] for m in producer.messages}
+    assert urls == {item['url'] for i, item in enumerate(items) if i != 7}
+    assert producer.max_pending <= 10
+
+
+def test_delivery_window_bounded():
+    producer = FakeProducer()
+    producer.send = lambda topic, value: Future()  # never acknowledged
+    window = kafka_upload.DeliveryWindow(producer, 'topic', max_in_flight=3)
+    for _ in range(3):
+        window.send(b'{}')
+    assert not window._slots.acquire(blocking=False)
+
+
+def test_delivery_window_send_error():
+    producer = FakeProducer()
+    window = kafka_upload.DeliveryWindow(producer, 'topic', max_in_flight=1)
+
+    def failing_send(topic, value):
+        raise AssertionError('value must be bytes')
+
+    producer.send = failing_send
+    with pytest.raises(AssertionError):
+        window.send('{}')
+    assert window._slots.acquire(blocking=False)
+    assert window.n_retries_waiting == 0
+
+
+def test_offload(tmpdir, monkeypatch):
+    items = [{'url': 'http://example.com/{}'.format(i),
+              'raw_content': u'п' * (i * 1000)} for i in range(5)]
+    path = tmpdir.join('items.jl.gz')
+    with gzip.open(str(path), 'wt') as f:
+        for item in items:
+            f.write(json.dumps(item) + '\n')
+    producer = FakeProducer()
+    monkeypatch.setattr(kafka_upload, 'KafkaProducer',
+                        lambda **kwargs: producer)
+    store_path = tmpdir.join('store')
+    monkeypatch.setattr(sys, 'argv', [
+        'cdr-kafka-upload', str(path), 'topic',
+        '--offload-store', str(store_path), '--offload-threshold', '5000'])
+    kafka_upload.main()
+    messages = [json.loads(m.decode('utf8')) for m in producer.messages]
+    assert [m['url'] for m in messages] == [item['url'] for item in items]
+    assert [m.get('raw_content') for m in messages[:3]] == [
+        item['raw_content'] for item in items[:3]]
+    store = open_store(str(store_path))
+    for message, item in zip(messages[3:], items[3:]):
+        assert 'raw_content' not in message
+        data = item['raw_content'].encode('utf8')
+        assert message['raw_content_stored_url'] == content_key(data)
+        assert store.get(message['raw_content_stored_url']) == data
+    assert len(store_path.listdir()) == 2
+
+
+def test_message_key():
+    item = {'_id': 'ID', 'url': 'https://Example.com:8080/a', 'team': 't'}
+    assert kafka_upload.message_key(item, '_id') == b'ID'
+    assert kafka_upload.message_key(item, 'domain') == b'example.com'
+    assert kafka_upload.message_key(item, 'team') == b't'
+    assert kafka_upload.message_key({}, 'team') is None
+
+
+def test_crc32_partitioner():
+    partitioner = kafka_upload.CRC32Partitioner({2, 0, 1})
+    assert [partitioner(None) for _ in range(4)] == [0, 1, 2, 0]
+    partitions = {key: partitioner(key) for key in
+                  [b'a.com', b'b.com', b'c.com', b'd.com']}
+    assert set(partitions.values()) <= {0, 1, 2}
+    assert len(set(partitions.values())) > 1
+    assert all(partitioner(key) == p for key, p in partitions.items())
+
+
+def test_crc32_partitioner_no_partitions():
+    with pytest.raises(ValueError):
+        kafka_upload.CRC32Partitioner(None)
+
+
+class NoMetadataProducer(FakeProducer):
+    """ Knows topic partitions only after a few metadata requests.
+    """
+    def __init__(self, n_unknown, **kwargs):
+        super(NoMetadataProducer, self).__init__(**kwargs)
+        self.n_unknown = n_unknown
+
+    def partitions_for(self, topic):
+        if self.n_unknown:
+            self.n_unknown -= 1
+            return None
+        return super(NoMetadataProducer, self).partitions_for(topic)
+
+
+def test_topic_partitions():
+    producer = NoMetadataProducer(2)
+    assert kafka_upload.topic_partitions(producer, 'topic') == {0, 1, 2}
+    with pytest.raises(KafkaTimeoutError):
+        kafka_upload.topic_partitions(
+            NoMetadataProducer(100), 'topic', timeout=0.2)
+
+
+class FileProducer(FakeProducer):
+    """ Writes delivered messages to a file, to check uploads
+    from worker processes.
+    """
+    def __init__(self, path, **kwargs):
+        super(FileProducer, self).__init__(**kwargs)
+        self.path = path
+
+    def flush(self):
+        super(FileProducer, self).flush()
+        with open(self.path, 'ab') as f:
+            for message, kwargs in zip(self.messages, self.sent_kwargs):
+                f.write(json.dumps([message.decode('utf8'),
+                                    kwargs.get('key').decode('utf8'),
+                                    kwargs.get('partition')])
+                        .encode('utf8') + b'\n')
+        self.messages = []
+        self.sent_kwargs = []
+
+
+def test_workers(tmpdir, monkeypatch):
+    paths = []
+    for i in range(3):
+        path = tmpdir.join('items{}.jl'.format(i))
+        path.write(''.join(json.dumps(
+            {'url': 'http://{}.example.com/{}'.format(j % 5, j)}) + '\n'
+            for j in range(i * 10, (i + 1) * 10)))
+        paths.append(str(path))
+    output = str(tmpdir.join('messages.jl'))
+    monkeypatch.setattr(kafka_upload, 'KafkaProducer',
+                        lambda **kwargs: FileProducer(output))
+    monkeypatch.setattr(sys, 'argv', [
+        'cdr-kafka-upload'] + paths + ['topic', '--workers', '2',
+                                       '--key', 'domain',
+                                       '--partitioner', 'crc32'])
+    kafka_upload.main()
+    with open(output) as f:
+        sent = [json.loads(line) for line in f]
+    assert sorted(json.loads(m)['url'] for m, _, _ in sent) == sorted(
+        'http://{}.example.com/{}'.format(j % 5, j) for j in range(30))
+    partitions = {}
+    for message, key, partition in sent:
+        assert key == urlsplit(json.loads(message)['url']).hostname
+        assert partitions.setdefault(key, partition) == partition
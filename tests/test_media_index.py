@@ -0,0 +1,26 @@
+from scrapy_cdr.media_index import MediaIndex
+
+
+def test_media_index(tmpdir):
+    path = str(tmpdir.join('index.sqlite'))
+    index = MediaIndex(path, commit_every=1)
+    assert index.get('http://example.com/1.png') is None
+    index.put('http://example.com/1.png', 'ABCD',
+              {'content-type': 'image/png'}, '2017-01-01T00:00:00Z')
+    entry = index.get('http://example.com/1.png')
+    assert entry['path'] == 'ABCD'
+    assert entry['headers'] == {'content-type': 'image/png'}
+    assert entry['timestamp_crawl'] == '2017-01-01T00:00:00Z'
+    checked_at = entry['checked_at']
+
+    # visible from another connection, as in a different process
+    other = MediaIndex(path)
+    assert other.get('http://example.com/1.png') == entry
+    index.touch('http://example.com/1.png')
+    assert other.get('http://example.com/1.png')['checked_at'] >= checked_at
+    other.close()
+    index.close()
+
+    index = MediaIndex(path)
+    assert len(index) == 1
+    index.close()
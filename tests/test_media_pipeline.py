@@ -1,14 +1,21 @@
 from __future__ import absolute_import
 
+import errno
+import os
+import struct
+import zlib
+
 import pytest
 import scrapy
 from scrapy.crawler import CrawlerRunner
 from scrapy.linkextractors import LinkExtractor
 from scrapy.settings import Settings
 from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
 
-from scrapy_cdr import text_cdr_item
-from .mockserver import MockServer
+from scrapy_cdr import media_pipeline, text_cdr_item
+from scrapy_cdr.media_pipeline import CDRMediaPipeline
+from .mockserver import MockServer, PORT
 from .utils import text_resource, find_item, inlineCallbacks
 
 
@@ -58,6 +65,74 @@ class PDFFile(Resource):
         return FILE_CONTENTS
 
 
+class ETagFile(Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader(b'content-type', b'application/pdf')
+        request.setHeader(b'etag', b'"1"')
+        if request.getHeader(b'if-none-match') == b'"1"':
+            request.setResponseCode(304)
+            return b''
+        return FILE_CONTENTS
+
+
+class WithETagFile(Resource):
+    def __init__(self):
+        Resource.__init__(self)
+        self.putChild(b'', text_resource(
+            '<a href="/file.pdf">file</a>')())
+        self.putChild(b'file.pdf', ETagFile())
+
+
+GZIP_CONTENTS = b'a' * 1000
+
+
+def gzip_same_size(data):
+    """ gzip data, padding the header with a comment,
+    so that compressed size is the same as len(data).
+    """
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    trailer = struct.pack('<II', zlib.crc32(data), len(data))
+    header = b'\x1f\x8b\x08\x10' + b'\x00' * 4 + b'\x00\xff'
+    comment_size = len(data) - len(header) - len(deflated) - len(trailer) - 1
+    return header + b'c' * comment_size + b'\x00' + deflated + trailer
+
+
+class GzipFile(Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader(b'content-type', b'application/pdf')
+        request.setHeader(b'content-encoding', b'gzip')
+        return gzip_same_size(GZIP_CONTENTS)
+
+
+class WithGzipFile(Resource):
+    def __init__(self):
+        Resource.__init__(self)
+        self.putChild(b'', text_resource(
+            '<a href="/file.pdf">file</a>')())
+        self.putChild(b'file.pdf', GzipFile())
+
+
+class WithFileChain(Resource):
+    """ Pages linked in a chain, the first and the last one
+    referencing the same file.
+    """
+    def __init__(self):
+        Resource.__init__(self)
+        self.putChild(b'', text_resource(
+            '<a href="/file.pdf">file</a> <a href="/page2">next</a>')())
+        self.putChild(b'page2', text_resource(
+            '<a href="/file2.pdf">file</a> <a href="/page3">next</a>')())
+        self.putChild(b'page3', text_resource(
+            '<a href="/file.pdf">file</a>')())
+        self.putChild(b'file.pdf', PDFFile())
+        self.putChild(b'file2.pdf', PDFFile())
+
+
 class WithFile(Resource):
     def __init__(self):
         Resource.__init__(self)
@@ -116,3 +191,257 @@ def test_media_pipeline(tmpdir, max_cache):
         '/file.pdf', another_page_item['objects'], 'obj_original_url')
     assert file_item_q['obj_stored_url'] == file_item['obj_stored_url']
     assert file_item_q['obj_original_url'] == file_item['obj_original_url']
+
+
+@inlineCallbacks
+def test_media_pipeline_max_size_budget(tmpdir):
+    crawler = make_crawler(FILES_STORE='file://{}'.format(tmpdir),
+                           CDR_MEDIA_MAX_SIZE=len(FILE_CONTENTS) + 1,
+                           CDR_MEDIA_MEMORY_BUDGET=1)
+    with MockServer(WithFile) as s:
+        yield crawler.crawl(url=s.root_url)
+    spider = crawler.spider
+    assert len(spider.collected_items) == 3
+
+    root_item = find_item('/', spider.collected_items)
+    # forbidden.pdf is larger than CDR_MEDIA_MAX_SIZE
+    assert [obj['obj_original_url'] for obj in root_item['objects']] == \
+        [s.root_url + '/file.pdf']
+    file_item = root_item['objects'][0]
+    with tmpdir.join(file_item['obj_stored_url']).open('rb') as f:
+        assert f.read() == FILE_CONTENTS
+    assert tmpdir.join('.spool').listdir() == []
+
+
+@inlineCallbacks
+@pytest.mark.parametrize(['max_age'], [[None], [1e-6]])
+def test_media_pipeline_index(tmpdir, max_age):
+    settings = dict(FILES_STORE='file://{}'.format(tmpdir),
+                    CDR_MEDIA_INDEX=str(tmpdir.join('index.sqlite')),
+                    CDR_MEDIA_INDEX_MAX_AGE=max_age)
+    stored_urls = []
+    with MockServer(WithETagFile) as s:
+        for status in ['downloaded', 'uptodate']:
+            crawler = make_crawler(**settings)
+            yield crawler.crawl(url=s.root_url)
+            assert crawler.stats.get_value(
+                'file_status_count/{}'.format(status)) == 1
+            item, = crawler.spider.collected_items
+            obj, = item['objects']
+            assert obj['obj_original_url'] == s.root_url + '/file.pdf'
+            assert obj['content_type'] == 'application/pdf'
+            stored_urls.append(obj['obj_stored_url'])
+    assert stored_urls[0] == stored_urls[1]
+
+
+@inlineCallbacks
+def test_media_pipeline_skip_existing(tmpdir):
+    with MockServer(WithFile) as s:
+        crawler = make_crawler(FILES_STORE='file://{}'.format(tmpdir))
+        yield crawler.crawl(url=s.root_url)
+        stats = crawler.stats
+        # file.pdf and forbidden.pdf are written,
+        # file.pdf?allow=true has the same contents as file.pdf
+        assert stats.get_value('media_store/miss') == 2
+        assert stats.get_value('media_store/hit_cache') == 1
+        assert stats.get_value('media_store/hit_store') is None
+
+        crawler = make_crawler(FILES_STORE='file://{}'.format(tmpdir))
+        yield crawler.crawl(url=s.root_url)
+        stats = crawler.stats
+        assert stats.get_value('media_store/miss') is None
+        assert stats.get_value('media_store/hit_store') == 2
+        assert stats.get_value('media_store/hit_cache') == 1
+    assert tmpdir.join('.spool').listdir() == []
+
+
+@inlineCallbacks
+@pytest.mark.parametrize(['cache_bytes'], [[100000], [2500]])
+def test_media_pipeline_cache_bytes(tmpdir, cache_bytes):
+    # with one item at a time, each page is requested after objects
+    # of the previous one are downloaded
+    crawler = make_crawler(FILES_STORE='file://{}'.format(tmpdir),
+                           CDR_MEDIA_CACHE_BYTES=cache_bytes,
+                           CONCURRENT_ITEMS=1)
+    with MockServer(WithFileChain) as s:
+        yield crawler.crawl(url=s.root_url)
+    stats = crawler.stats
+    n_hits = stats.get_value('media_cache/hit', 0)
+    n_misses = stats.get_value('media_cache/miss', 0)
+    n_evictions = stats.get_value('media_cache/eviction', 0)
+    if cache_bytes == 100000:
+        # file.pdf is found when referenced for the second time
+        assert (n_hits, n_misses, n_evictions) == (1, 2, 0)
+    else:
+        # only one result fits, file.pdf is evicted by file2.pdf
+        assert (n_hits, n_misses, n_evictions) == (0, 3, 2)
+    page_item = find_item('/page3', crawler.spider.collected_items)
+    obj, = page_item['objects']
+    assert obj['content_type'] == 'application/pdf'
+    assert obj['response_headers']['content-hype'] == 'very/high'
+
+
+class SlowPDFFile(Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        from twisted.internet import reactor
+        request.setHeader(b'content-type', b'application/pdf')
+
+        def finish():
+            request.write(FILE_CONTENTS)
+            request.finish()
+
+        reactor.callLater(0.2, finish)
+        return NOT_DONE_YET
+
+
+class WithSlowFilesOnTwoHosts(Resource):
+    def __init__(self):
+        Resource.__init__(self)
+        self.putChild(b'', text_resource(' '.join(
+            '<a href="http://{}:{}/file{}.pdf">file</a>'.format(host, PORT, i)
+            for host in ['127.0.0.1', 'localhost'] for i in range(3)))())
+        for i in range(3):
+            self.putChild('file{}.pdf'.format(i).encode(), SlowPDFFile())
+
+
+@inlineCallbacks
+def test_media_pipeline_concurrency(tmpdir, monkeypatch):
+    max_in_flight = {'all': 0, 'host': 0}
+    acquire_slot = CDRMediaPipeline._acquire_slot
+
+    def recording_acquire_slot(self, request):
+        acquire_slot(self, request)
+        max_in_flight['all'] = max(max_in_flight['all'], self.n_in_flight)
+        max_in_flight['host'] = max(
+            max_in_flight['host'], *self._in_flight_per_host.values())
+
+    monkeypatch.setattr(
+        CDRMediaPipeline, '_acquire_slot', recording_acquire_slot)
+    crawler = make_crawler(FILES_STORE='file://{}'.format(tmpdir),
+                           CDR_MEDIA_CONCURRENT_REQUESTS=2,
+                           CDR_MEDIA_CONCURRENT_REQUESTS_PER_DOMAIN=1,
+                           CDR_MEDIA_PRIORITY=-10)
+    with MockServer(WithSlowFilesOnTwoHosts) as s:
+        yield crawler.crawl(url=s.root_url)
+    item, = crawler.spider.collected_items
+    assert len(item['objects']) == 6
+    assert crawler.stats.get_value('response_received_count') == 7
+    # both hosts were downloaded from at the same time, one file per host
+    assert max_in_flight == {'all': 2, 'host': 1}
+
+
+@inlineCallbacks
+def test_media_pipeline_max_objects(tmpdir):
+    crawler = make_crawler(FILES_STORE='file://{}'.format(tmpdir),
+                           CDR_MEDIA_MAX_OBJECTS_PER_ITEM=1)
+    with MockServer(WithFile) as s:
+        yield crawler.crawl(url=s.root_url)
+    spider = crawler.spider
+    assert len(spider.collected_items) == 3
+    root_item = find_item('/', spider.collected_items)
+    obj, = root_item['objects']  # objects are not ordered
+    assert obj['obj_original_url'] in {
+        s.root_url + '/file.pdf', s.root_url + '/forbidden.pdf'}
+    assert crawler.stats.get_value('media/objects_over_limit') == 1
+    for item in spider.collected_items:
+        assert len(item['objects']) == 1
+
+
+@inlineCallbacks
+def test_media_pipeline_decompressed(tmpdir):
+    assert len(gzip_same_size(GZIP_CONTENTS)) == len(GZIP_CONTENTS)
+    crawler = make_crawler(FILES_STORE='file://{}'.format(tmpdir))
+    with MockServer(WithGzipFile) as s:
+        yield crawler.crawl(url=s.root_url)
+    item, = crawler.spider.collected_items
+    obj, = item['objects']
+    with tmpdir.join(obj['obj_stored_url']).open('rb') as f:
+        assert f.read() == GZIP_CONTENTS
+    assert tmpdir.join('.spool').listdir() == []
+
+
+@inlineCallbacks
+def test_media_pipeline_spool_other_fs(tmpdir, monkeypatch):
+    spool_dir = str(tmpdir.join('spool'))
+    replace = os.replace
+
+    def cross_device_replace(src, dest):
+        if src.startswith(spool_dir):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        replace(src, dest)
+
+    monkeypatch.setattr(os, 'replace', cross_device_replace)
+    store = tmpdir.join('store')
+    crawler = make_crawler(FILES_STORE='file://{}'.format(store),
+                           CDR_MEDIA_SPOOL_DIR=spool_dir)
+    with MockServer(WithETagFile) as s:
+        yield crawler.crawl(url=s.root_url)
+    item, = crawler.spider.collected_items
+    obj, = item['objects']
+    with store.join(obj['obj_stored_url']).open('rb') as f:
+        assert f.read() == FILE_CONTENTS
+    assert tmpdir.join('spool').listdir() == []
+    assert [p.basename for p in store.listdir()] == [obj['obj_stored_url']]
+
+
+class GetValueStore:
+    """ A store which needs the body in memory, like GCSFilesStore.
+    """
+    def __init__(self, uri):
+        self.basedir = uri[len('getvalue://'):]
+
+    def persist_file(self, path, buf, info, meta=None, headers=None):
+        with open(os.path.join(self.basedir, path), 'wb') as f:
+            f.write(buf.getvalue())
+
+    def stat_file(self, path, info):
+        return {}
+
+
+class GetValueMediaPipeline(CDRMediaPipeline):
+    STORE_SCHEMES = dict(CDRMediaPipeline.STORE_SCHEMES,
+                         getvalue=GetValueStore)
+
+
+@inlineCallbacks
+def test_media_pipeline_getvalue_store(tmpdir):
+    crawler = make_crawler(
+        FILES_STORE='getvalue://{}'.format(tmpdir),
+        ITEM_PIPELINES={
+            'tests.test_media_pipeline.GetValueMediaPipeline': 1,
+            'tests.utils.CollectorPipeline': 100,
+        })
+    with MockServer(WithETagFile) as s:
+        yield crawler.crawl(url=s.root_url)
+    item, = crawler.spider.collected_items
+    obj, = item['objects']
+    with tmpdir.join(obj['obj_stored_url']).open('rb') as f:
+        assert f.read() == FILE_CONTENTS
+
+
+@inlineCallbacks
+def test_media_pipeline_store_error(tmpdir, monkeypatch):
+    def failing_move(src, dest):
+        raise OSError(errno.ENOSPC, 'No space left on device')
+
+    monkeypatch.setattr(media_pipeline, '_move_file', failing_move)
+    pipelines = []
+    open_spider = CDRMediaPipeline.open_spider
+
+    def recording_open_spider(self, spider):
+        pipelines.append(self)
+        return open_spider(self, spider)
+
+    monkeypatch.setattr(CDRMediaPipeline, 'open_spider', recording_open_spider)
+    crawler = make_crawler(FILES_STORE='file://{}'.format(tmpdir))
+    with MockServer(WithFile) as s:
+        yield crawler.crawl(url=s.root_url)
+    assert len(crawler.spider.collected_items) == 3
+    # file.pdf is not found in the store when it is referenced again
+    assert crawler.stats.get_value('media_store/miss') == 3
+    # failed downloads do not count against CDR_MEDIA_MEMORY_BUDGET
+    pipeline, = pipelines
+    assert pipeline.bytes_in_flight == 0
+    assert tmpdir.join('.spool').listdir() == []
@@ -0,0 +1,104 @@
+import json
+import os
+import sys
+
+import pytest
+
+from scrapy_cdr import jl_io, media_relayout
+from scrapy_cdr.media_relayout import Relayout, reverse_domain_path
+
+
+def test_reverse_domain_path():
+    assert reverse_domain_path(
+        'http://images.example.com:8080/1.jpg', 'ABCD.jpg') == \
+        os.path.join('com', 'example', 'images', 'ABCD')
+
+
+def make_media(media_root, names):
+    media_root.ensure(dir=True)
+    for name in names:
+        media_root.join(name).write_binary(name.encode('ascii'))
+
+
+def make_item(*objects):
+    return {'objects': [{'obj_original_url': url, 'obj_stored_url': stored}
+                        for url, stored in objects]}
+
+
+@pytest.mark.parametrize(['mode'], [[m] for m in media_relayout.MODES])
+def test_relayout(tmpdir, mode):
+    media_root = tmpdir.join('media')
+    make_media(media_root, ['A.jpg', 'B.png'])
+    relayout = Relayout(str(media_root), mode=mode, threads=4)
+    items = [
+        make_item(('http://a.com/1.jpg', 'A.jpg'),
+                  ('http://b.a.com/2.png', 'B.png')),
+        make_item(('http://a.com/3.jpg', 'A.jpg')),
+        make_item(('http://c.com/1.jpg', 'A.jpg')),
+    ]
+    for item in items:
+        relayout.relayout_item(item)
+    relayout.close()
+    assert [[obj['obj_stored_url'] for obj in item['objects']]
+            for item in items] == [
+        ['com/a/A', 'com/a/b/B'], ['com/a/A'], ['com/c/A']]
+    assert media_root.join('com/a/A').read_binary() == b'A.jpg'
+    assert media_root.join('com/c/A').read_binary() == b'A.jpg'
+    assert media_root.join('com/a/b/B').read_binary() == b'B.png'
+    assert media_root.join('A.jpg').exists() == (mode != 'rename')
+    if mode in {'hardlink', 'rename'}:
+        assert media_root.join('com/a/A').stat().nlink == (
+            3 if mode == 'hardlink' else 2)
+    assert (relayout.n_done, relayout.n_failed) == (3, 0)
+
+
+def test_relayout_missing(tmpdir):
+    media_root = tmpdir.join('media')
+    make_media(media_root, [])
+    relayout = Relayout(str(media_root), mode='hardlink')
+    relayout.relayout_item(make_item(('http://a.com/1.jpg', 'A.jpg')))
+    relayout.close()
+    assert (relayout.n_done, relayout.n_failed) == (0, 1)
+
+
+def test_relayout_rename_seen_again(tmpdir):
+    media_root = tmpdir.join('media')
+    make_media(media_root, ['A.jpg', 'B.jpg'])
+    relayout = Relayout(str(media_root), mode='rename', max_cached=1)
+    for url, stored in [('http://a.com/1.jpg', 'A.jpg'),
+                        ('http://b.com/1.jpg', 'B.jpg'),
+                        ('http://c.com/1.jpg', 'A.jpg')]:
+        relayout.relayout_item(make_item((url, stored)))
+        relayout.wait()
+    relayout.close()
+    assert (relayout.n_done, relayout.n_failed) == (3, 0)
+    assert media_root.join('com/c/A').read_binary() == b'A.jpg'
+    assert not media_root.join('A.jpg').exists()
+    assert not media_root.join('B.jpg').exists()
+
+
+def test_main(tmpdir, monkeypatch):
+    media_root = tmpdir.join('media')
+    make_media(media_root, ['A.jpg'])
+    path = tmpdir.join('items.jl')
+    path.write(json.dumps(make_item(('http://a.com/1.jpg', 'A.jpg'))))
+    output = tmpdir.join('items-relayout.jl.gz')
+    monkeypatch.setattr(sys, 'argv', [
+        'cdr-media-relayout', str(path), '--media-root', str(media_root),
+        '--output', str(output)])
+    media_relayout.main()
+    assert list(jl_io.iter_items(str(output))) == [
+        make_item(('http://a.com/1.jpg', 'com/a/A'))]
+    assert media_root.join('com/a/A').exists()
+
+
+def test_main_missing(tmpdir, monkeypatch):
+    media_root = tmpdir.join('media')
+    make_media(media_root, [])
+    path = tmpdir.join('items.jl')
+    path.write(json.dumps(make_item(('http://a.com/1.jpg', 'A.jpg'))))
+    monkeypatch.setattr(sys, 'argv', [
+        'cdr-media-relayout', str(path), '--media-root', str(media_root)])
+    with pytest.raises(SystemExit) as e:
+        media_relayout.main()
+    assert e.value.code == 1
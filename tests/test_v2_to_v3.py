@@ -0,0 +1,71 @@
+import gzip
+import json
+import sys
+
+import pytest
+
+from scrapy_cdr import jl_io, v2_to_v3
+from scrapy_cdr.items import CDRItem
+
+
+def make_v2_items(n):
+    return [{'url': 'http://example.com/{}'.format(i),
+             'timestamp': 1487190659000 + i,
+             'crawler': 'crawler',
+             'team': 'team',
+             'version': 2.0,
+             'raw_content': u'<p>п {}</p>'.format(i),
+             'content_type': 'text/html',
+             } for i in range(n)]
+
+
+def test_convert_item():
+    v2_item, = make_v2_items(1)
+    item = v2_to_v3.convert_item(v2_item)
+    assert dict(CDRItem(**item)) == item
+    assert item['version'] == 3.0
+    assert item['response_headers'] == {'content-type': 'text/html'}
+    with pytest.raises(ValueError):
+        v2_to_v3.convert_item(dict(v2_item, version=3.0))
+
+
+def test_convert_lines():
+    lines = [json.dumps(item).encode('utf8') + b'\n'
+             for item in make_v2_items(3)]
+    data, n_items = v2_to_v3.convert_lines(lines + [b'{"url'], broken=True)
+    assert n_items == 3
+    assert [json.loads(line) for line in data.decode('utf8').splitlines()] \
+        == [v2_to_v3.convert_item(item) for item in make_v2_items(3)]
+    with pytest.raises(ValueError):
+        v2_to_v3.convert_lines(lines + [b'{"url'])
+
+
+@pytest.mark.parametrize(['extra_args'], [
+    [['--workers', '1']],
+    [['--workers', '2', '--batch-size', '7']],
+    [['--workers', '2', '--batch-size', '7', '--unordered',
+      '--shards', '3']],
+])
+def test_main(tmpdir, monkeypatch, extra_args):
+    items = make_v2_items(100)
+    for i in range(2):
+        with gzip.open(str(tmpdir.join('items{}.v2.jl.gz'.format(i))),
+                       'wt') as f:
+            for item in items[i * 50:(i + 1) * 50]:
+                f.write(json.dumps(item) + '\n')
+    output = str(tmpdir.join('items.v3.jl.gz'))
+    monkeypatch.setattr(sys, 'argv', [
+        'cdr-v2-to-v3', str(tmpdir.join('items*.v2.jl.gz')), output,
+        ] + extra_args)
+    v2_to_v3.main()
+    if '--shards' in extra_args:
+        outputs = [jl_io.part_path(output, 'shard{}'.format(i))
+                   for i in range(3)]
+    else:
+        outputs = [output]
+    result = [item for path in outputs for item in jl_io.iter_items(path)]
+    expected = [v2_to_v3.convert_item(item) for item in items]
+    if '--unordered' in extra_args:
+        result.sort(key=lambda x: x['url'])
+        expected.sort(key=lambda x: x['url'])
+    assert result == expected